@@ -12,6 +12,7 @@ from modelmapper.initialize import initialize
 from modelmapper.etl import ETL
 from modelmapper.loader import (
     BaseLoaderMixin,
+    PostgresCopyLoaderMixin,
     SignatureSqlalchemyMixin,
     SqlalchemyBulkLoaderMixin,
     SqlalchemyLoaderMixin,
@@ -0,0 +1,93 @@
+import os
+import json
+import sqlite3
+import hashlib
+from contextlib import closing
+
+from modelmapper.misc import FileNotFound, convert_dict_keys
+
+# Adding a csv to the training csvs should not make the other csvs to be analyzed again.
+FINGERPRINT_IGNORED_SETTINGS = {'training_csvs'}
+
+
+def _json_default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError(f'{obj!r} is not JSON serializable')
+
+
+def get_csv_fingerprint(csv_path, settings, **kwargs):
+    """
+    Returns a hash of the size and modification time of the csv, the settings and the kwargs.
+    It changes when the csv is modified or when anything that the analysis depends on changes,
+    without reading the csv.
+    """
+    stat = os.stat(csv_path)
+    settings = {k: v for k, v in settings._asdict().items() if k not in FINGERPRINT_IGNORED_SETTINGS}
+    contents = json.dumps([stat.st_size, stat.st_mtime_ns, settings, kwargs], sort_keys=True, default=_json_default)
+    return hashlib.sha1(contents.encode('utf-8')).hexdigest()
+
+
+class AnalysisStore:
+    """
+    Stores the analyzed results of the training csvs of a model in a single SQLite file.
+    Each csv has one row that is replaced when the csv is analyzed again, so the rest of the
+    results do not need to be rewritten and all of them are read back with one query.
+    The row keeps the fingerprint of the csv so the results are reused until the csv changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE IF NOT EXISTS analysis (csv_name TEXT PRIMARY KEY, results TEXT NOT NULL, '
+                     'fingerprint TEXT, empty_fields TEXT)')
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(analysis)')}
+        # The stores that were made before the fingerprints are analyzed again once.
+        for column in ('fingerprint', 'empty_fields'):
+            if column not in columns:
+                conn.execute(f'ALTER TABLE analysis ADD COLUMN {column} TEXT')
+        return conn
+
+    def write(self, csv_name, results, fingerprint=None, empty_fields=()):
+        """
+        Writes the analyzed results of the csv. The empty fields are the fields of the csv that only had
+        null values and are not in the results.
+        """
+        contents = json.dumps(results, default=_json_default)
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO analysis (csv_name, results, fingerprint, empty_fields) '
+                         'VALUES (?, ?, ?, ?)', (csv_name, contents, fingerprint, json.dumps(sorted(empty_fields))))
+
+    def get(self, csv_name, fingerprint, keys_to_convert_to_set=None):
+        """
+        Returns the analyzed results and the empty fields of the csv if it was analyzed with the same
+        fingerprint, otherwise None.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT results, empty_fields FROM analysis WHERE csv_name = ? AND fingerprint = ?',
+                               (csv_name, fingerprint)).fetchone()
+        if row is None:
+            return None
+        loaded = json.loads(row[0])
+        if keys_to_convert_to_set:
+            convert_dict_keys(loaded, keys=keys_to_convert_to_set, func=set)
+        return loaded, set(json.loads(row[1] or '[]'))
+
+    def read(self, csv_names, keys_to_convert_to_set=None):
+        """
+        Returns the analyzed results of the csvs in the same order as the csv names.
+        """
+        with closing(self._connect()) as conn:
+            rows = dict(conn.execute('SELECT csv_name, results FROM analysis'))
+        results = []
+        for csv_name in csv_names:
+            try:
+                loaded = json.loads(rows[csv_name])
+            except KeyError:
+                raise FileNotFound(f'{csv_name} is not analyzed in {self.path}') from None
+            if keys_to_convert_to_set:
+                convert_dict_keys(loaded, keys=keys_to_convert_to_set, func=set)
+            results.append(loaded)
+        return results
@@ -9,11 +9,12 @@ from collections import defaultdict
 
 from collections import namedtuple, Counter
 
-from modelmapper.misc import read_csv_gen, load_toml, camel_to_snake
+from modelmapper.misc import read_csv_gen, read_csv_lines_gen, load_toml, camel_to_snake
 from modelmapper.slack import slack
 
 OVERRIDES_FILE_NAME = "{}_overrides.toml"
 COMBINED_FILE_NAME = "{}_combined.py"
+QUESTIONS_FILE_NAME = "{}_questions.toml"
 
 
 class Base:
@@ -48,16 +49,32 @@ class Base:
         # attempt to get passed in value from ENV VAR, defaulting to passed in value if not present
         slack_http_endpoint = os.environ.get(slack_http_endpoint, slack_http_endpoint)
         self.settings['should_reprocess'] = self.settings.get('should_reprocess', False)
+        self.settings['training_sample_size'] = self.settings.get('training_sample_size', 0)
+        self.settings['training_streaming'] = self.settings.get('training_streaming', False)
+        self.settings['training_short_circuit_string_fields'] = self.settings.get(
+            'training_short_circuit_string_fields', False)
+        self.settings['analysis_store'] = self.settings.get('analysis_store', '')
+        self.settings['track_cleaning_field_costs'] = self.settings.get('track_cleaning_field_costs', False)
+        self.settings['memory_profiling'] = self.settings.get('memory_profiling', '')
+        self.settings['memory_warning_bytes'] = self.settings.get('memory_warning_bytes', 0)
+        self.settings['signature_strategy'] = self.settings.get('signature_strategy', 'cleaned')
+        self.settings['signature_bits'] = self.settings.get('signature_bits', 128)
+        self.settings['signature_format'] = self.settings.get('signature_format', 'hex')
+        self.settings['signature_dedup_max_bytes'] = self.settings.get('signature_dedup_max_bytes', 268435456)
         self.settings['slack_http_endpoint'] = slack_http_endpoint
         self.settings['identifier'] = identifier = os.path.basename(self.setup_path).replace('_setup.toml', '')
         self.settings['overrides_file_name'] = OVERRIDES_FILE_NAME.format(identifier)
         self.settings['combined_file_name'] = COMBINED_FILE_NAME.format(identifier)
+        self.settings['questions_file_name'] = QUESTIONS_FILE_NAME.format(identifier)
         self.settings['booleans'] = self.settings['boolean_true'] | self.settings['boolean_false']
         self.settings['datetime_allowed_characters'] = set(self.settings['datetime_allowed_characters'])
         for i, v in (('overrides_path', 'overrides_file_name'),
                      ('combined_path', 'combined_file_name'),
+                     ('questions_path', 'questions_file_name'),
                      ('output_model_path', 'output_model_file')):
             self.settings[i] = os.path.join(self.setup_dir, self.settings[v])
+        analysis_store = self.settings['analysis_store']
+        self.settings['analysis_store_path'] = os.path.join(self.setup_dir, analysis_store) if analysis_store else ''
         # Since we cleaning up the field_name_part_conversion, special characters
         # such as \n need to be added seperately.
         # self.settings['field_name_part_conversion'].insert(0, ['\n', '_']).insert(0, ['\r\n', '_'])
@@ -133,10 +150,14 @@ class Base:
         if duplicates:
             raise ValueError(f'The following fields were repeated in the csv: {duplicates}')
 
-    def _get_clean_names_and_csv_data_gen(self, path):
-        reader = read_csv_gen(path,
-                              identify_header_by_column_names=self.settings.identify_header_by_column_names,
-                              cleaning_func=self._clean_it)
+    def _get_clean_names_and_csv_data_gen(self, path, line_by_line=False):
+        """
+        line_by_line: (optional) If true, the file of the path is read line by line instead of all at once.
+        """
+        read_csv = read_csv_lines_gen if line_by_line else read_csv_gen
+        reader = read_csv(path,
+                          identify_header_by_column_names=self.settings.identify_header_by_column_names,
+                          cleaning_func=self._clean_it)
         names = next(reader)
         self._verify_no_duplicate_names(names)
         name_mapping = self._get_all_clean_field_names_mapping(names)
@@ -144,21 +165,27 @@ class Base:
         clean_names = list(name_mapping.values())
         return clean_names, reader
 
-    def _get_all_values_per_clean_name(self, path):
+    def _get_all_values_per_clean_name(self, path, line_filter=None):
+        """
+        line_filter: (optional) A function that gets the clean names and the lines that include data
+                     and yields the lines to be kept.
+        """
         result = defaultdict(list)
         clean_names, reader = self._get_clean_names_and_csv_data_gen(path)
+        lines = (line for line in reader if self._does_line_include_data(line))
+        if line_filter is not None:
+            lines = line_filter(clean_names, lines)
         # transposing csv and turning into dictionary
-        for line in reader:
-            if self._does_line_include_data(line):
-                for i, v in enumerate(line):
-                    try:
-                        field_name = clean_names[i]
-                    except IndexError:
-                        raise ValueError("Your data might have new lines in the field names. "
-                                         "Please fix that and try again.")
-                    else:
-                        if field_name not in self.settings.fields_to_be_scrubbed:
-                            result[field_name].append(v)
+        for line in lines:
+            for i, v in enumerate(line):
+                try:
+                    field_name = clean_names[i]
+                except IndexError:
+                    raise ValueError("Your data might have new lines in the field names. "
+                                     "Please fix that and try again.")
+                else:
+                    if field_name not in self.settings.fields_to_be_scrubbed:
+                        result[field_name].append(v)
         return result
 
     def slack(self, text):
@@ -0,0 +1,365 @@
+"""
+Benchmarks of the hot paths: training the model, cleaning the data, generating the row signatures
+and loading the rows. The benchmarks run on synthetic csvs so the results can be compared across
+releases and saved as a baseline to catch regressions.
+"""
+import io
+import os
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import NamedTuple
+
+from sqlalchemy import (Column, MetaData, Table, String, SmallInteger, Integer, BigInteger, DECIMAL, DateTime,
+                        Boolean)
+from sqlalchemy.dialects import postgresql
+from tabulate import tabulate
+
+from modelmapper.cleaner import Cleaner
+from modelmapper.instrumentation import EtlInstrumentation, StageMetrics
+from modelmapper.loader import SqlalchemyBulkLoaderMixin
+from modelmapper.mapper import Mapper, SqlalchemyFieldType
+from modelmapper.misc import load_toml, write_settings, generator_chunker
+from modelmapper.signature import BoundedSignatureSet
+from modelmapper.synthetic import write_synthetic_file
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The fields of the columns of each type of the synthetic csvs.
+COLUMN_FIELDS = {
+    'int': {'field_db_sqlalchemy_type': SqlalchemyFieldType.SmallInteger},
+    'decimal': {'field_db_sqlalchemy_type': SqlalchemyFieldType.Decimal, 'args': (7, 3)},
+    'dollar': {'field_db_sqlalchemy_type': SqlalchemyFieldType.Integer, 'is_dollar': True},
+    'percent': {'field_db_sqlalchemy_type': SqlalchemyFieldType.Decimal, 'args': (5, 3), 'is_percent': True},
+    'boolean': {'field_db_sqlalchemy_type': SqlalchemyFieldType.Boolean},
+    'datetime': {'field_db_sqlalchemy_type': SqlalchemyFieldType.DateTime, 'datetime_formats': {'%m/%d/%Y'}},
+    'string': {'field_db_sqlalchemy_type': SqlalchemyFieldType.String, 'args': 40},
+}
+
+TYPE_MIXES = {
+    'numeric': ('int', 'decimal', 'dollar', 'percent'),
+    'text': ('string', ),
+    'datetime': ('datetime', ),
+    'mixed': ('int', 'decimal', 'dollar', 'percent', 'boolean', 'datetime', 'string'),
+}
+
+SQLALCHEMY_TYPES = {
+    SqlalchemyFieldType.String: String,
+    SqlalchemyFieldType.SmallInteger: SmallInteger,
+    SqlalchemyFieldType.Integer: Integer,
+    SqlalchemyFieldType.BigInteger: BigInteger,
+    SqlalchemyFieldType.Decimal: DECIMAL,
+    SqlalchemyFieldType.DateTime: DateTime,
+    SqlalchemyFieldType.Boolean: Boolean,
+}
+
+NULL_RATE = 0.05
+
+LOADER_CHUNK_ROWS = 300
+
+
+class BenchmarkCase(NamedTuple):
+    rows: 'BenchmarkCase' = 10000
+    columns: 'BenchmarkCase' = 10
+    type_mix: 'BenchmarkCase' = 'mixed'
+
+    @property
+    def name(self):
+        return f'{self.type_mix}_{self.rows}x{self.columns}'
+
+
+class NullResult:
+
+    rowcount = 0
+
+    def fetchall(self):
+        return []
+
+
+class NullSession:
+    """
+    Session that compiles the statements for PostgreSQL but does not run them,
+    so only the loader and building the statements are measured.
+    """
+    dialect = postgresql.dialect()
+
+    def execute(self, query):
+        query.compile(dialect=self.dialect)
+        return NullResult()
+
+    def flush(self):
+        pass
+
+
+class BenchmarkLoader(SqlalchemyBulkLoaderMixin, Cleaner):
+    """
+    Cleaner with the bulk loader of the ETLs. The rows are loaded into a records model with the fields
+    of the combined module through a NullSession.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # There is no line filter to add the raw_line signatures.
+        self.settings = self.settings._replace(signature_strategy='cleaned')
+        self.instrumentation = EtlInstrumentation()
+
+    def reset_loader(self, fields):
+        self.RECORDS_MODEL = get_records_model(fields)
+        self.all_recent_rows_signatures = BoundedSignatureSet(self.settings.signature_dedup_max_bytes)
+        self.instrumentation.reset()
+
+
+def get_records_model(fields):
+    """A model of the records table with the id, the signature and the fields of the combined module."""
+    columns = [Column(name, SQLALCHEMY_TYPES[field_info['field_db_sqlalchemy_type']])
+               for name, field_info in fields.items()]
+    table = Table('records', MetaData(), Column('id', Integer, primary_key=True), Column('signature', String),
+                  *columns)
+    return type('Records', (), {'__table__': table})
+
+
+def get_synthetic_fields(case):
+    """
+    The fields of the synthetic csv of the case. The columns cycle through the types of the type mix.
+    """
+    column_types = TYPE_MIXES[case.type_mix]
+    fields = {}
+    for i in range(case.columns):
+        _type = column_types[i % len(column_types)]
+        fields[f'{_type}_{i}'] = dict(COLUMN_FIELDS[_type], is_nullable=True)
+    return fields
+
+
+def write_synthetic_csv(path, case, seed=0):
+    """
+    Writes a csv with the rows and columns of the case where NULL_RATE of the values are empty.
+
+    Returns:
+        list: the column names.
+    """
+    fields = get_synthetic_fields(case)
+    write_synthetic_file(path, fields, case.rows, file_format='csv', null_rate=NULL_RATE, seed=seed)
+    return list(fields.keys())
+
+
+def _write_setup(work_dir, identifier, csv_name, column_names):
+    template_setup_path = os.path.join(current_dir, 'templates/setup_template.toml')
+    settings = load_toml(template_setup_path)['settings']
+    settings['training_csvs'] = [csv_name]
+    # The csv sniffer can not always tell that the synthetic csv has a header.
+    settings['identify_header_by_column_names'] = column_names
+    settings['output_model_file'] = f'{identifier}_model.py'
+    setup_path = os.path.join(work_dir, f'{identifier}_setup.toml')
+    write_settings(setup_path, settings)
+    return setup_path
+
+
+def _measure(func, rows, trace_memory):
+    """
+    Runs the function and measures it. If rows is None, the number of rows is the length of the result.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    if rows is None:
+        rows = len(result)
+    metrics = {
+        'seconds': seconds,
+        'rows_per_sec': rows / seconds if seconds else None,
+        'peak_memory_bytes': peak_memory,
+    }
+    return result, metrics
+
+
+def run_case(case, seed=0, trace_memory=True):
+    """
+    Runs every stage on a synthetic csv of the case.
+
+    Returns:
+        dict: stage name to its seconds, rows per second and peak memory bytes.
+    """
+    identifier = f'benchmark_{case.name}'
+    combined_module_name = f'{identifier}_combined'
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        csv_name = f'{identifier}.csv'
+        csv_path = os.path.join(work_dir, csv_name)
+        column_names = write_synthetic_csv(csv_path, case, seed=seed)
+        setup_path = _write_setup(work_dir, identifier, csv_name, column_names)
+        try:
+            with redirect_stdout(io.StringIO()):
+                mapper = Mapper(setup_path)
+                _, results['analyze'] = _measure(mapper.analyze, case.rows, trace_memory)
+                mapper.combine_results()
+
+            loader = BenchmarkLoader(setup_path)
+            results.update(_run_cleaning_stages(loader, 'csv', csv_path, trace_memory=trace_memory))
+        finally:
+            # The setup dir is added to the path to import the combined module.
+            sys.modules.pop(combined_module_name, None)
+            while work_dir in sys.path:
+                sys.path.remove(work_dir)
+    return results
+
+
+def _run_cleaning_stages(loader, content_type, path, trace_memory=True, chunk_size=LOADER_CHUNK_ROWS):
+    """
+    Runs the cleaner and then loads the rows with the insert path of the bulk loader into a NullSession.
+    The signature stage is the time spent in add_row_signature and the load stage is the rest of the insert path.
+    """
+    results = {}
+    rows, results['clean'] = _measure(
+        lambda: list(loader.clean(content_type, path=path)), None, trace_memory)
+
+    loader.reset_loader(loader._get_combined_module().FIELDS)
+    session = NullSession()
+
+    def load():
+        with loader.instrumentation.stage('load'):
+            for chunk in generator_chunker(iter(rows), chunk_size=chunk_size):
+                loader.insert_chunk_of_data_to_db(session, loader.RECORDS_MODEL, chunk)
+
+    _, load_metrics = _measure(load, len(rows), trace_memory)
+    for stage in ('signature', 'load'):
+        seconds = loader.instrumentation.metrics.get(stage, StageMetrics()).wall_seconds
+        results[stage] = {
+            'seconds': seconds,
+            'rows_per_sec': len(rows) / seconds if seconds else None,
+            'peak_memory_bytes': load_metrics['peak_memory_bytes'] if stage == 'load' else None,
+        }
+    return results
+
+
+def bench_model(setup_path, data_path=None, content_type=None, rows=10000, seed=0, trace_memory=False,
+                chunk_size=LOADER_CHUNK_ROWS, **synthetic_kwargs):
+    """
+    Benchmarks the cleaner, the row signatures and the bulk loader of a trained model on a data file.
+    If no data path is passed, synthetic data based on the fields of the model is used.
+
+    Returns:
+        dict: the metrics of each stage and the seconds spent on cleaning each field.
+    """
+    loader = BenchmarkLoader(setup_path)
+    loader.settings = loader.settings._replace(track_cleaning_field_costs=True)
+    with tempfile.TemporaryDirectory() as work_dir:
+        if data_path is None:
+            fields = loader._get_combined_module().FIELDS
+            data_path = os.path.join(work_dir, f'{loader.settings.identifier}_synthetic.csv')
+            write_synthetic_file(data_path, fields, rows, seed=seed, **synthetic_kwargs)
+            # The csv sniffer can not always tell that random data has a header.
+            loader.settings = loader.settings._replace(identify_header_by_column_names=set(fields.keys()))
+            source = f'{rows} synthetic rows'
+        else:
+            source = data_path
+        content_type = content_type or os.path.splitext(data_path)[1].lstrip('.').lower()
+        file_size = os.path.getsize(data_path)
+        stages = _run_cleaning_stages(loader, content_type, data_path, trace_memory=trace_memory,
+                                      chunk_size=chunk_size)
+    clean_seconds = stages['clean']['seconds']
+    field_costs = {}
+    for field_name, stats in loader._field_cost_registry.get_fields_by_cost():
+        field_costs[field_name] = dict(
+            stats, paths=dict(stats['paths']),
+            percent_of_clean=stats['seconds'] / clean_seconds * 100 if clean_seconds else None)
+    return {
+        'python': sys.version.split()[0],
+        'source': source,
+        'content_type': content_type,
+        'file_size_bytes': file_size,
+        'chunk_size': chunk_size,
+        'trace_memory': trace_memory,
+        'stages': stages,
+        'field_costs': field_costs,
+    }
+
+
+def get_bench_report_str(results):
+    stages = []
+    for stage, metrics in results['stages'].items():
+        peak_memory = metrics['peak_memory_bytes']
+        stages.append([
+            stage, f"{metrics['seconds']:.3f}", f"{metrics['rows_per_sec'] or 0:,.0f}",
+            '' if peak_memory is None else f'{peak_memory / 2 ** 20:,.1f}'])
+    fields = [[field_name, f"{cost['seconds']:.4f}", f"{cost['percent_of_clean'] or 0:.1f}%", cost['values']]
+              for field_name, cost in results['field_costs'].items()]
+    return '\n\n'.join([
+        f"{results['source']} ({results['file_size_bytes']:,} bytes)",
+        tabulate(stages, headers=['stage', 'seconds', 'rows/sec', 'peak MiB']),
+        tabulate(fields, headers=['field', 'clean seconds', '% of clean', 'values']),
+    ])
+
+
+def run_benchmarks(row_counts=(10000, ), column_counts=(10, ), type_mixes=('mixed', ), seed=0, trace_memory=True):
+    """
+    Runs the benchmark cases of every combination of the row counts, column counts and type mixes.
+    Peak memory is measured with tracemalloc which slows down the stages. Pass trace_memory=False for
+    more accurate timings.
+    """
+    cases = {}
+    for type_mix in type_mixes:
+        for columns in column_counts:
+            for rows in row_counts:
+                case = BenchmarkCase(rows=rows, columns=columns, type_mix=type_mix)
+                cases[case.name] = run_case(case, seed=seed, trace_memory=trace_memory)
+    return {
+        'python': sys.version.split()[0],
+        'trace_memory': trace_memory,
+        'cases': cases,
+    }
+
+
+def save_results(path, results):
+    with open(path, 'w') as the_file:
+        json.dump(results, the_file, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path, 'r') as the_file:
+        return json.load(the_file)
+
+
+def compare_to_baseline(results, baseline, threshold=0.1):
+    """
+    Compares the results of the cases and stages that are in both the results and the baseline.
+
+    Returns:
+        list: messages about the stages that are more than threshold slower or use more than
+        threshold more peak memory than the baseline.
+    """
+    regressions = []
+    for case_name, stages in results['cases'].items():
+        for stage, metrics in stages.items():
+            try:
+                baseline_metrics = baseline['cases'][case_name][stage]
+            except KeyError:
+                continue
+            speed, baseline_speed = metrics['rows_per_sec'], baseline_metrics['rows_per_sec']
+            if speed and baseline_speed and speed < baseline_speed * (1 - threshold):
+                regressions.append(f'{case_name} {stage}: {speed:,.0f} rows/sec vs {baseline_speed:,.0f} '
+                                   'rows/sec in the baseline')
+            memory, baseline_memory = metrics['peak_memory_bytes'], baseline_metrics['peak_memory_bytes']
+            if memory and baseline_memory and memory > baseline_memory * (1 + threshold):
+                regressions.append(f'{case_name} {stage}: {memory:,} bytes peak memory vs {baseline_memory:,} '
+                                   'bytes in the baseline')
+    return regressions
+
+
+def get_report_str(results):
+    table = []
+    for case_name, stages in results['cases'].items():
+        for stage, metrics in stages.items():
+            peak_memory = metrics['peak_memory_bytes']
+            table.append([
+                case_name, stage, f"{metrics['seconds']:.3f}", f"{metrics['rows_per_sec'] or 0:,.0f}",
+                '' if peak_memory is None else f'{peak_memory / 2 ** 20:,.1f}'])
+    return tabulate(table, headers=['case', 'stage', 'seconds', 'rows/sec', 'peak MiB'])
@@ -0,0 +1,103 @@
+"""
+A Bloom filter of the row signatures. It answers whether a signature is definitely new or probably exists,
+so only the probable hits need to be looked up in the database.
+"""
+import os
+import math
+import struct
+import tempfile
+
+import mmh3
+
+HEADER_FORMAT = '<4sQdQB'
+HEADER_MAGIC = b'MMBF'
+
+
+def _to_bytes(signature):
+    if isinstance(signature, bytes):
+        return signature
+    return str(signature).encode('utf-8')
+
+
+class BloomFilter:
+    """
+    Sized for the capacity with the error_rate as the false positive rate. Adding more signatures than the
+    capacity still works but the false positive rate goes up. There are no false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        if capacity <= 0:
+            raise ValueError('The capacity of the Bloom filter needs to be bigger than 0.')
+        if not 0 < error_rate < 1:
+            raise ValueError('The error_rate of the Bloom filter needs to be between 0 and 1.')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _get_positions(self, signature):
+        # Double hashing: the positions are h1 + i * h2 for each of the hashes.
+        h1, h2 = mmh3.hash64(_to_bytes(signature), signed=False)
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+    def add(self, signature):
+        """
+        Adds the signature. The count only goes up if a bit was set, so adding a signature
+        that is already in the filter does not make it look fuller.
+        """
+        bits = self._bits
+        is_new = False
+        for position in self._get_positions(signature):
+            index, mask = position >> 3, 1 << (position & 7)
+            if not bits[index] & mask:
+                bits[index] |= mask
+                is_new = True
+        if is_new:
+            self.count += 1
+
+    def update(self, signatures):
+        for signature in signatures:
+            self.add(signature)
+
+    def __contains__(self, signature):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._get_positions(signature))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def is_full(self):
+        return self.count > self.capacity
+
+    def save(self, path):
+        """
+        Writes the filter into the file. The file is replaced at once so it is never read half written.
+        """
+        dir_name = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('wb', dir=dir_name, suffix='.tmp', delete=False) as the_file:
+            the_file.write(struct.pack(HEADER_FORMAT, HEADER_MAGIC, self.capacity, self.error_rate,
+                                       self.count, self.num_hashes))
+            the_file.write(self._bits)
+        os.replace(the_file.name, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as the_file:
+            header = the_file.read(struct.calcsize(HEADER_FORMAT))
+            try:
+                magic, capacity, error_rate, count, num_hashes = struct.unpack(HEADER_FORMAT, header)
+            except struct.error:
+                magic = None
+            if magic != HEADER_MAGIC:
+                raise ValueError(f'{path} is not a Bloom filter file.')
+            bloom_filter = cls(capacity, error_rate=error_rate)
+            bits = the_file.read()
+        if len(bits) != len(bloom_filter._bits) or num_hashes != bloom_filter.num_hashes:
+            raise ValueError(f'The Bloom filter file of {path} is corrupted.')
+        bloom_filter._bits = bytearray(bits)
+        bloom_filter.count = count
+        return bloom_filter
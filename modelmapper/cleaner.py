@@ -4,7 +4,8 @@ Functionality for cleaning the data for importing into tables that mapper has cr
 import io
 import datetime
 import textwrap
-from collections import defaultdict
+from time import perf_counter
+from collections import defaultdict, Counter
 from itertools import chain
 from functools import partial
 from decimal import Decimal
@@ -12,6 +13,7 @@ from string import digits
 from tabulate import tabulate
 from xlrd import xldate_as_datetime
 from modelmapper.base import Base
+from modelmapper.memory import get_memory_profiler, profile_stage
 from modelmapper.misc import add_strings_and_integers_to_set, decode_bytes
 from modelmapper.normalization import normalize_numberic_values
 from modelmapper.mapper import ONE_HUNDRED, SqlalchemyFieldType, INTEGER_SQLALCHEMY_TYPES
@@ -132,6 +134,72 @@ class ErrorRegistry:
                         result[key] = item[:self.MAX_MSG_CHARS]
         return result
 
+    def get_count_per_field(self):
+        return {field_name: sum(i['count'] for i in errors.values()) for field_name, errors in self._stats.items()}
+
+    def __bool__(self):
+        return bool(self._stats)
+
+
+class FieldCostRegistry:
+    """
+    Keeps the cost of cleaning each field: the seconds, the number of values per path,
+    and the casting errors that got the default value or were raised.
+    """
+
+    MAX_ROWS_IN_DICT_REPORT = 3
+
+    def __init__(self):
+        self._stats = defaultdict(lambda: {'seconds': 0.0, 'values': 0, 'paths': Counter(), 'defaults': 0,
+                                           'exceptions': 0})
+
+    def add_field(self, field_name, seconds, path, values=0, nulls=0, defaults=0, exceptions=0):
+        stats = self._stats[field_name]
+        stats['seconds'] += seconds
+        stats['values'] += values
+        stats['paths']['null'] += nulls
+        stats['paths'][path] += values - nulls
+        stats['defaults'] += defaults
+        stats['exceptions'] += exceptions
+
+    def get_fields_by_cost(self):
+        return sorted(self._stats.items(), key=lambda x: x[1]['seconds'], reverse=True)
+
+    def get_report_str(self):
+        result = {'field_name': [], 'seconds': [], 'values': [], 'paths': [], 'defaults': [], 'exceptions': []}
+        for field_name, stats in self.get_fields_by_cost():
+            result['field_name'].append(field_name)
+            result['seconds'].append(f"{stats['seconds']:.4f}")
+            result['paths'].append(', '.join(f'{path}: {count}' for path, count in stats['paths'].items() if count))
+            for key in ('values', 'defaults', 'exceptions'):
+                result[key].append(stats[key])
+        return tabulate(result, headers='keys')
+
+    def get_report_dict(self):
+        """
+        The same format as the ErrorRegistry's dict report for the most expensive fields to be used in logs.
+
+        The format is:
+        result = {
+            'field_name1': None, 'seconds1': None, 'values1': None, 'null1': None, 'decimal1': None, ...
+            'field_name2': None, 'seconds2': None, 'values2': None, 'null2': None, 'string2': None, ...
+        }
+        """
+        result = {}
+        for n, (field_name, stats) in enumerate(self.get_fields_by_cost()[:self.MAX_ROWS_IN_DICT_REPORT], 1):
+            result[f'field_name{n}'] = field_name
+            result[f'seconds{n}'] = round(stats['seconds'], 6)
+            result[f'values{n}'] = stats['values']
+            for path, count in stats['paths'].items():
+                if count:
+                    result[f'{path}{n}'] = count
+            for key in ('defaults', 'exceptions'):
+                result[f'{key}{n}'] = stats[key]
+        return result
+
+    def to_dict(self):
+        return {field_name: dict(stats, paths=dict(stats['paths'])) for field_name, stats in self._stats.items()}
+
     def __bool__(self):
         return bool(self._stats)
 
@@ -146,8 +214,10 @@ class Cleaner(Base):
         self.reset()
 
         super().__init__(*args, **kwargs)
+        self.memory_profiler = get_memory_profiler(self.settings)
 
-    def get_csv_data_cleaned(self, path_or_content, original_content_type=None, ignore_missing_fields=True):
+    def get_csv_data_cleaned(self, path_or_content, original_content_type=None, ignore_missing_fields=True,
+                             line_filter=None):
         """
         Gets csv data cleaned. Use it only if you know you have a CSV path or stringIO with CSV content.
         Otherwise use the clean method in this class.
@@ -155,19 +225,32 @@ class Cleaner(Base):
         combined_module = self._get_combined_module()
         model_info = combined_module.FIELDS
 
-        all_items = self._get_all_values_per_clean_name(path_or_content)
-        for field_name, field_values in all_items.items():
-            try:
-                field_info = model_info[field_name]
-            except KeyError:
-                if ignore_missing_fields:
-                    self._missing_fields.add(field_name)
-                    continue
-                else:
-                    raise KeyError(FIELD_NAME_NOT_FOUND_MSG.format(field_name))
-            self._get_field_values_cleaned_for_importing(
-                field_name, field_info, field_values, original_content_type
-            )
+        profiler = self.memory_profiler
+        if profiler:
+            profiler.start()
+        try:
+            with profile_stage(profiler, 'transpose'):
+                all_items = self._get_all_values_per_clean_name(path_or_content, line_filter=line_filter)
+            with profile_stage(profiler, 'clean'):
+                for field_name, field_values in all_items.items():
+                    try:
+                        field_info = model_info[field_name]
+                    except KeyError:
+                        if ignore_missing_fields:
+                            self._missing_fields.add(field_name)
+                            continue
+                        else:
+                            raise KeyError(FIELD_NAME_NOT_FOUND_MSG.format(field_name))
+                    self._get_field_values_cleaned_for_importing(
+                        field_name, field_info, field_values, original_content_type
+                    )
+        finally:
+            if profiler:
+                profiler.stop()
+        if profiler:
+            self.logger.info(f'The memory used by cleaning {self.settings.combined_file_name[:-3]} ({profiler.mode}).\n'
+                             f'{profiler.get_report_str()}')
+
         if self._missing_fields:
             for field in self._missing_fields:
                 try:
@@ -192,6 +275,11 @@ class Cleaner(Base):
             self.logger.error(slack_msg, extra=self._error_registry.get_report_dict())
             self.publicized_errs = True
 
+        if self._field_cost_registry:
+            self.logger.info(f'The cost of cleaning the fields in {self.settings.combined_file_name[:-3]}.\n'
+                             f'{self._field_cost_registry.get_report_str()}',
+                             extra=self._field_cost_registry.get_report_dict())
+
         all_lines_cleaned = zip(*all_items.values())
 
         for i in all_lines_cleaned:
@@ -213,6 +301,9 @@ class Cleaner(Base):
             ValueError, TypeError - Indicates something is wrong with the incoming data, refer to error message.
         """
 
+        track_costs = self.settings.track_cleaning_field_costs
+        if track_costs:
+            start = perf_counter()
         is_nullable = field_info.get('is_nullable', False)
         is_decimal = field_info['field_db_sqlalchemy_type'] == SqlalchemyFieldType.Decimal
         is_dollar = field_info.get('is_dollar', False)
@@ -235,6 +326,7 @@ class Cleaner(Base):
             default_if_err = None
 
         datetime_allowed_characters = add_strings_and_integers_to_set(self.settings.datetime_allowed_characters)
+        defaults_count = 0
 
         def _mark_nulls(item):
             return None if item in self.settings.null_values else item
@@ -310,7 +402,12 @@ class Cleaner(Base):
                 if has_default_if_err:
                     field_values[i] = default_if_err
                     self._error_registry.add_err(msg=str(e), field_name=field_name, item=item)
+                    defaults_count += 1
                 else:
+                    if track_costs:
+                        self._field_cost_registry.add_field(
+                            field_name, perf_counter() - start, path=self._get_cleaning_path(field_info),
+                            values=i, defaults=defaults_count, exceptions=1)
                     raise
             else:
                 field_values[i] = item
@@ -329,15 +426,33 @@ class Cleaner(Base):
 
         self._error_registry.total_item_count_per_field = len(field_values)
 
+        if track_costs:
+            self._field_cost_registry.add_field(
+                field_name, perf_counter() - start, path=self._get_cleaning_path(field_info),
+                values=len(field_values), nulls=field_values.count(None), defaults=defaults_count)
+
         return field_values
 
+    @staticmethod
+    def _get_cleaning_path(field_info):
+        _type = field_info['field_db_sqlalchemy_type']
+        if _type == SqlalchemyFieldType.Boolean:
+            return 'boolean'
+        if _type == SqlalchemyFieldType.DateTime:
+            return 'datetime'
+        if _type == SqlalchemyFieldType.String:
+            return 'string'
+        return 'decimal'
+
     def reset(self):
         # default dict with default value of another default dict that has the default of a set
         self._error_registry = ErrorRegistry()
+        self._field_cost_registry = FieldCostRegistry()
         self._publicized_missing_fields = self.publicized_errs = False
         self._missing_fields = set()
 
-    def clean(self, content_type, path=None, content=None, sheet_names=None, ignore_missing_fields=True):
+    def clean(self, content_type, path=None, content=None, sheet_names=None, ignore_missing_fields=True,
+              line_filter=None):
         """
         Clean the data for importing into database.
         content_type: Options: csv, xls, xls_xml, xlsx
@@ -346,19 +461,21 @@ class Cleaner(Base):
         sheet_names: (optional) The sheet names from the Excel file to be considered.
                                 If none provided, all sheets will be considered.
         ignore_missing_fields: (optional) If true: fields not found in the model will be ignored
+        line_filter: (optional) A function that gets the clean field names and the raw lines of each csv or sheet
+                     and yields the lines to be cleaned. The other lines are skipped before they are cleaned.
         """
         def _excel_contents_cleaned(content, func, sheet_names):
             results = func(content, sheet_names=sheet_names)
             csvs_chained = results.values()
             csvs_cleaned = map(
                 lambda x: self.get_csv_data_cleaned(
-                    x, content_type, ignore_missing_fields=ignore_missing_fields
+                    x, content_type, ignore_missing_fields=ignore_missing_fields, line_filter=line_filter
                 ), csvs_chained
             )
             return chain.from_iterable(csvs_cleaned)
 
         get_csv_data_cleaned = partial(
-            self.get_csv_data_cleaned, ignore_missing_fields=ignore_missing_fields
+            self.get_csv_data_cleaned, ignore_missing_fields=ignore_missing_fields, line_filter=line_filter
         )
         xls_contents_cleaned = partial(_excel_contents_cleaned, func=_xls_contents_to_csvs,
                                        sheet_names=sheet_names)
@@ -417,9 +534,16 @@ class Cleaner(Base):
             funcs = content_type_solution[key]
         except KeyError as e:
             raise ValueError('Unrecognized content. It has to be either bytes, string, BytesIO or StringIO')
+        if self.memory_profiler:
+            self.memory_profiler.start()
         try:
-            for function in funcs:
-                value = function(value)
+            # The csv contents are only decoded here. The Excel contents are also converted to csvs.
+            with profile_stage(self.memory_profiler, 'decode'):
+                for function in funcs:
+                    value = function(value)
         except Exception as e:
             raise ParsingError(f'Error parsing for content type of {content_type}: {e}')
+        finally:
+            if self.memory_profiler:
+                self.memory_profiler.stop()
         return value
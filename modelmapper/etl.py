@@ -7,8 +7,11 @@ import json
 
 from modelmapper.base import Base
 from modelmapper.cleaner import Cleaner, CastingError
+from modelmapper.instrumentation import EtlInstrumentation, StageMetrics
+from modelmapper.memory import get_memory_profiler, profile_stage
+from modelmapper.tracing import trace_span, trace_iterate
 from modelmapper.misc import generator_chunker, generator_updater
-from modelmapper.signature import get_hash_of_bytes
+from modelmapper.signature import get_hash_of_bytes, BoundedSignatureSet
 from modelmapper.exceptions import NothingToProcess, FileAlreadyProcessed
 from sqlalchemy import exc as core_exc
 
@@ -16,22 +19,41 @@ from sqlalchemy import exc as core_exc
 class ETL(Base):
     """
     Subclass this for your data processing and define the BUCKET_NAME, RAW_KEY_MODEL and RECORDS_MODEL.
+    Optionally define the RUN_STATS_MODEL to keep the stats of each run. See _get_run_stats for its columns.
+
+    The time, bytes and rows of each stage of the last run are in stage_metrics. Pass an EtlInstrumentation
+    with sinks as the instrumentation kwarg to get the metrics as they are recorded. The memory used by each
+    stage is in memory_profiler when the memory_profiling setting is set.
+
+    Pass an EtlMetrics as the metrics kwarg to export the rows, bytes, casting errors and stage latencies.
+    They are written to METRICS_FILE_PATH after each run if it is set. Pass a Tracer as the tracer kwarg
+    to trace each run with nested spans.
     """
 
     RAW_KEY_MODEL = None
     RECORDS_MODEL = None
+    RUN_STATS_MODEL = None
     BACKUP_KEY_DATETIME_FORMAT = '%Y/%m/%Y_%m_%d__%H_%M_%S.gzip'
     SQL_CHUNK_ROWS = 300
     SIGNATURE_BITS = 128
+    METRICS_FILE_PATH = None
     logger = logging.getLogger(__name__)
 
     def __init__(self, *args, **kwargs):
         self.JOB_NAME = self.__class__.__name__
         self.DUMP_FILEPATH = f'/tmp/{self.JOB_NAME}_dump'
+        self.instrumentation = kwargs.pop('instrumentation', None) or EtlInstrumentation()
+        self.metrics = kwargs.pop('metrics', None)
+        self.tracer = kwargs.pop('tracer', None)
+        if self.metrics:
+            self.instrumentation.sinks.append(self.metrics.get_stage_sink(self.JOB_NAME))
         super().__init__(*args, **kwargs)
         kwargs['setup_path'] = self.setup_path
         self.cleaner = Cleaner(*args, **kwargs)
+        self.memory_profiler = self.cleaner.memory_profiler = get_memory_profiler(self.settings)
         self.backup_key_name = None
+        self.raw_key_id = None
+        self.line_filter = None
 
     def get_client_data(self):
         """
@@ -71,13 +93,16 @@ class ETL(Base):
     def _backup_data_and_get_raw_key(self, session, data_raw_bytes, signature):
         key = datetime.datetime.strftime(datetime.datetime.utcnow(), self.BACKUP_KEY_DATETIME_FORMAT)
         raw_key_id = self._create_raw_key(session, key, signature)
-        data_compressed = self._compress(data_raw_bytes)
+        with self.instrumentation.stage('compress', bytes=len(data_raw_bytes)):
+            data_compressed = self._compress(data_raw_bytes)
         if self.settings.encrypt_raw_data_during_backup:
-            data_compressed = self.encrypt_raw_data(data_compressed)
+            with self.instrumentation.stage('encrypt', bytes=len(data_compressed)):
+                data_compressed = self.encrypt_raw_data(data_compressed)
         self.logger.info(f'Backing up the data: {key}')
         self.backup_key_name = key
         metadata = {'compression': 'gzip'}
-        self.backup_data(content=data_compressed, key=key, metadata=metadata)
+        with self.instrumentation.stage('backup_upload', bytes=len(data_compressed)):
+            self.backup_data(content=data_compressed, key=key, metadata=metadata)
         return raw_key_id
 
     def _dump_state_after_client_response(self, data):
@@ -158,29 +183,40 @@ class ETL(Base):
 
         self.logger.info(f'Starting the {self.JOB_NAME} ...')
 
-        if use_client:
-            content = self.get_client_data()
+        with self.instrumentation.stage('download') as download_metrics, \
+                trace_span(self.tracer if use_client else None, 'get_client_data') as span:
+            if use_client:
+                with profile_stage(self.memory_profiler, 'client_fetch'):
+                    content = self.get_client_data()
 
-        # get_client_data may have returned a key for the raw_key value
-        if isinstance(content, tuple):
-            content, key = content
-        else:
-            key = path if path else f'content.{content_type}'
-
-        if isinstance(content, types.GeneratorType):
-            content = '\n'.join(content)
-        if isinstance(content, str):
-            data_raw_bytes = content.encode('utf-8')
-        elif isinstance(content, bytes):
-            data_raw_bytes = content
-        else:
-            raise TypeError('Unexpected type of content is received. '
-                            'Please make sure the content is either string, bytes or generator.')
-        signature = get_hash_of_bytes(data_raw_bytes, bits=self.SIGNATURE_BITS)
+            # get_client_data may have returned a key for the raw_key value
+            if isinstance(content, tuple):
+                content, key = content
+            else:
+                key = path if path else f'content.{content_type}'
+
+            if isinstance(content, types.GeneratorType):
+                content = '\n'.join(content)
+            if isinstance(content, str):
+                data_raw_bytes = content.encode('utf-8')
+            elif isinstance(content, bytes):
+                data_raw_bytes = content
+            else:
+                raise TypeError('Unexpected type of content is received. '
+                                'Please make sure the content is either string, bytes or generator.')
+            download_metrics.bytes = len(data_raw_bytes)
+            if span:
+                span.set_attributes(key=key, bytes=len(data_raw_bytes))
+        with self.instrumentation.stage('hash', bytes=len(data_raw_bytes)):
+            signature = get_hash_of_bytes(data_raw_bytes, bits=self.SIGNATURE_BITS)
         if backup_data:
             try:
-                raw_key_id = self._backup_data_and_get_raw_key(
-                    session, data_raw_bytes=data_raw_bytes, signature=signature)
+                with profile_stage(self.memory_profiler, 'backup'), \
+                        trace_span(self.tracer, 'backup_data_and_get_raw_key', bytes=len(data_raw_bytes)) as span:
+                    raw_key_id = self._backup_data_and_get_raw_key(
+                        session, data_raw_bytes=data_raw_bytes, signature=signature)
+                    if span:
+                        span.set_attributes(key=self.backup_key_name, raw_key_id=raw_key_id)
             except FileAlreadyProcessed:
                 if hasattr(self, 'post_pickup_cleanup'):
                     self.post_pickup_cleanup()
@@ -192,7 +228,8 @@ class ETL(Base):
             raw_key_id = self._create_raw_key(session, key=key, signature=signature)
 
         if self.settings.decrypt_raw_data:
-            content = self.decrypt_raw_data(content)
+            with self.instrumentation.stage('decrypt', bytes=len(content)):
+                content = self.decrypt_raw_data(content)
 
         data = {"content": content, "raw_key_id": raw_key_id, "content_type": content_type,
                 "path": path, "sheet_names": sheet_names}
@@ -202,6 +239,21 @@ class ETL(Base):
 
         return data
 
+    def get_line_filter(self, session):
+        """
+        Returns a function that gets the clean field names and the raw lines and yields the lines to be cleaned,
+        or None to clean all the lines. If it has a rows_skipped attribute, the skipped rows are counted as
+        existing rows. If it has an update_rows method, the cleaned rows go through it.
+        The signature loaders return it for the raw_line signature_strategy.
+        """
+        return None
+
+    def post_commit(self, session):
+        """
+        Called after the rows of a run are committed.
+        """
+        pass
+
     def transform(self, session=None, data_gen=None):
         """
         The function to add your additional transform functionality
@@ -215,9 +267,23 @@ class ETL(Base):
         pass
 
     def _transform(self, session, data):
-        self.transform_raw_content(data)
-        data_gen = self.cleaner.clean(content_type=data['content_type'], path=data['path'],
-                                      content=data['content'], sheet_names=data['sheet_names'])
+        self.raw_key_id = data['raw_key_id']
+        # Each stage is recorded once when its rows are all read, including the work done before that.
+        transform_metrics = StageMetrics()
+        with self.instrumentation.measure(transform_metrics):
+            self.transform_raw_content(data)
+        content_bytes = len(data['content']) if isinstance(data['content'], (str, bytes)) else 0
+        self.line_filter = line_filter = self.get_line_filter(session)
+        # The rows are cleaned lazily while they are being loaded.
+        clean_metrics = StageMetrics(bytes=content_bytes)
+        with self.instrumentation.measure(clean_metrics):
+            data_gen = self.cleaner.clean(content_type=data['content_type'], path=data['path'],
+                                          content=data['content'], sheet_names=data['sheet_names'],
+                                          line_filter=line_filter)
+        data_gen = self.instrumentation.iterate('clean', data_gen, metrics=clean_metrics)
+        if hasattr(line_filter, 'update_rows'):
+            data_gen = line_filter.update_rows(data_gen)
+        data_gen = trace_iterate(self.tracer, 'clean', data_gen, content_type=data['content_type'], bytes=content_bytes)
 
         if self.settings.fields_to_be_encrypted:
             data_gen = self.encrypt_row_fields(data_gen)
@@ -226,7 +292,7 @@ class ETL(Base):
         data_gen = generator_updater(data_gen, **row_metadata)
         data_gen = self.transform(session, data_gen)
 
-        return data_gen
+        return self.instrumentation.iterate('transform', data_gen, metrics=transform_metrics)
 
     def _load(self, session, data_gen):
         self.logger.info(f"{self.JOB_NAME}: Inserting data into db")
@@ -234,15 +300,20 @@ class ETL(Base):
 
         row_count = existing_row_count = 0
 
-        self.all_recent_rows_signatures = set()
+        self.all_recent_rows_signatures = BoundedSignatureSet(self.settings.signature_dedup_max_bytes)
         chunks = generator_chunker(data_gen, chunk_size=self.SQL_CHUNK_ROWS)
         if chunks is None:
             self.logger.error("No data was provided by generator for table: {}".format(table))
             return
         try:
             for chunk in chunks:
-                chunk_rows_inserted, chunk_rows_already_existing = self.insert_chunk_of_data_to_db(
-                    session, self.RECORDS_MODEL, chunk)
+                with self.instrumentation.stage('insert', rows=len(chunk)), \
+                        profile_stage(self.memory_profiler, 'insert'), \
+                        trace_span(self.tracer, 'insert_chunk_of_data_to_db', rows=len(chunk)) as span:
+                    chunk_rows_inserted, chunk_rows_already_existing = self.insert_chunk_of_data_to_db(
+                        session, self.RECORDS_MODEL, chunk)
+                    if span:
+                        span.set_attributes(inserted=chunk_rows_inserted, existing=chunk_rows_already_existing)
                 if chunk_rows_inserted:
                     row_count += chunk_rows_inserted
                     self.logger.debug(f'{self.JOB_NAME}: Put {row_count} rows in the {table}.')
@@ -259,6 +330,10 @@ class ETL(Base):
             self.logger.error(f'Error when inserting row into {table}: {e}')
             raise
         else:
+            rows_skipped = getattr(self.line_filter, 'rows_skipped', 0)
+            if rows_skipped:
+                existing_row_count += rows_skipped
+                self.logger.info(f'{self.JOB_NAME}: Skipped {rows_skipped} existing rows before cleaning them.')
             if row_count:
                 msg = (f'{self.JOB_NAME}: Finished putting {row_count} rows in the database.'
                        f'And there were {existing_row_count} existing rows that were not re-inserted.')
@@ -266,7 +341,87 @@ class ETL(Base):
                 msg = (f'{self.JOB_NAME}: Non New Records are added but a snapshot is added.'
                        f'And there were {existing_row_count} existing rows that were not re-inserted.')
             self.logger.info(msg)
+            with self.instrumentation.stage('commit'), \
+                    trace_span(self.tracer, 'commit', inserted=row_count, existing=existing_row_count):
+                session.commit()
+            self.post_commit(session)
+            if self.metrics:
+                self.metrics.record_load(self.JOB_NAME, row_count, existing_row_count)
+            if self.RUN_STATS_MODEL is not None:
+                self._write_run_stats(session, row_count, existing_row_count)
+            self.logger.info(f'{self.JOB_NAME}: Stage metrics:\n{self.instrumentation.get_report_str()}')
+
+    def _get_run_stats(self, rows_inserted, rows_existing):
+        """
+        The stats of the run for the RUN_STATS_MODEL. Only the keys that are columns of the model are written.
+        stage_seconds is a dictionary of the stage names to their seconds to be put in a JSON column.
+        """
+        metrics = self.instrumentation.to_dict()
+
+        def get(stage, key):
+            return metrics.get(stage, {}).get(key, 0)
+
+        stage_seconds = {stage: i['wall_seconds'] for stage, i in metrics.items()}
+        return {
+            'raw_key_id': self.raw_key_id,
+            'job_name': self.JOB_NAME,
+            'rows_read': get('clean', 'rows') + getattr(self.line_filter, 'rows_skipped', 0),
+            'rows_inserted': rows_inserted,
+            'rows_existing': rows_existing,
+            'rows_errored': sum(self.cleaner._error_registry.get_count_per_field().values()),
+            'bytes_in': get('download', 'bytes') or get('clean', 'bytes'),
+            'bytes_out': get('backup_upload', 'bytes'),
+            'seconds': sum(stage_seconds.values()),
+            'stage_seconds': stage_seconds,
+        }
+
+    def _write_run_stats(self, session, rows_inserted, rows_existing):
+        """
+        Writes the run stats after the data is committed, so failing to write them does not fail the run.
+        """
+        table = self.RUN_STATS_MODEL.__table__
+        column_names = {column.name for column in table.columns}
+        run_stats = self._get_run_stats(rows_inserted, rows_existing)
+        try:
+            session.execute(table.insert().values(**{k: v for k, v in run_stats.items() if k in column_names}))
             session.commit()
+        except Exception as e:
+            session.rollback()
+            self.report_exception(e, extra={
+                'msg': 'Failed to write the run stats',
+                'backup_key_name': self.backup_key_name})
+
+    @property
+    def stage_metrics(self):
+        """
+        The wall time, CPU time, bytes and rows of each stage of the last run.
+        """
+        return self.instrumentation.to_dict()
+
+    def _start_memory_profiling(self):
+        if self.memory_profiler:
+            self.memory_profiler.reset()
+            self.memory_profiler.start()
+
+    def _stop_memory_profiling(self):
+        if self.memory_profiler:
+            self.memory_profiler.stop()
+            self.logger.info(f'{self.JOB_NAME}: Memory used by stage ({self.memory_profiler.mode}):\n'
+                             f'{self.memory_profiler.get_report_str()}')
+
+    def _record_run_metrics(self, result, casting_error=None):
+        if not self.metrics:
+            return
+        casting_errors = self.cleaner._error_registry.get_count_per_field()
+        if casting_error:
+            casting_errors[casting_error.field_name] = casting_errors.get(casting_error.field_name, 0) + 1
+        self.metrics.record_casting_errors(self.JOB_NAME, casting_errors)
+        self.metrics.record_run(self.JOB_NAME, result)
+        if self.METRICS_FILE_PATH:
+            try:
+                self.metrics.write_text_file(self.METRICS_FILE_PATH)
+            except OSError as e:
+                self.logger.error(f'{self.JOB_NAME}: Failed to write the metrics to {self.METRICS_FILE_PATH}: {e}')
 
     def _handle_generic_exception(self, e, ping_slack):
         self.report_exception(e, extra={'backup_key_name': self.backup_key_name})
@@ -286,20 +441,30 @@ class ETL(Base):
             ignore_missing_fields (bool): drop columns that are not defined in the provided model mapping
                                       instead of raising an error.
         """
+        self.instrumentation.reset()
+        self.cleaner.reset()
+        self._start_memory_profiling()
+        result, casting_error = 'success', None
         try:
-            with self.get_session() as session:
+            with trace_span(self.tracer, 'run', job=self.JOB_NAME), self.get_session() as session:
                 data = self._extract(session, path=path, content=content, content_type=content_type,
                                      sheet_names=sheet_names, use_client=use_client, backup_data=backup_data)
                 data_gen = self._transform(session, data)
                 self._load(session, data_gen)
         except CastingError as e:
+            result, casting_error = 'casting_error', e
             self._handle_generic_exception(e, ping_slack)
             self.logger.exception(*e.get_logger_args(), extra=e.get_extra())
         except NothingToProcess:
+            result = 'nothing_to_process'
             self.logger.info('There is nothing new to process.')
         except Exception as e:
+            result = 'error'
             self._handle_generic_exception(e, ping_slack)
             self.logger.exception(str(e))
+        finally:
+            self._stop_memory_profiling()
+            self._record_run_metrics(result, casting_error)
 
     def reload(self):
         """
@@ -307,12 +472,21 @@ class ETL(Base):
         Meant for local usage only.
         """
         data = self._load_state_after_client_response()
+        self.instrumentation.reset()
+        self.cleaner.reset()
+        self._start_memory_profiling()
+        result, casting_error = 'success', None
         try:
-            with self.get_session() as session:
+            with trace_span(self.tracer, 'reload', job=self.JOB_NAME), self.get_session() as session:
                 data_gen = self._transform(session, data)
                 self._load(session, data_gen)
         except CastingError as e:
+            result, casting_error = 'casting_error', e
             self._handle_generic_exception(e, ping_slack=False)
             self.logger.exception(*e.get_logger_args(), extra=e.get_extra())
         except Exception as e:
+            result = 'error'
             self._handle_generic_exception(e, ping_slack=False)
+        finally:
+            self._stop_memory_profiling()
+            self._record_run_metrics(result, casting_error)
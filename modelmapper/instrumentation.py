@@ -0,0 +1,149 @@
+"""
+Per stage instrumentation of the ETL. Each stage records its wall time, CPU time, bytes and rows.
+
+The time of a stage is exclusive of any other stage that runs inside it. The cleaned rows are lazily
+generated while they are inserted, so the time spent generating them is attributed to the clean stage
+and not to the insert stage that pulls them.
+"""
+from contextlib import contextmanager
+from time import perf_counter, process_time
+
+from tabulate import tabulate
+
+
+class StageMetrics:
+
+    __slots__ = ('wall_seconds', 'cpu_seconds', 'bytes', 'rows')
+
+    def __init__(self, wall_seconds=0.0, cpu_seconds=0.0, bytes=0, rows=0):
+        self.wall_seconds = wall_seconds
+        self.cpu_seconds = cpu_seconds
+        self.bytes = bytes
+        self.rows = rows
+
+    def add(self, other):
+        self.wall_seconds += other.wall_seconds
+        self.cpu_seconds += other.cpu_seconds
+        self.bytes += other.bytes
+        self.rows += other.rows
+
+    def to_dict(self):
+        return {
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'bytes': self.bytes,
+            'rows': self.rows,
+            'bytes_per_sec': self.bytes / self.wall_seconds if self.wall_seconds else None,
+            'rows_per_sec': self.rows / self.wall_seconds if self.wall_seconds else None,
+        }
+
+    def __repr__(self):
+        return f'<StageMetrics {self.to_dict()}>'
+
+
+class _Frame:
+
+    __slots__ = ('metrics', 'wall_start', 'cpu_start')
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.restart()
+
+    def restart(self):
+        self.wall_start = perf_counter()
+        self.cpu_start = process_time()
+
+    def charge(self):
+        self.metrics.wall_seconds += perf_counter() - self.wall_start
+        self.metrics.cpu_seconds += process_time() - self.cpu_start
+
+
+class EtlInstrumentation:
+    """
+    Collects the metrics of the ETL stages: download, decrypt, hash, compress, encrypt, backup_upload,
+    clean, transform, signature, insert and commit.
+
+    Pass sinks to get the metrics as they are recorded. A sink is any object with a
+    record(stage, metrics) method. A stage that wraps an iterable is recorded once when the iteration ends.
+    """
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self.reset()
+
+    def reset(self):
+        self.metrics = {}
+        self._stack = []
+
+    def _enter(self, metrics):
+        if self._stack:
+            self._stack[-1].charge()
+        self._stack.append(_Frame(metrics))
+
+    def _exit(self):
+        self._stack.pop().charge()
+        if self._stack:
+            self._stack[-1].restart()
+
+    def _record(self, stage, metrics):
+        self.metrics.setdefault(stage, StageMetrics()).add(metrics)
+        for sink in self.sinks:
+            sink.record(stage, metrics)
+
+    @contextmanager
+    def stage(self, stage, bytes=0, rows=0):
+        """
+        Measures the block as the stage. The yielded metrics can be updated inside the block,
+        for example once the number of bytes is known.
+        """
+        metrics = StageMetrics(bytes=bytes, rows=rows)
+        try:
+            with self.measure(metrics):
+                yield metrics
+        finally:
+            self._record(stage, metrics)
+
+    @contextmanager
+    def measure(self, metrics):
+        """
+        Adds the time of the block to the metrics without recording them. Pass the metrics to iterate
+        to record the work done before the iteration, such as creating the iterable, as the same stage.
+        """
+        self._enter(metrics)
+        try:
+            yield metrics
+        finally:
+            self._exit()
+
+    def iterate(self, stage, iterable, metrics=None):
+        """
+        Wraps the iterable so the time to get each item is measured as the stage and each item is a row.
+        The stage is recorded once with the metrics, if any are passed, when the iteration ends.
+        """
+        if metrics is None:
+            metrics = StageMetrics()
+        iterator = iter(iterable)
+        try:
+            while True:
+                self._enter(metrics)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self._exit()
+                metrics.rows += 1
+                yield item
+        finally:
+            self._record(stage, metrics)
+
+    def to_dict(self):
+        return {stage: metrics.to_dict() for stage, metrics in self.metrics.items()}
+
+    def get_report_str(self):
+        table = []
+        for stage, metrics in self.metrics.items():
+            row = metrics.to_dict()
+            table.append([stage, f"{row['wall_seconds']:.3f}", f"{row['cpu_seconds']:.3f}",
+                          f"{row['bytes']:,}", f"{row['rows']:,}", f"{row['rows_per_sec'] or 0:,.0f}"])
+        return tabulate(table, headers=['stage', 'wall seconds', 'cpu seconds', 'bytes', 'rows', 'rows/sec'])
@@ -1,9 +1,15 @@
+import os
 import uuid
-from modelmapper.signature import generate_row_signature
+from collections import deque
+from modelmapper.bloom import BloomFilter
+from modelmapper.pgcopy import CopyTextBuffer, COPY_BUFFER_SIZE
+from modelmapper.signature import SignaturePlan, BoundedSignatureSet
+from modelmapper.misc import cached_property, generator_chunker
 try:
     from sqlalchemy.dialects.postgresql import insert
     from sqlalchemy.exc import IntegrityError
-    from sqlalchemy.sql import select
+    from sqlalchemy.sql import select, func, text
+    from sqlalchemy import Column, MetaData, Table, UniqueConstraint
 except ImportError:
     def insert(table):
         raise ImportError('Please install SQLAlchemy')
@@ -11,6 +17,143 @@ except ImportError:
     def select(fields):
         raise ImportError('Please install SQLAlchemy')
 
+SIGNATURE_STRATEGIES = ('cleaned', 'raw_line')
+
+
+def _instrumented(loader, stage, rows):
+    """
+    Measures the rows as the stage when the loader is a part of an ETL with instrumentation.
+    """
+    if hasattr(loader, 'instrumentation'):
+        return loader.instrumentation.iterate(stage, rows)
+    return rows
+
+
+class RawLineSignatureFilter:
+    """
+    The line filter of the raw_line signature strategy. The signature of each line is calculated from the raw
+    values of the field_names, or all the fields if not given, and the lines whose signatures are already in
+    the records table are skipped. The lines that are duplicates of the earlier lines of the file are skipped
+    too unless skip_duplicate_lines is False.
+    The signatures of the lines that are kept are added to the rows once they are cleaned.
+    """
+
+    def __init__(self, signature_plan, get_ids_by_signatures, on_existing_ids=None, chunk_rows=1000,
+                 max_seen_bytes=0, field_names=None, skip_duplicate_lines=True):
+        self.signature_plan = signature_plan
+        self.get_ids_by_signatures = get_ids_by_signatures
+        self.on_existing_ids = on_existing_ids
+        self.chunk_rows = chunk_rows
+        self.field_names = field_names
+        self.skip_duplicate_lines = skip_duplicate_lines
+        self.rows_skipped = 0
+        self._seen_signatures = BoundedSignatureSet(max_seen_bytes)
+        self._signatures = deque()
+
+    def _get_signed_values(self, clean_names, chunk):
+        field_names = self.field_names
+        indexes = [(i, name) for i, name in enumerate(clean_names) if field_names is None or name in field_names]
+        return [{name: line[i] for i, name in indexes if i < len(line)} for line in chunk]
+
+    def __call__(self, clean_names, lines):
+        for chunk in generator_chunker(iter(lines), self.chunk_rows):
+            if not chunk:
+                continue
+            signatures = self.signature_plan.generate_signatures(self._get_signed_values(clean_names, chunk))
+            if self.skip_duplicate_lines:
+                existing_ids = self.get_ids_by_signatures(
+                    {i for i in signatures if i not in self._seen_signatures})
+                self._seen_signatures.update(existing_ids)
+            else:
+                existing_ids = self.get_ids_by_signatures(set(signatures))
+            if existing_ids and self.on_existing_ids:
+                # One id per skipped line.
+                self.on_existing_ids([existing_ids[i] for i in signatures if i in existing_ids])
+            for line, signature in zip(chunk, signatures):
+                if signature in existing_ids or (self.skip_duplicate_lines and signature in self._seen_signatures):
+                    self.rows_skipped += 1
+                    continue
+                if self.skip_duplicate_lines:
+                    self._seen_signatures.add(signature)
+                self._signatures.append(signature)
+                yield line
+
+    def update_rows(self, rows):
+        """
+        Adds the signatures to the rows that are cleaned from the lines that were kept, in the same order.
+        """
+        for row in rows:
+            row['signature'] = self._signatures.popleft()
+            yield row
+
+
+class RawLineSignatureMixin():
+    """
+    Adds the raw_line signature_strategy to the signature loaders.
+    """
+    RAW_LINE_CHUNK_ROWS = 1000
+    # If false, the lines that are duplicates of the earlier lines of the file are cleaned and loaded too.
+    RAW_LINE_SKIP_DUPLICATE_LINES = True
+
+    def _uses_raw_line_signatures(self):
+        strategy = self.settings.signature_strategy
+        if strategy not in SIGNATURE_STRATEGIES:
+            raise ValueError(f"The signature_strategy of {strategy} is invalid. "
+                             f"Options are: {', '.join(SIGNATURE_STRATEGIES)}")
+        return strategy == 'raw_line' and self.settings.ignore_duplicate_rows_when_importing
+
+    @cached_property
+    def signature_plan(self):
+        return SignaturePlan(self.RECORDS_MODEL, self.settings.ignore_fields_in_signature_calculation,
+                             signature_size=self.settings.signature_bits,
+                             signature_format=self.settings.signature_format)
+
+    @cached_property
+    def raw_line_signature_plan(self):
+        return SignaturePlan(ignore_fields=self.settings.ignore_fields_in_signature_calculation,
+                             signature_size=self.settings.signature_bits,
+                             signature_format=self.settings.signature_format)
+
+    def get_signatures(self, chunk):
+        """
+        The signatures of the rows. The rows already have them when the raw_line signature strategy is used.
+        """
+        if self._uses_raw_line_signatures():
+            return [row['signature'] for row in chunk]
+        return self.signature_plan.generate_signatures(chunk)
+
+    def get_ids_by_signatures(self, session, model, signatures):
+        """Searches given table for given signatures. Returns a dictionary of the found signatures to their ids"""
+        if not signatures:
+            return {}
+        table = model.__table__
+        query = select([table.c.signature, table.c.id]).where(table.c.signature.in_(list(signatures)))
+        return dict(session.execute(query).fetchall())
+
+    def get_raw_line_signature_field_names(self):
+        """
+        The fields whose raw values are in the raw_line signatures. These are the fields of the model
+        that are not scrubbed, so the signatures only change when the loaded values change.
+        """
+        return set(self._get_combined_module().FIELDS) - set(self.settings.fields_to_be_scrubbed)
+
+    def on_existing_raw_line_ids(self, session, ids):
+        """Called with the id of the record of each line that is skipped since it already exists."""
+        pass
+
+    def get_line_filter(self, session):
+        if not self._uses_raw_line_signatures():
+            return None
+        return RawLineSignatureFilter(
+            self.raw_line_signature_plan,
+            get_ids_by_signatures=lambda signatures: self.get_ids_by_signatures(
+                session, self.RECORDS_MODEL, signatures),
+            on_existing_ids=lambda ids: self.on_existing_raw_line_ids(session, ids),
+            chunk_rows=self.RAW_LINE_CHUNK_ROWS,
+            max_seen_bytes=self.settings.signature_dedup_max_bytes,
+            field_names=self.get_raw_line_signature_field_names(),
+            skip_duplicate_lines=self.RAW_LINE_SKIP_DUPLICATE_LINES)
+
 
 class BaseLoaderMixin():
     """
@@ -68,7 +211,7 @@ class SqlalchemyLoaderMixin(BaseLoaderMixin):
             raise
 
 
-class SignatureSqlalchemyMixin(SqlalchemyLoaderMixin):
+class SignatureSqlalchemyMixin(RawLineSignatureMixin, SqlalchemyLoaderMixin):
     """
     Base Signature loader. A signature column will be added to each row whose value is a 64-bit
     murmur hash of the row (requiring BigInteger type). This will insert DUPLICATE ROWS!!!
@@ -77,14 +220,13 @@ class SignatureSqlalchemyMixin(SqlalchemyLoaderMixin):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.all_recent_rows_signatures = set()
+        self.all_recent_rows_signatures = BoundedSignatureSet(self.settings.signature_dedup_max_bytes)
 
     def add_row_signature(self, chunk):
         """Add hash of row to row about to be inserted"""
-        for row in chunk:
-            row['signature'] = generate_row_signature(
-                row, self.RECORDS_MODEL, self.settings.ignore_fields_in_signature_calculation
-            )
+        chunk = chunk if isinstance(chunk, list) else list(chunk)
+        for row, signature in zip(chunk, self.get_signatures(chunk)):
+            row['signature'] = signature
             yield row
 
     def get_id_by_signature(self, session, model, signature):
@@ -98,7 +240,7 @@ class SignatureSqlalchemyMixin(SqlalchemyLoaderMixin):
 
     def insert_chunk_of_data_to_db(self, session, model, chunk):
         """Add row signature to row then run Base class logic"""
-        new_chunk = self.add_row_signature(chunk)
+        new_chunk = _instrumented(self, 'signature', self.add_row_signature(chunk))
         return super().insert_chunk_of_data_to_db(session, model, new_chunk)
 
 
@@ -106,60 +248,211 @@ class SqlalchemySnapshotLoaderMixin(SignatureSqlalchemyMixin):
     """
     Sqlalchemy Specific Loader with Snapshot Auxilary Table for row dupes.
     It adds the records to the snapshot model.
+    On PostgreSQL, if the signature of the records model is unique, the new records of a chunk are inserted
+    in one statement. Otherwise they are inserted one by one.
     """
     SNAPSHOT_MODEL = None
+    # Each line of the file gets a snapshot row, so the duplicate lines are loaded to get their record ids.
+    RAW_LINE_SKIP_DUPLICATE_LINES = False
+    # If true, the signatures of the records table are put in a Bloom filter once per run and only the
+    # signatures that are probably in the table are looked up in the database.
+    SIGNATURE_BLOOM_FILTER = False
+    SIGNATURE_BLOOM_FILTER_ERROR_RATE = 0.01
+    SIGNATURE_BLOOM_FILTER_MIN_CAPACITY = 100000
+    # If set, the Bloom filter is loaded from this file instead of the table and saved into it after each run.
+    # Only set it if this job is the only one that inserts into the records table.
+    SIGNATURE_BLOOM_FILTER_PATH = None
+    _signature_bloom_filter = None
+
+    def get_signature_count(self, session, model):
+        table = model.__table__
+        return session.execute(select([func.count()]).select_from(table)).scalar()
+
+    def get_all_signatures(self, session, model, chunk_rows=10000):
+        table = model.__table__
+        result = session.execute(select([table.c.signature]).where(table.c.signature.isnot(None)))
+        while True:
+            rows = result.fetchmany(chunk_rows)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0]
+
+    def get_signature_bloom_filter(self, session, model):
+        """
+        Loads the Bloom filter from the SIGNATURE_BLOOM_FILTER_PATH. If the file does not exist or the filter
+        is over its capacity, a new filter is made from the signatures of the table.
+        """
+        path = self.SIGNATURE_BLOOM_FILTER_PATH
+        if path and os.path.exists(path):
+            bloom_filter = BloomFilter.load(path)
+            if not bloom_filter.is_full:
+                return bloom_filter
+        # Leaving room for the table to double before the false positive rate goes above the error rate.
+        capacity = max(self.get_signature_count(session, model) * 2, self.SIGNATURE_BLOOM_FILTER_MIN_CAPACITY)
+        bloom_filter = BloomFilter(capacity, error_rate=self.SIGNATURE_BLOOM_FILTER_ERROR_RATE)
+        bloom_filter.update(self.get_all_signatures(session, model))
+        return bloom_filter
+
+    def _get_signature_bloom_filter(self, session, model):
+        if not self.SIGNATURE_BLOOM_FILTER:
+            return None
+        if self._signature_bloom_filter is None:
+            self._signature_bloom_filter = self.get_signature_bloom_filter(session, model)
+        return self._signature_bloom_filter
+
+    def get_ids_by_signatures(self, session, model, signatures):
+        bloom_filter = self._get_signature_bloom_filter(session, model)
+        if bloom_filter is not None:
+            signatures = [i for i in signatures if i in bloom_filter]
+        return super().get_ids_by_signatures(session, model, signatures)
+
+    def post_commit(self, session):
+        if self._signature_bloom_filter is not None:
+            if self.SIGNATURE_BLOOM_FILTER_PATH:
+                self._signature_bloom_filter.save(self.SIGNATURE_BLOOM_FILTER_PATH)
+            # The next run starts from the table or the file again.
+            self._signature_bloom_filter = None
+        super().post_commit(session)
+
+    def on_existing_raw_line_ids(self, session, ids):
+        """The records of the skipped lines are still a part of the snapshot."""
+        raw_key_id = str(self.raw_key_id) if isinstance(self.raw_key_id, uuid.UUID) else self.raw_key_id
+        self.insert_snapshot_rows(session, [{'raw_key_id': raw_key_id, 'record_id': id_} for id_ in ids])
+
+    def has_unique_signature(self, session, model):
+        """
+        Whether the records can be inserted with ON CONFLICT (signature) DO NOTHING. It needs PostgreSQL and
+        a unique constraint or a unique index on only the signature column of the model.
+        """
+        if session.get_bind().dialect.name != 'postgresql':
+            return False
+        table = model.__table__
+        signature = table.c.signature
+        if signature.unique or list(table.primary_key.columns) == [signature]:
+            return True
+        unique_columns = [index.columns for index in table.indexes if index.unique]
+        unique_columns += [i.columns for i in table.constraints if isinstance(i, UniqueConstraint)]
+        return any(list(columns) == [signature] for columns in unique_columns)
+
+    def insert_records(self, session, model, rows):
+        """
+        Inserts the rows in one statement. Returns a dictionary of the signatures of the inserted rows to their ids.
+        The rows whose signatures conflict with the existing records are not inserted. Any other
+        constraint violation still raises.
+        Without a unique signature, the rows are inserted one by one and none of them conflict.
+        """
+        table = model.__table__
+        if not self.has_unique_signature(session, model):
+            return self.insert_records_one_by_one(session, model, rows)
+        query = insert(table).values(rows).on_conflict_do_nothing(
+            index_elements=['signature']).returning(table.c.id, table.c.signature)
+        return {signature: id_ for id_, signature in session.execute(query).fetchall()}
+
+    def insert_records_one_by_one(self, session, model, rows):
+        table = model.__table__
+        result = {}
+        for row in rows:
+            query_result = session.execute(table.insert().values(**row))
+            result[row['signature']] = query_result.inserted_primary_key[0]
+        return result
+
+    def insert_snapshot_rows(self, session, snapshot_rows):
+        """Inserts the snapshot rows in one statement."""
+        if not snapshot_rows:
+            return
+        for snapshot_row in snapshot_rows:
+            if isinstance(snapshot_row['record_id'], uuid.UUID):
+                snapshot_row['record_id'] = str(snapshot_row['record_id'])
+        session.execute(self.SNAPSHOT_MODEL.__table__.insert().values(snapshot_rows))
+
+    def post_rows_insert(self, rows, session, model):
+        """Override to add any logic for the inserted rows of a chunk. It calls post_row_insert for each row."""
+        for row in rows:
+            self.post_row_insert(row, session, model)
 
     def insert_chunk_of_data_to_db(self, session, model, chunk):
+        """
+        Looks up the signatures of the chunk in one query, inserts the new records in one statement
+        and then inserts the snapshot rows of all the records of the chunk in one statement.
+        """
         table = model.__table__
-        snapshot_table = self.SNAPSHOT_MODEL.__table__
-        new_chunk = self.add_row_signature(chunk) if self.settings.ignore_duplicate_rows_when_importing else chunk  # NOQA
-        count = 0
+        new_chunk = list(_instrumented(self, 'signature', self.add_row_signature(chunk))) if self.settings.ignore_duplicate_rows_when_importing else list(chunk)  # NOQA
+        if not new_chunk:
+            return 0, 0
+        for row in new_chunk:
+            if isinstance(row['raw_key_id'], uuid.UUID):
+                row['raw_key_id'] = str(row['raw_key_id'])
+        ids_by_signature = dict(self.get_ids_by_signatures(
+            session, model, {row['signature'] for row in new_chunk if row.get('signature')}))
         existing_count = 0
-        if new_chunk:
-            for row in new_chunk:
-                if isinstance(row['raw_key_id'], uuid.UUID):
-                    row['raw_key_id'] = str(row['raw_key_id'])
-                id_ = None
-                if row['signature']:
-                    id_ = self.get_id_by_signature(session, model, row['signature'])
-                if id_:
-                    existing_count += 1
-                else:
-                    ins = table.insert().values(**row)
-                    result = session.execute(ins)
-                    session.flush()
-                    id_ = result.inserted_primary_key[0]
-                    row['id'] = id_
-                    self.post_row_insert(row, session, model)
-                if id_:
-                    count += 1
-                    if isinstance(id_, uuid.UUID):
-                        id_ = str(id_)
-                    snapshot_row = {'raw_key_id': row['raw_key_id'], 'record_id': id_}
-                    ins = snapshot_table.insert().values(**snapshot_row)
-                    result = session.execute(ins)
-            session.flush()
-        return count, existing_count
+        # The duplicates of a row in the chunk use the id of the first one once it is inserted.
+        rows_to_insert_by_signature = {}
+        rows_without_signature = []
+        for row in new_chunk:
+            signature = row.get('signature')
+            if not signature:
+                rows_without_signature.append(row)
+            elif signature in ids_by_signature or signature in rows_to_insert_by_signature:
+                existing_count += 1
+            else:
+                rows_to_insert_by_signature[signature] = row
 
+        inserted_rows = []
+        if rows_to_insert_by_signature:
+            inserted_ids = self.insert_records(session, model, list(rows_to_insert_by_signature.values()))
+            ids_by_signature.update(inserted_ids)
+            bloom_filter = self._get_signature_bloom_filter(session, model)
+            for signature, id_ in inserted_ids.items():
+                row = rows_to_insert_by_signature[signature]
+                row['id'] = id_
+                inserted_rows.append(row)
+                if bloom_filter is not None:
+                    bloom_filter.add(signature)
+            # The rows that conflicted were inserted by someone else after they were looked up.
+            conflicted_signatures = set(rows_to_insert_by_signature) - set(inserted_ids)
+            if conflicted_signatures:
+                conflicted_ids = super().get_ids_by_signatures(session, model, conflicted_signatures)
+                ids_by_signature.update(conflicted_ids)
+                existing_count += len(conflicted_ids)
+                missing_signatures = conflicted_signatures - set(conflicted_ids)
+                if missing_signatures:
+                    self.logger.warning(f'{len(missing_signatures)} rows were neither inserted nor found '
+                                        f'by their signatures in {table}.')
+        for row in rows_without_signature:
+            result = session.execute(table.insert().values(**row))
+            row['id'] = result.inserted_primary_key[0]
+            inserted_rows.append(row)
+        if inserted_rows:
+            self.post_rows_insert(inserted_rows, session, model)
 
-class SqlalchemyBulkLoaderMixin():
+        snapshot_rows = []
+        for row in new_chunk:
+            id_ = ids_by_signature.get(row['signature']) if row.get('signature') else row['id']
+            if id_:
+                snapshot_rows.append({'raw_key_id': row['raw_key_id'], 'record_id': id_})
+        self.insert_snapshot_rows(session, snapshot_rows)
+        session.flush()
+        return len(snapshot_rows), existing_count
+
+
+class SqlalchemyBulkLoaderMixin(RawLineSignatureMixin):
     """
     Sqlalchemy Specific Bulk Loader.
     Handles Bulk inserts and ignores when there were errors and continues
     """
 
     def add_row_signature(self, chunk):
-        for row in chunk:
-            row['signature'] = signature = generate_row_signature(
-                row, self.RECORDS_MODEL, self.settings.ignore_fields_in_signature_calculation
-            )
+        chunk = chunk if isinstance(chunk, list) else list(chunk)
+        for row, signature in zip(chunk, self.get_signatures(chunk)):
+            row['signature'] = signature
             if signature and signature not in self.all_recent_rows_signatures:
                 self.all_recent_rows_signatures.add(signature)
                 yield row
 
     def insert_chunk_of_data_to_db(self, session, model, chunk):
         table = model.__table__
-        new_chunk = list(self.add_row_signature(chunk)) if self.settings.ignore_duplicate_rows_when_importing else list(chunk)  # NOQA
+        new_chunk = list(_instrumented(self, 'signature', self.add_row_signature(chunk))) if self.settings.ignore_duplicate_rows_when_importing else list(chunk)  # NOQA
         if new_chunk:
             insrt_stmnt = insert(table).values(new_chunk)
             do_nothing_stmt = insrt_stmnt.on_conflict_do_nothing()
@@ -167,3 +460,74 @@ class SqlalchemyBulkLoaderMixin():
             return results.rowcount, None
         else:
             return 0, None
+
+
+class PostgresCopyLoaderMixin(SqlalchemyBulkLoaderMixin):
+    """
+    PostgreSQL Specific Bulk Loader that sends the rows with COPY which is much faster than INSERT.
+    The rows are copied into a temporary table and then inserted into the table while ignoring the
+    rows that conflict with the existing ones. Requires the psycopg2 or psycopg driver.
+    The temporary table is made once per transaction and emptied after each chunk.
+    """
+    SQL_CHUNK_ROWS = 10000
+    _copy_tables = None
+    _copy_tables_transaction = None
+
+    def get_copy_columns(self, table, rows):
+        """The columns of the table that are in the rows. The other columns get their database defaults."""
+        keys = set()
+        for row in rows:
+            keys.update(row)
+        return [column.name for column in table.columns if column.name in keys]
+
+    def copy_rows(self, connection, table, columns, rows):
+        preparer = connection.dialect.identifier_preparer
+        query = (f"COPY {preparer.format_table(table)} ({', '.join(preparer.quote(i) for i in columns)}) "
+                 f"FROM STDIN")
+        copy_buffer = CopyTextBuffer(rows, columns)
+        cursor = connection.connection.cursor()
+        try:
+            if hasattr(cursor, 'copy_expert'):  # psycopg2
+                cursor.copy_expert(query, copy_buffer, size=COPY_BUFFER_SIZE)
+            elif hasattr(cursor, 'copy'):  # psycopg 3
+                with cursor.copy(query) as copy:
+                    for data in iter(lambda: copy_buffer.read(COPY_BUFFER_SIZE), ''):
+                        copy.write(data)
+            else:
+                raise ImportError('Please install psycopg2 to use the PostgresCopyLoaderMixin')
+        finally:
+            cursor.close()
+
+    def _get_copy_table(self, table, columns):
+        columns = [Column(i, table.c[i].type) for i in columns]
+        return Table(f'{table.name}_copy', MetaData(), *columns, prefixes=['TEMPORARY'], postgresql_on_commit='DROP')
+
+    def get_copy_table(self, session, table):
+        """
+        The temporary table with the columns of the table that the rows are copied into.
+        It is dropped on commit so it is made again in the next transaction.
+        """
+        transaction = session.transaction
+        if self._copy_tables_transaction is not transaction:
+            self._copy_tables = {}
+            self._copy_tables_transaction = transaction
+        copy_table = self._copy_tables.get(table.name)
+        if copy_table is None:
+            copy_table = self._get_copy_table(table, [column.name for column in table.columns])
+            copy_table.create(session.connection())
+            self._copy_tables[table.name] = copy_table
+        return copy_table
+
+    def insert_chunk_of_data_to_db(self, session, model, chunk):
+        table = model.__table__
+        new_chunk = list(_instrumented(self, 'signature', self.add_row_signature(chunk))) if self.settings.ignore_duplicate_rows_when_importing else list(chunk)  # NOQA
+        if not new_chunk:
+            return 0, None
+        columns = self.get_copy_columns(table, new_chunk)
+        copy_table = self.get_copy_table(session, table)
+        connection = session.connection()
+        self.copy_rows(connection, copy_table, columns, new_chunk)
+        query = insert(table).from_select(columns, select([copy_table.c[i] for i in columns]))
+        results = connection.execute(query.on_conflict_do_nothing())
+        connection.execute(text(f'TRUNCATE {connection.dialect.identifier_preparer.format_table(copy_table)}'))
+        return results.rowcount, None
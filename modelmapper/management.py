@@ -1,6 +1,10 @@
+import json
 import click
 from modelmapper import Mapper, initialize
 from .excel import excel_file_to_csv_files
+from .synthetic import FILE_FORMATS, write_synthetic_file
+from .benchmark import (TYPE_MIXES, LOADER_CHUNK_ROWS, run_benchmarks, get_report_str, save_results, load_results,
+                        compare_to_baseline, bench_model, get_bench_report_str)
 
 
 @click.group()
@@ -11,13 +15,15 @@ def cli():
 
 @cli.command()
 @click.option('--debug', is_flag=True)
+@click.option('--batch', is_flag=True,
+              help='Do not prompt. The questions are written to the questions file to be answered later.')
 @click.argument('path', type=click.Path(exists=True, resolve_path=True))
-def analyze(path, debug):
+def analyze(path, debug, batch):
     """
     Only analyze the files based on the setup_toml settings and write the analyzed toml files.
     """
     click.echo(f'Analyzing {path}')
-    mapper = Mapper(path, debug=debug)
+    mapper = Mapper(path, debug=debug, non_interactive=batch)
     mapper.analyze()
 
 
@@ -35,14 +41,159 @@ def write_orm_model(path, debug):
 
 @cli.command()
 @click.option('--debug', is_flag=True)
+@click.option('--batch', is_flag=True,
+              help='Do not prompt. The questions are written to the questions file to be answered later.')
 @click.argument('path', type=click.Path(exists=True, resolve_path=True))
-def run(path, debug):
+def run(path, debug, batch):
     """
     In addition to analyzing the files based on the setup_toml, go ahead and generate the ORM models and related files.
     """
     click.echo(f'Running {path}')
-    mapper = Mapper(path, debug=debug)
+    mapper = Mapper(path, debug=debug, non_interactive=batch)
     mapper.run()
+    if mapper.get_pending_questions():
+        raise click.ClickException(f'The questions in {mapper.settings.questions_path} need to be answered.')
+
+
+@cli.command()
+@click.option('--debug', is_flag=True)
+@click.argument('path', type=click.Path(exists=True, resolve_path=True))
+def export_analysis(path, debug):
+    """
+    Write the analyzed results in the analysis store into toml files for review.
+    """
+    click.echo(f'Exporting the analysis of {path}')
+    mapper = Mapper(path, debug=debug)
+    mapper.export_analysis()
+
+
+def _parse_shard(ctx, param, value):
+    try:
+        shard_index, shard_count = map(int, value.split('/'))
+    except ValueError:
+        raise click.BadParameter('The shard needs to be in the index/count format such as 0/4.')
+    if not 0 <= shard_index < shard_count:
+        raise click.BadParameter(f'The shard index needs to be between 0 and {shard_count - 1}.')
+    return shard_index, shard_count
+
+
+@cli.command()
+@click.option('--debug', is_flag=True)
+@click.option('--batch', is_flag=True,
+              help='Do not prompt. The questions are written to the questions file to be answered later.')
+@click.option('--csv', 'csv_paths', multiple=True, type=click.Path(exists=True, resolve_path=True),
+              help='The csvs of this shard. Defaults to the training_csvs in the settings.')
+@click.option('--shard', default='0/1', callback=_parse_shard,
+              help='Only inspect the rows of this shard. For example 1/4 is the second of 4 shards.')
+@click.option('--output', '-o', required=True, type=click.Path(resolve_path=True),
+              help='The json file to write the partial stats to.')
+@click.argument('path', type=click.Path(exists=True, resolve_path=True))
+def partial_stats(path, debug, batch, csv_paths, shard, output):
+    """
+    Collect the stats of a shard of the training data so they can be merged with merge-stats later.
+    """
+    click.echo(f'Collecting the partial stats of shard {shard[0]} of {shard[1]} for {path}')
+    mapper = Mapper(path, debug=debug, non_interactive=batch)
+    all_stats = mapper.get_partial_stats(csv_paths=list(csv_paths), shard_index=shard[0], shard_count=shard[1])
+    mapper.write_partial_stats(output, all_stats)
+
+
+@cli.command()
+@click.option('--debug', is_flag=True)
+@click.argument('path', type=click.Path(exists=True, resolve_path=True))
+@click.argument('partials', nargs=-1, required=True, type=click.Path(exists=True, resolve_path=True))
+def merge_stats(path, debug, partials):
+    """
+    Merge the partial stats files and generate the combined module and the ORM models.
+    """
+    click.echo(f'Merging {len(partials)} partial stats files')
+    mapper = Mapper(path, debug=debug)
+    mapper.run_from_partial_stats(partials)
+
+
+@cli.command()
+@click.option('--rows', '-r', multiple=True, type=int, default=[10000], show_default=True,
+              help='Number of rows of the synthetic csvs. Can be passed multiple times.')
+@click.option('--columns', '-c', multiple=True, type=int, default=[10], show_default=True,
+              help='Number of columns of the synthetic csvs. Can be passed multiple times.')
+@click.option('--mix', '-m', 'type_mixes', multiple=True, default=['mixed'], show_default=True,
+              type=click.Choice(sorted(TYPE_MIXES.keys())),
+              help='The types of the columns. Can be passed multiple times.')
+@click.option('--seed', type=int, default=0, show_default=True)
+@click.option('--no-memory', is_flag=True, help='Do not trace the peak memory. The timings are more accurate.')
+@click.option('--save', type=click.Path(resolve_path=True), help='Save the results as json to be used as a baseline.')
+@click.option('--compare', type=click.Path(exists=True, resolve_path=True),
+              help='Compare the results to the baseline json and fail if there are regressions.')
+@click.option('--threshold', type=float, default=0.1, show_default=True,
+              help='How much slower or bigger than the baseline is a regression.')
+def benchmark(rows, columns, type_mixes, seed, no_memory, save, compare, threshold):
+    """
+    Benchmark training, cleaning, row signatures and loading on synthetic csvs.
+    """
+    results = run_benchmarks(row_counts=rows, column_counts=columns, type_mixes=type_mixes,
+                             seed=seed, trace_memory=not no_memory)
+    click.echo(get_report_str(results))
+    if save:
+        save_results(save, results)
+        click.echo(f'{save} written.')
+    if compare:
+        regressions = compare_to_baseline(results, load_results(compare), threshold=threshold)
+        if regressions:
+            raise click.ClickException('Regressions compared to the baseline:\n' + '\n'.join(regressions))
+        click.echo('No regressions compared to the baseline.')
+
+
+@cli.command()
+@click.option('--file', '-f', 'data_path', type=click.Path(exists=True, resolve_path=True),
+              help='The data file to clean. If not passed, synthetic data based on the model is used.')
+@click.option('--content-type', type=click.Choice(['csv', 'tsv', 'xls', 'xls_xml', 'xlsx']),
+              help='The content type of the file. Defaults to the extension of the file.')
+@click.option('--rows', '-r', type=int, default=10000, show_default=True, help='Number of synthetic rows.')
+@click.option('--null-rate', type=float, default=0.05, show_default=True,
+              help='Ratio of the values of the nullable fields that are empty in the synthetic data.')
+@click.option('--seed', type=int, default=0, show_default=True)
+@click.option('--chunk-size', type=int, default=LOADER_CHUNK_ROWS, show_default=True,
+              help='Number of rows per chunk that is passed to the loader.')
+@click.option('--memory', is_flag=True, help='Trace the peak memory. It slows down the stages.')
+@click.option('--json', 'as_json', is_flag=True, help='Output the results as json.')
+@click.argument('path', type=click.Path(exists=True, resolve_path=True))
+def bench(path, data_path, content_type, rows, null_rate, seed, chunk_size, memory, as_json):
+    """
+    Benchmark the cleaner, row signatures and loading of a trained model on a file or synthetic data.
+    """
+    results = bench_model(path, data_path=data_path, content_type=content_type, rows=rows, seed=seed,
+                          trace_memory=memory, chunk_size=chunk_size, null_rate=null_rate)
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+    else:
+        click.echo(get_bench_report_str(results))
+
+
+@cli.command()
+@click.option('--rows', '-r', type=int, default=10000, show_default=True, help='Number of rows to generate.')
+@click.option('--output', '-o', required=True, type=click.Path(resolve_path=True),
+              help='The csv, tsv or xlsx file to write to.')
+@click.option('--format', 'file_format', type=click.Choice(FILE_FORMATS),
+              help='The format of the output. Defaults to the extension of the output.')
+@click.option('--null-rate', type=float, default=0.05, show_default=True,
+              help='Ratio of the values of the nullable fields that are empty.')
+@click.option('--error-rate', type=float, default=0.0, show_default=True,
+              help='Ratio of the values that can not be cast to the type of the field.')
+@click.option('--duplicate-rate', type=float, default=0.0, show_default=True,
+              help='Ratio of the rows that are copies of a previous row.')
+@click.option('--cardinality', type=int, help='Number of distinct values of each field.')
+@click.option('--seed', type=int, default=0, show_default=True)
+@click.argument('path', type=click.Path(exists=True, resolve_path=True))
+def synthetic(path, rows, output, file_format, null_rate, error_rate, duplicate_rate, cardinality, seed):
+    """
+    Generate synthetic data based on the fields of the combined module of the model.
+    """
+    click.echo(f'Generating {rows} rows for {path}')
+    mapper = Mapper(path)
+    fields = mapper._get_combined_module().FIELDS
+    write_synthetic_file(output, fields, rows, file_format=file_format, null_rate=null_rate, error_rate=error_rate,
+                         duplicate_rate=duplicate_rate, cardinality=cardinality, seed=seed)
+    click.echo(f'{output} written.')
 
 
 @cli.command()
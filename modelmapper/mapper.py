@@ -1,7 +1,10 @@
 import enum
 import os
+import re
 
 import sys
+import json
+import random
 import datetime
 
 from decimal import Decimal
@@ -9,6 +12,7 @@ from typing import NamedTuple
 from tabulate import tabulate
 
 from modelmapper.base import Base
+from modelmapper.analysis_store import AnalysisStore, get_csv_fingerprint
 from modelmapper.ui import get_user_choice, get_user_input
 from modelmapper.misc import (load_toml, write_toml, write_settings,
                               named_tuple_to_compact_dict, escape_word, get_combined_dict,
@@ -18,7 +22,10 @@ from modelmapper.stats import (
     StatsCollector,
     UserInferenceRequired,
     InconsistentData,
-    matchers_from_settings
+    matchers_from_settings,
+    merge_field_stats,
+    field_stats_to_dict,
+    field_stats_from_dict,
 )
 from modelmapper.types import (
     HasNull,
@@ -43,6 +50,12 @@ INVALID_DATETIME_USER_OPTIONS = {
 }
 
 
+QUESTION_HELP = ('Set datetime_format to the datetime format of the item or set not_datetime to true '
+                 'to confirm that this is not a datetime field. Then analyze again.')
+# The questions of a field after this many are not recorded until the previous ones are answered.
+MAX_PENDING_QUESTIONS_PER_FIELD = 20
+
+
 CONTINUE_OR_ABORT_OPTIONS = {
     'y': {'help': 'to continue when done', 'func': lambda x: True},
     'n': {'help': 'to abort', 'func': lambda x: sys.exit()}
@@ -153,35 +166,277 @@ def _is_valid_dateformat(user_input, item):
     return result
 
 
+def _is_question_answered(question):
+    return bool(question.get('not_datetime') or question.get('datetime_format'))
+
+
+def _get_item_shape(item):
+    """The item with its runs of digits and letters replaced, so the items of the same format have the same shape."""
+    return re.sub(r'[^\W\d_]+', 'a', re.sub(r'\d+', '0', item))
+
+
 class Mapper(Base):
 
+    def __init__(self, *args, **kwargs):
+        # In the non-interactive mode the questions are written to the questions file instead of prompting the user.
+        self.non_interactive = kwargs.pop('non_interactive', False)
+        super().__init__(*args, **kwargs)
+        self._stats_collectors = {}
+        self.questions = {}
+        self._fields_not_datetime = set()
+        # (shard index, shard count) when only a shard of the rows of the csvs is inspected.
+        self.row_shard = None
+
+    def _get_clean_names_and_csv_data_gen(self, path, line_by_line=False):
+        clean_names, reader = super()._get_clean_names_and_csv_data_gen(path, line_by_line=line_by_line)
+        if self.row_shard is not None:
+            shard_index, shard_count = self.row_shard
+            reader = (line for i, line in enumerate(reader) if i % shard_count == shard_index)
+        return clean_names, reader
+
+    def _get_decided_string_length(self):
+        """Any string longer than the boolean words makes the field a string field."""
+        return max(map(len, self.settings.booleans))
+
+    def _new_stats_collector(self, ignore_matchers=None):
+        decided_string_length = None
+        if self.settings.training_short_circuit_string_fields:
+            decided_string_length = self._get_decided_string_length()
+        on_inference_required = self._add_question if self.non_interactive else None
+        return StatsCollector(matchers=matchers_from_settings(self.settings, ignore_matchers=ignore_matchers),
+                              decided_string_length=decided_string_length,
+                              on_inference_required=on_inference_required)
+
+    def _get_stats_collector(self, ignore_matchers=None):
+        """
+        Returns a reset collector. The collectors are cached per set of ignored matchers.
+        """
+        key = frozenset(ignore_matchers or ())
+        try:
+            collector = self._stats_collectors[key]
+        except KeyError:
+            collector = self._new_stats_collector(ignore_matchers)
+            self._stats_collectors[key] = collector
+        else:
+            collector.reset()
+        return collector
+
+    def _split_training_sample(self, field_name, items):
+        """
+        Splits the items into a random sample of training_sample_size items and the rest of them.
+        The field name seeds the random generator so the training stays deterministic.
+        """
+        sample_size = self.settings.training_sample_size
+        if not sample_size or len(items) <= sample_size:
+            return items, []
+        sample_indexes = set(random.Random(field_name).sample(range(len(items)), sample_size))
+        sample = []
+        rest = []
+        for i, item in enumerate(items):
+            if i in sample_indexes:
+                sample.append(item)
+            else:
+                rest.append(item)
+        return sample, rest
+
+    def _ask_user_about_datetime(self, field_name, item, ignore_matchers):
+        """
+        Asks the user about a value that looks like a datetime but none of the datetime formats match it.
+        Either the new format is added to the settings or the DateTimeMatcher is ignored for the field.
+
+        Returns:
+            set: the matchers to ignore when the field is inspected again.
+        """
+        msg = f'field {field_name} has inconsistent datetime data: {item}.'
+        choice = get_user_choice(msg, choices=INVALID_DATETIME_USER_OPTIONS)
+        if choice == 'n':
+            if ignore_matchers:
+                ignore_matchers.add('DateTimeMatcher')
+            else:
+                ignore_matchers = {'DateTimeMatcher'}
+        else:
+            msg = f'Please enter the datetime format for {item}'
+            new_format = get_user_input(msg, validate_func=_is_valid_dateformat, item=item)
+            if new_format in self.settings.datetime_formats:
+                raise InconsistentData(f"field {field_name} has inconsistent datetime data: "
+                                       f"{item}. {new_format} was already in your settings.")
+            self._add_datetime_format_to_settings(new_format)
+        return ignore_matchers
+
+    def _add_datetime_format_to_settings(self, new_format):
+        print(f'Adding {new_format} to your settings.')
+        self.settings.datetime_formats.add(new_format)
+        self._original_settings['datetime_formats'].append(new_format)
+        write_settings(self.setup_path, self._original_settings)
+
+    def _add_question(self, field_name, item, err):
+        """
+        Records the question about the item instead of prompting the user in the non-interactive mode.
+        The item is treated as not being a datetime and the inspection of the field goes on.
+        Each field gets one question per shape of the items that need an answer, so all the
+        formats of the field can be answered at once.
+        """
+        if err.value_type != HasDateTime:
+            raise err
+        questions = self.questions.setdefault(field_name, [])
+        pending = [i for i in questions if not _is_question_answered(i)]
+        shape = _get_item_shape(item)
+        if len(pending) >= MAX_PENDING_QUESTIONS_PER_FIELD or any(
+                _get_item_shape(i['item']) == shape for i in pending):
+            return
+        # The datetime formats that were answered before are already added to the settings.
+        questions.append({
+            'item': item,
+            'message': f'field {field_name} has inconsistent datetime data: {item}.',
+            'help': QUESTION_HELP,
+            'datetime_format': '',
+            'not_datetime': False,
+        })
+
+    def _apply_answered_questions(self):
+        """
+        Reads the questions file. The datetime formats that are answered are added to the settings and
+        the fields that are answered to not be datetimes are inspected without the DateTimeMatcher.
+        The answered questions are kept so they are applied in the next analysis too.
+        """
+        self.questions = {}
+        self._fields_not_datetime = set()
+        if not os.path.exists(self.settings.questions_path):
+            return
+        for field_name, questions in load_toml(self.settings.questions_path).items():
+            # The older questions files have one question per field.
+            if isinstance(questions, dict):
+                questions = [questions]
+            for question in questions:
+                if not _is_question_answered(question):
+                    continue
+                new_format = question.get('datetime_format')
+                if question.get('not_datetime'):
+                    self._fields_not_datetime.add(field_name)
+                elif not _is_valid_dateformat(new_format, question['item']):
+                    raise ValueError(f"{new_format} in {self.settings.questions_file_name} is not a valid datetime "
+                                     f"format for {question['item']} of field {field_name}.")
+                elif new_format not in self.settings.datetime_formats:
+                    self._add_datetime_format_to_settings(new_format)
+                self.questions.setdefault(field_name, []).append(question)
+
+    def _get_pending_question_items(self):
+        return {(field_name, question['item']) for field_name, questions in self.questions.items()
+                for question in questions if not _is_question_answered(question)}
+
+    def get_pending_questions(self):
+        """The names of the fields that have questions that are not answered yet."""
+        return [field_name for field_name, questions in self.questions.items()
+                if not any(i.get('not_datetime') for i in questions) and
+                not all(map(_is_question_answered, questions))]
+
+    def _write_questions(self):
+        if self.questions:
+            write_toml(self.settings.questions_path, self.questions)
+            pending = self.get_pending_questions()
+            if pending:
+                print(f'The following fields need your input in {self.settings.questions_path}:')
+                print('\n'.join(pending))
+        elif os.path.exists(self.settings.questions_path):
+            os.remove(self.settings.questions_path)
+
+    def _get_ignore_matchers_of_field(self, field_name):
+        return {'DateTimeMatcher'} if field_name in self._fields_not_datetime else None
+
     def _get_stats(self, field_name, items, ignore_matchers=None):
         try:
-            collector = StatsCollector(matchers=matchers_from_settings(self.settings, ignore_matchers=ignore_matchers))
-            for item in items:
+            collector = self._get_stats_collector(ignore_matchers)
+            sample, rest = self._split_training_sample(field_name, items)
+            for item in sample:
                 collector.inspect_item(field_name, item)
+            if rest:
+                collector.end_sample(decided_string_length=self._get_decided_string_length())
+                for item in rest:
+                    collector.inspect_item(field_name, item)
             return collector.collect()
         except UserInferenceRequired as err:
             if err.value_type == HasDateTime:
-                msg = f'field {field_name} has inconsistent datetime data: {item}.'
-                choice = get_user_choice(msg, choices=INVALID_DATETIME_USER_OPTIONS)
-                if choice == 'n':
-                    if ignore_matchers:
-                        ignore_matchers.add('DateTimeMatcher')
-                    else:
-                        ignore_matchers = {'DateTimeMatcher'}
-                else:
-                    msg = f'Please enter the datetime format for {item}'
-                    new_format = get_user_input(msg, validate_func=_is_valid_dateformat, item=item)
-                    if new_format in self.settings.datetime_formats:
-                        raise InconsistentData(f"field {field_name} has inconsistent datetime data: "
-                                               f"{item}. {new_format} was already in your settings.")
-                    print(f'Adding {new_format} to your settings.')
-                    self.settings.datetime_formats.add(new_format)
-                    self._original_settings['datetime_formats'].append(new_format)
-                    write_settings(self.setup_path, self._original_settings)
+                ignore_matchers = self._ask_user_about_datetime(field_name, item, ignore_matchers)
                 return self._get_stats(field_name, items, ignore_matchers)
 
+    def _get_values_of_field_gen(self, path, field_name):
+        """
+        Reads the csv again line by line and yields the values of only one field.
+        """
+        clean_names, reader = self._get_clean_names_and_csv_data_gen(path, line_by_line=True)
+        i = clean_names.index(field_name)
+        for line in reader:
+            if self._does_line_include_data(line) and i < len(line):
+                yield line[i]
+
+    def _inspect_streamed_item(self, collector, field_name, item):
+        collector.inspect_item(field_name, item)
+        if collector.inspected == self.settings.training_sample_size:
+            collector.end_sample(decided_string_length=self._get_decided_string_length())
+
+    def _get_streamed_stats(self, field_name, path, ignore_matchers=None):
+        """
+        Inspects one field by streaming its values from the csv.
+        """
+        try:
+            collector = self._get_stats_collector(ignore_matchers)
+            for item in self._get_values_of_field_gen(path, field_name):
+                self._inspect_streamed_item(collector, field_name, item)
+            return collector.collect()
+        except UserInferenceRequired as err:
+            if err.value_type == HasDateTime:
+                ignore_matchers = self._ask_user_about_datetime(field_name, item, ignore_matchers)
+                return self._get_streamed_stats(field_name, path, ignore_matchers)
+
+    def _get_streamed_stats_per_field(self, path):
+        """
+        Reads the csv line by line only once and inspects the values of all the fields as the lines come in.
+        Each field only keeps the running counters of its collector, so the memory does not grow
+        with the length of the csv. With training_sample_size, the sample is the first values of each field
+        and not a random sample.
+        Fields that need the user's input are inspected again once the user is asked. The fields that
+        can not be inferred are added to the failed_to_infer_fields.
+
+        Yields:
+            tuple: field name and its stats
+        """
+        clean_names, reader = self._get_clean_names_and_csv_data_gen(path, line_by_line=True)
+        collectors = {}
+        fields_needing_input = {}
+        for line in reader:
+            if not self._does_line_include_data(line):
+                continue
+            for i, item in enumerate(line):
+                try:
+                    field_name = clean_names[i]
+                except IndexError:
+                    raise ValueError("Your data might have new lines in the field names. "
+                                     "Please fix that and try again.")
+                if field_name in self.settings.fields_to_be_scrubbed or field_name in fields_needing_input:
+                    continue
+                try:
+                    collector = collectors[field_name]
+                except KeyError:
+                    collector = collectors[field_name] = self._new_stats_collector(
+                        self._get_ignore_matchers_of_field(field_name))
+                try:
+                    self._inspect_streamed_item(collector, field_name, item)
+                except UserInferenceRequired as err:
+                    fields_needing_input[field_name] = (err, item)
+
+        for field_name, collector in collectors.items():
+            if field_name in fields_needing_input:
+                err, item = fields_needing_input[field_name]
+                if err.value_type != HasDateTime:
+                    self.logger.error(f'Unable to understand the field type from the data in {field_name}: {err}')
+                    self.failed_to_infer_fields.add(field_name)
+                    continue
+                ignore_matchers = self._ask_user_about_datetime(
+                    field_name, item, ignore_matchers=self._get_ignore_matchers_of_field(field_name))
+                yield field_name, self._get_streamed_stats(field_name, path, ignore_matchers)
+            else:
+                yield field_name, collector.collect()
+
     def _get_integer_field(self, max_int):
         previous_key = 0
         for field_db_type, key in self.settings.max_int.items():
@@ -327,10 +582,17 @@ class Mapper(Base):
             raise NotImplementedError(f'_get_field_orm_string is not implemented for {orm} orm yet.')
         return result
 
+    def _get_stats_per_field_from_csv(self, path):
+        if self.settings.training_streaming:
+            yield from self._get_streamed_stats_per_field(path)
+        else:
+            all_items = self._get_all_values_per_clean_name(path)
+            for field_name, field_values in all_items.items():
+                yield field_name, self._get_stats(field_name=field_name, items=field_values,
+                                                  ignore_matchers=self._get_ignore_matchers_of_field(field_name))
+
     def _get_field_results_from_csv(self, path):
-        all_items = self._get_all_values_per_clean_name(path)
-        for field_name, field_values in all_items.items():
-            stats = self._get_stats(field_name=field_name, items=field_values)
+        for field_name, stats in self._get_stats_per_field_from_csv(path):
             field_result = self._get_field_result_from_stats(field_name=field_name, stats=stats)
             if field_result:
                 yield field_name, field_result
@@ -349,7 +611,15 @@ class Mapper(Base):
         if os.path.exists(self.settings.overrides_path):
             return load_toml(self.settings.overrides_path, keys_to_convert_to_set=TOML_KEYS_THAT_ARE_SET)
 
+    def _get_analysis_store(self):
+        if self.settings.analysis_store_path:
+            return AnalysisStore(self.settings.analysis_store_path)
+
     def _read_analyzed_csv_results(self):
+        analysis_store = self._get_analysis_store()
+        if analysis_store:
+            csv_names = [os.path.basename(i) for i in self.settings.training_csvs]
+            return analysis_store.read(csv_names, keys_to_convert_to_set=TOML_KEYS_THAT_ARE_SET)
         results = []
         for csv_path in self.settings.training_csvs:
             file_path = self._get_analyzed_file_path_from_csv_path(csv_path)
@@ -368,21 +638,51 @@ class Mapper(Base):
         if not self.settings.training_csvs:
             raise ValueError('The list of training_csvs in the settings file is empty.')
 
+        self._apply_answered_questions()
+        analysis_store = self._get_analysis_store()
         results = []
         for csv_path in self.settings.training_csvs:
 
             csv_path = self._get_csv_full_path(csv_path)
+            csv_name = os.path.basename(csv_path)
             file_path = self._get_analyzed_file_path_from_csv_path(csv_path)
+
+            if analysis_store:
+                fingerprint = get_csv_fingerprint(csv_path, self.settings,
+                                                  fields_not_datetime=self._fields_not_datetime)
+                stored = analysis_store.get(csv_name, fingerprint, keys_to_convert_to_set=TOML_KEYS_THAT_ARE_SET)
+                if stored:
+                    result, csv_empty_fields = stored
+                    self.empty_fields |= csv_empty_fields
+                    results.append(result)
+                    print(f'{csv_name} is not changed since it was analyzed in {self.settings.analysis_store_path}.')
+                    continue
+
+            # The empty fields of each csv are stored with its results.
+            empty_fields, self.empty_fields = self.empty_fields, set()
+            pending_questions = self._get_pending_question_items()
             result = {}
 
             for field_name, field_result in self._get_field_results_from_csv(csv_path):
                 result[field_name] = named_tuple_to_compact_dict(field_result)
 
-            write_toml(file_path, result, auto_generated_from=os.path.basename(csv_path),
-                       keys_to_convert_to_list=TOML_KEYS_THAT_ARE_SET)
+            csv_empty_fields = self.empty_fields
+            self.empty_fields = empty_fields | csv_empty_fields
+
+            if analysis_store:
+                # The csvs that have new questions are analyzed again until the questions are answered.
+                if self._get_pending_question_items() - pending_questions:
+                    fingerprint = None
+                analysis_store.write(csv_name, result, fingerprint=fingerprint, empty_fields=csv_empty_fields)
+                print(f'{csv_name} updated in {self.settings.analysis_store_path}.')
+            else:
+                write_toml(file_path, result, auto_generated_from=os.path.basename(csv_path),
+                           keys_to_convert_to_list=TOML_KEYS_THAT_ARE_SET)
+                print(f'{file_path} updated.')
 
             results.append(result)
-            print(f'{file_path} updated.')
+
+        self._write_questions()
 
         overrides = self._get_overrides()
 
@@ -394,6 +694,17 @@ class Mapper(Base):
 
         return results
 
+    def export_analysis(self):
+        """Writes the analyzed results in the analysis store into the toml files for review."""
+        analysis_store = self._get_analysis_store()
+        if not analysis_store:
+            raise ValueError('The analysis_store is not set in the settings file.')
+        for csv_path, result in zip(self.settings.training_csvs, self._read_analyzed_csv_results()):
+            file_path = self._get_analyzed_file_path_from_csv_path(csv_path)
+            write_toml(file_path, result, auto_generated_from=os.path.basename(csv_path),
+                       keys_to_convert_to_list=TOML_KEYS_THAT_ARE_SET)
+            print(f'{file_path} updated.')
+
     def _combine_analyzed_csvs(self, analyzed_results_all, overrides=None):
         results = {}
         for analyzed_results in analyzed_results_all:
@@ -441,8 +752,86 @@ class Mapper(Base):
                         self.empty_fields.remove(field_name)
         return results
 
-    def combine_results(self):
-        analyzed_results_all = self._read_analyzed_csv_results()
+    def get_partial_stats(self, csv_paths=None, shard_index=0, shard_count=1):
+        """Collects the stats of the fields from a shard of the data. The partial stats of all the shards
+        can be computed on different machines and then merged with :meth:`merge_partial_stats`.
+
+        Args:
+            csv_paths: The csvs of this shard. Defaults to the training_csvs in the settings.
+            shard_index: Only every shard_count-th row starting from this index is inspected.
+            shard_count: The number of shards that the rows of the csvs are split into.
+
+        Returns:
+            dict: field name to its FieldStats.
+        """
+        csv_paths = csv_paths or self.settings.training_csvs
+        if not csv_paths:
+            raise ValueError('The list of training_csvs in the settings file is empty.')
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f'The shard index {shard_index} is not in the range of {shard_count} shards.')
+
+        self._apply_answered_questions()
+        self.row_shard = (shard_index, shard_count) if shard_count > 1 else None
+        all_stats = {}
+        try:
+            for csv_path in csv_paths:
+                csv_path = self._get_csv_full_path(csv_path)
+                for field_name, stats in self._get_stats_per_field_from_csv(csv_path):
+                    if field_name in all_stats:
+                        stats = merge_field_stats([all_stats[field_name], stats], field_name=field_name)
+                    all_stats[field_name] = stats
+        finally:
+            self.row_shard = None
+        self._write_questions()
+        return all_stats
+
+    def write_partial_stats(self, path, all_stats):
+        contents = {
+            'identifier': self.settings.identifier,
+            'fields': {i: field_stats_to_dict(v) for i, v in all_stats.items()},
+        }
+        with open(path, 'w') as the_file:
+            json.dump(contents, the_file, indent=2, sort_keys=True)
+        print(f'{path} written.')
+
+    def load_partial_stats(self, path):
+        with open(path, 'r') as the_file:
+            contents = json.load(the_file)
+        if contents['identifier'] != self.settings.identifier:
+            raise ValueError(f"{path} has the partial stats of {contents['identifier']} "
+                             f"and not {self.settings.identifier}.")
+        return {i: field_stats_from_dict(v) for i, v in contents['fields'].items()}
+
+    def merge_partial_stats(self, all_partials):
+        """Merges the partial stats of the shards.
+
+        Returns:
+            dict: field name to its merged FieldStats.
+        """
+        stats_per_field = {}
+        for partial in all_partials:
+            for field_name, stats in partial.items():
+                stats_per_field.setdefault(field_name, []).append(stats)
+        return {field_name: merge_field_stats(all_stats, field_name=field_name)
+                for field_name, all_stats in stats_per_field.items()}
+
+    def run_from_partial_stats(self, paths):
+        """
+        Merges the partial stats files, decides the field types based on the merged stats and
+        writes the combined python module and the ORM model.
+        """
+        merged = self.merge_partial_stats(self.load_partial_stats(path) for path in paths)
+        result = {}
+        for field_name, stats in merged.items():
+            field_result = self._get_field_result_from_stats(field_name=field_name, stats=stats)
+            if field_result:
+                result[field_name] = named_tuple_to_compact_dict(field_result)
+        self.combine_results(analyzed_results_all=[result])
+        self.write_orm_model()
+
+    def combine_results(self, analyzed_results_all=None):
+        if analyzed_results_all is None:
+            analyzed_results_all = self._read_analyzed_csv_results()
         overrides = self._get_overrides()
         combined_results = self._combine_analyzed_csvs(analyzed_results_all, overrides)
         for field_name in self.empty_fields:
@@ -466,6 +855,11 @@ class Mapper(Base):
     def run(self):
         try:
             self.analyze()
+            if self.get_pending_questions():
+                # The values in question are counted as strings until they are answered.
+                print(f'The combined module and the ORM model are not written until the questions in '
+                      f'{self.settings.questions_path} are answered. Then run it again.')
+                return
             self.empty_fields = self.empty_fields - (
                 self.failed_to_infer_fields |
                 set(self.solid_decisions.keys()) |
@@ -484,7 +878,8 @@ class Mapper(Base):
                 print("The following fields failed:")
                 print('\n'.join(self.failed_to_infer_fields))
                 msg = f'Please provide the overrides for these fields in {self.settings.overrides_file_name}\n'
-                get_user_choice(msg, choices=CONTINUE_OR_ABORT_OPTIONS)
+                if not self.non_interactive:
+                    get_user_choice(msg, choices=CONTINUE_OR_ABORT_OPTIONS)
                 print("")
 
             if self.questionable_fields:
@@ -493,7 +888,8 @@ class Mapper(Base):
                 print(tabulate(self.questionable_fields.values(), headers=headers))
                 msg = ("Please verify the fields and provide the overrides if "
                        f"necessary in {self.settings.overrides_file_name}")
-                get_user_choice(msg, choices=CONTINUE_OR_ABORT_OPTIONS)
+                if not self.non_interactive:
+                    get_user_choice(msg, choices=CONTINUE_OR_ABORT_OPTIONS)
                 print("")
 
             self.combine_results()
@@ -0,0 +1,180 @@
+"""
+Opt-in memory profiling of the ETL and cleaning stages.
+
+The tracemalloc mode measures the memory that Python allocates and finds the top allocation sites of
+each stage. The rss mode measures the resident memory of the process which is what the container limit
+applies to. It is cheaper but only sees the memory at the stage boundaries unless the stage sets a new
+peak for the process.
+"""
+import os
+import logging
+import tracemalloc
+from contextlib import contextmanager
+
+from tabulate import tabulate
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MEMORY_PROFILING_MODES = ('tracemalloc', 'rss')
+
+logger = logging.getLogger(__name__)
+
+
+def get_rss_bytes():
+    """
+    The current resident memory of the process. Falls back to the peak if the current is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as the_file:
+            return int(the_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return get_max_rss_bytes()
+
+
+def get_max_rss_bytes():
+    if resource is None:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # It is in bytes on macOS and kilobytes on Linux.
+    return max_rss if os.uname().sysname == 'Darwin' else max_rss * 1024
+
+
+class _Frame:
+
+    __slots__ = ('peak', 'snapshot')
+
+    def __init__(self, peak, snapshot=None):
+        self.peak = peak
+        self.snapshot = snapshot
+
+
+class MemoryProfiler:
+    """
+    Records the peak and retained bytes of each stage and the top allocation sites in the tracemalloc mode.
+    A warning is logged once per stage when its peak goes above warning_bytes.
+
+    The top allocation sites are taken from the first call of each stage, so stages that run many times
+    such as the chunk inserts do not take a snapshot every time.
+    """
+
+    def __init__(self, mode='tracemalloc', warning_bytes=0, top_sites=5):
+        if mode not in MEMORY_PROFILING_MODES:
+            raise ValueError(f"The memory profiling mode of {mode} is invalid. "
+                             f"Options are: {', '.join(MEMORY_PROFILING_MODES)}")
+        self.mode = mode
+        self.warning_bytes = warning_bytes
+        self.top_sites = top_sites
+        self._started = 0
+        self._started_tracemalloc = False
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+        self.warnings = []
+        self._stack = []
+
+    def start(self):
+        """
+        Starts tracing if it is not already started. The calls can be nested and each needs a stop.
+        """
+        if self.mode == 'tracemalloc' and not self._started and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._started += 1
+
+    def stop(self):
+        self._started = max(self._started - 1, 0)
+        if not self._started and self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _get_current_and_peak(self):
+        if self.mode == 'tracemalloc':
+            return tracemalloc.get_traced_memory()
+        current = get_rss_bytes()
+        return current, max(current, get_max_rss_bytes())
+
+    def _fold_peak(self):
+        """
+        Updates the peak of all the open stages before the peak is reset for a nested stage.
+        """
+        current, peak = self._get_current_and_peak()
+        for frame in self._stack:
+            frame.peak = max(frame.peak, peak)
+        if self.mode == 'tracemalloc' and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        return current
+
+    def _is_tracing(self):
+        return self.mode == 'rss' or tracemalloc.is_tracing()
+
+    @contextmanager
+    def stage(self, stage):
+        if not self._is_tracing():
+            yield
+            return
+        stats = self.stats.setdefault(stage, {'calls': 0, 'peak_bytes': 0, 'retained_bytes': 0, 'top_sites': []})
+        take_snapshot = self.mode == 'tracemalloc' and self.top_sites and not stats['calls']
+        before = self._fold_peak()
+        if self.mode == 'rss':
+            # The process peak only tells about this stage if the stage goes above it.
+            max_rss_before = get_max_rss_bytes()
+        frame = _Frame(peak=before, snapshot=tracemalloc.take_snapshot() if take_snapshot else None)
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            after = self._fold_peak()
+            self._stack.pop()
+            if self.mode == 'rss' and frame.peak <= max_rss_before:
+                frame.peak = max(before, after)
+            stats['calls'] += 1
+            stats['peak_bytes'] = max(stats['peak_bytes'], frame.peak)
+            stats['retained_bytes'] += after - before
+            if frame.snapshot is not None:
+                stats['top_sites'] = self._get_top_sites(frame.snapshot)
+            self._check_warning(stage, frame.peak)
+
+    def _get_top_sites(self, snapshot_before):
+        diff = tracemalloc.take_snapshot().compare_to(snapshot_before, 'lineno')
+        return [(str(i.traceback[0]), i.size_diff) for i in diff[:self.top_sites] if i.size_diff > 0]
+
+    def _check_warning(self, stage, peak):
+        if self.warning_bytes and peak >= self.warning_bytes and stage not in {i[0] for i in self.warnings}:
+            self.warnings.append((stage, peak))
+            logger.warning(f'The {stage} stage used {peak:,} bytes of memory ({self.mode}) which is above '
+                           f'the memory_warning_bytes of {self.warning_bytes:,}.')
+
+    def to_dict(self):
+        return {stage: dict(stats) for stage, stats in self.stats.items()}
+
+    def get_report_str(self):
+        table = []
+        for stage, stats in self.stats.items():
+            sites = '\n'.join(f'{site} {size:,}' for site, size in stats['top_sites'])
+            table.append([stage, stats['calls'], f"{stats['peak_bytes']:,}", f"{stats['retained_bytes']:,}", sites])
+        return tabulate(table, headers=['stage', 'calls', 'peak bytes', 'retained bytes', 'top allocation sites'])
+
+
+def get_memory_profiler(settings):
+    """
+    Returns the memory profiler based on the memory_profiling settings or None if it is not enabled.
+    """
+    if not settings.memory_profiling:
+        return None
+    return MemoryProfiler(mode=settings.memory_profiling, warning_bytes=settings.memory_warning_bytes)
+
+
+@contextmanager
+def profile_stage(profiler, stage):
+    """
+    Profiles the block as the stage if there is a memory profiler.
+    """
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(stage):
+            yield
@@ -0,0 +1,251 @@
+"""
+Counters and histograms of the ETL jobs in the Prometheus text format.
+
+The metrics can be written to a file, for example for the textfile collector of the node exporter,
+or served over a local HTTP endpoint. Share one EtlMetrics between the jobs of a process so all of
+them are exported together with the job label.
+"""
+import os
+import re
+import tempfile
+import threading
+from bisect import bisect_left
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+METRIC_NAME_REGEX = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    items = ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in labels)
+    return f'{{{items}}}'
+
+
+class _Metric:
+
+    TYPE = None
+
+    def __init__(self, name, documentation, label_names=()):
+        if not METRIC_NAME_REGEX.match(name):
+            raise ValueError(f'{name} is not a valid metric name.')
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def _get_label_values(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} needs the labels of {self.label_names}. Got {tuple(labels)}.')
+        return tuple(str(labels[i]) for i in self.label_names)
+
+    def _get_header_lines(self):
+        documentation = self.documentation.replace('\\', r'\\').replace('\n', r'\n')
+        return [f'# HELP {self.name} {documentation}', f'# TYPE {self.name} {self.TYPE}']
+
+    def get_lines(self):
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counters can only be increased.')
+        key = self._get_label_values(labels)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+    def get_value(self, **labels):
+        return self._samples.get(self._get_label_values(labels), 0)
+
+    def get_lines(self):
+        lines = self._get_header_lines()
+        with self._lock:
+            for key, value in sorted(self._samples.items()):
+                labels = _format_labels(zip(self.label_names, key))
+                lines.append(f'{self.name}{labels} {_format_value(value)}')
+        return lines
+
+
+class Histogram(_Metric):
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names=label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._get_label_values(labels)
+        with self._lock:
+            try:
+                sample = self._samples[key]
+            except KeyError:
+                sample = self._samples[key] = {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                sample['buckets'][index] += 1
+            sample['sum'] += value
+            sample['count'] += 1
+
+    def get_count(self, **labels):
+        sample = self._samples.get(self._get_label_values(labels))
+        return sample['count'] if sample else 0
+
+    def get_lines(self):
+        lines = self._get_header_lines()
+        with self._lock:
+            for key, sample in sorted(self._samples.items()):
+                label_items = list(zip(self.label_names, key))
+                cumulative = 0
+                for bucket, count in zip(self.buckets, sample['buckets']):
+                    cumulative += count
+                    labels = _format_labels(label_items + [('le', _format_value(float(bucket)))])
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _format_labels(label_items + [('le', '+Inf')])
+                lines.append(f"{self.name}_bucket{labels} {sample['count']}")
+                labels = _format_labels(label_items)
+                lines.append(f"{self.name}_sum{labels} {_format_value(sample['sum'])}")
+                lines.append(f"{self.name}_count{labels} {sample['count']}")
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, klass, name, *args, **kwargs):
+        with self._lock:
+            try:
+                metric = self._metrics[name]
+            except KeyError:
+                metric = self._metrics[name] = klass(name, *args, **kwargs)
+        if not isinstance(metric, klass):
+            raise ValueError(f'{name} is already registered as a {metric.TYPE}.')
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._get_or_create(Counter, name, documentation, label_names=label_names)
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, label_names=label_names, buckets=buckets)
+
+    def get_text(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.get_lines())
+        return '\n'.join(lines) + '\n'
+
+    def write_text_file(self, path):
+        """
+        Writes the metrics into the file. The file is replaced at once so it is never read half written.
+        """
+        dir_name = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('w', dir=dir_name, suffix='.tmp', delete=False) as the_file:
+            the_file.write(self.get_text())
+        os.replace(the_file.name, path)
+
+    def serve(self, port=9100, host='127.0.0.1'):
+        """
+        Serves the metrics over HTTP in a daemon thread. Call shutdown() on the returned server to stop it.
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                content = registry.get_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+
+class _JobStageSink:
+
+    def __init__(self, metrics, job):
+        self.metrics = metrics
+        self.job = job
+
+    def record(self, stage, metrics):
+        self.metrics.record_stage(self.job, stage, metrics)
+
+
+class EtlMetrics(MetricsRegistry):
+    """
+    The metrics of the ETL jobs. Pass it as the metrics kwarg of the ETL.
+    """
+
+    def __init__(self, prefix='modelmapper_etl'):
+        super().__init__()
+        self.rows_inserted = self.counter(
+            f'{prefix}_rows_inserted_total', 'Rows inserted into the database.', ['job'])
+        self.rows_existing = self.counter(
+            f'{prefix}_rows_existing_total', 'Rows that already existed in the database and were not inserted.',
+            ['job'])
+        self.casting_errors = self.counter(
+            f'{prefix}_casting_errors_total', 'Values that could not be cast to the type of their field.',
+            ['job', 'field_name'])
+        self.bytes_downloaded = self.counter(
+            f'{prefix}_bytes_downloaded_total', 'Bytes of raw data received from the client.', ['job'])
+        self.stage_seconds = self.histogram(
+            f'{prefix}_stage_seconds', 'Wall time of the ETL stages.', ['job', 'stage'])
+        self.stage_rows = self.counter(
+            f'{prefix}_stage_rows_total', 'Rows processed by the ETL stages.', ['job', 'stage'])
+        self.runs = self.counter(
+            f'{prefix}_runs_total', 'ETL runs by their result.', ['job', 'result'])
+
+    def get_stage_sink(self, job):
+        """
+        Returns a sink for the EtlInstrumentation that records the stages under the job.
+        """
+        return _JobStageSink(self, job)
+
+    def record_stage(self, job, stage, metrics):
+        self.stage_seconds.observe(metrics.wall_seconds, job=job, stage=stage)
+        if metrics.rows:
+            self.stage_rows.inc(metrics.rows, job=job, stage=stage)
+        if stage == 'download' and metrics.bytes:
+            self.bytes_downloaded.inc(metrics.bytes, job=job)
+
+    def record_load(self, job, rows_inserted, rows_existing):
+        self.rows_inserted.inc(rows_inserted, job=job)
+        self.rows_existing.inc(rows_existing, job=job)
+
+    def record_casting_errors(self, job, counts_per_field):
+        for field_name, count in counts_per_field.items():
+            self.casting_errors.inc(count, job=job, field_name=field_name)
+
+    def record_run(self, job, result):
+        self.runs.inc(job=job, result=result)
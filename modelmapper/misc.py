@@ -1,6 +1,7 @@
 import re
 import clevercsv as csv
 import io
+import codecs
 import os
 import string
 import enum
@@ -20,6 +21,10 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 START_LINE = "    # --------- THE FOLLOWING FIELDS ARE AUTOMATICALLY GENERATED. DO NOT CHANGE THEM OR REMOVE THIS LINE. {} --------\n"
 END_LINE = "    # --------- THE ABOVE FIELDS ARE AUTOMATICALLY GENERATED. DO NOT CHANGE THEM OR REMOVE THIS LINE. {} --------\n"
 CHUNK_SIZE = 2048  # The chunk needs to be big enough that covers a couple of rows of data.
+ENCODING_SAMPLE_SIZE = 65536  # The bytes at the start of a file that its encoding is detected from.
+# The bytes that can not be decoded with the encoding of a file that is read line by line are decoded with this.
+FALLBACK_ENCODING = 'cp1252'
+FALLBACK_DECODE_ERRORS = 'modelmapper_fallback'
 
 
 valid_chars_for_string = set(string.ascii_letters.lower())
@@ -293,6 +298,21 @@ def read_csv_gen(path_or_stringio, **kwargs):
         raise TypeError('Either a path to the file or StringIO object needs to be passed.')
 
 
+def read_csv_lines_gen(path, **kwargs):
+    """
+    Takes a path to a file and creates a CSV generator that reads the file line by line, instead of decoding
+    the whole file into memory like read_csv_gen. The encoding is detected from the start of the file.
+    """
+    _check_file_exists(path)
+    with open(path, 'rb') as csvfile:
+        encoding = get_encoding_of_bytes(csvfile.read(ENCODING_SAMPLE_SIZE))
+    # The universal newlines mode turns \r\n and \r into \n since the sniffer has problems with \r.
+    # The bytes after the start of the file that are not in its encoding are decoded with the FALLBACK_ENCODING.
+    with open(path, 'r', encoding=encoding, errors=FALLBACK_DECODE_ERRORS) as csvfile:
+        for row in find_header(csvfile, **kwargs):
+            yield row
+
+
 def named_tuple_to_compact_dict(named_tuple_obj, include_enums=False):
     """
     Convert new style of Named Tuple with defaults into dictionary
@@ -448,6 +468,42 @@ BIG_ENDIAN_HEADER = b'\xfe\xff'
 LITTLE_ENDIAN_HEADER = b'\xff\xfe'
 UTF8_HEADER = b'\xef\xbb\xbf'
 
+def get_encoding_of_bytes(content):
+    """
+    The encoding that decode_bytes would use for the content. It works on the start of the content too,
+    but the encoding is then only detected from that part.
+    """
+    if content.startswith(UTF8_HEADER):
+        return 'utf-8-sig'
+    if content.startswith(BIG_ENDIAN_HEADER) or content.startswith(LITTLE_ENDIAN_HEADER):
+        # The utf-16 codec gets the byte order from the header and skips it.
+        return 'utf-16'
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(content, final=False)
+    except UnicodeDecodeError:
+        # cchardet returns None when it can not tell the encoding.
+        return cchardet.detect(content)['encoding'] or FALLBACK_ENCODING
+    return 'utf-8'
+
+
+def _decode_with_fallback(err):
+    """
+    Codecs error handler that decodes the bytes that are not in the encoding with the FALLBACK_ENCODING,
+    or latin-1 for the few bytes that are not in the FALLBACK_ENCODING either.
+    """
+    if not isinstance(err, UnicodeDecodeError):
+        raise err
+    content = err.object[err.start:err.end]
+    logger.debug(f'{content!r} is not {err.encoding}. Decoding it as {FALLBACK_ENCODING}.')
+    try:
+        return content.decode(FALLBACK_ENCODING), err.end
+    except UnicodeDecodeError:
+        return content.decode('latin-1'), err.end
+
+
+codecs.register_error(FALLBACK_DECODE_ERRORS, _decode_with_fallback)
+
+
 def decode_bytes(content):
     try:
         if content.startswith(UTF8_HEADER):
@@ -0,0 +1,85 @@
+"""
+Serializes the cleaned rows into the text format of the PostgreSQL COPY command.
+The rows are serialized as they are read so the whole chunk is never in memory as text.
+"""
+import json
+import datetime
+from decimal import Decimal
+
+COPY_NULL = '\\N'
+COPY_BUFFER_SIZE = 65536
+
+# Backslash needs to be escaped first.
+COPY_TEXT_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'))
+
+
+def _escape_copy_text(value):
+    for character, escaped in COPY_TEXT_ESCAPES:
+        if character in value:
+            value = value.replace(character, escaped)
+    return value
+
+
+def get_copy_text_value(value):
+    """
+    Returns the value in the COPY text format.
+    """
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, float, Decimal)):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # The bytea hex format with its backslash escaped.
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return _escape_copy_text(str(value))
+
+
+def get_copy_text_line(row, columns):
+    """
+    Returns the line of the row in the COPY text format. The missing fields are null.
+    """
+    return '\t'.join(get_copy_text_value(row.get(column)) for column in columns) + '\n'
+
+
+class CopyTextBuffer:
+    """
+    A file like object of the rows in the COPY text format that the driver reads from.
+    """
+
+    def __init__(self, rows, columns):
+        self._lines = (get_copy_text_line(row, columns) for row in rows)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buffer + ''.join(self._lines)
+            self._buffer = ''
+            return data
+        pieces = [self._buffer]
+        length = len(self._buffer)
+        for line in self._lines:
+            pieces.append(line)
+            length += len(line)
+            if length >= size:
+                break
+        data = ''.join(pieces)
+        self._buffer = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        while '\n' not in self._buffer:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        index = self._buffer.find('\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            index = min(index, size)
+        data, self._buffer = self._buffer[:index], self._buffer[index:]
+        return data
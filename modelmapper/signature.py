@@ -1,4 +1,5 @@
-from collections import Mapping
+import sys
+from collections import Mapping, OrderedDict
 from decimal import Decimal
 
 import mmh3
@@ -9,8 +10,11 @@ BITS_MAP = {
     128: 'hash128',
 }
 
+SIGNATURE_FORMATS = ('hex', 'int', 'bytes')
 
-def generate_row_signature(row, model=None, ignore_fields=None, signature_size=128, x64arch=True):
+
+def generate_row_signature(row, model=None, ignore_fields=None, signature_size=128, x64arch=True,
+                           signature_format='hex'):
     """ Generates a hash of the given row
         Arguments:
             row: A dictionary or list of tuples
@@ -18,26 +22,29 @@ def generate_row_signature(row, model=None, ignore_fields=None, signature_size=1
             ignore_fields: Fields to be ignored in the calcuation of the hash
             signature_size: Options between 32, 64 and 128 bytes
             x64arch: A murmur flag to optimize between x86 and x64 operating systems
+            signature_format: Options between hex, int and bytes
         Returns:
-            Integer: the hash value of the given row
+            String: the hash value of the given row in hex, or an integer or bytes based on the signature_format
     """
-    if isinstance(row, list):
-        for each in row:
-            if not isinstance(each, tuple) or len(each) != 2:
-                raise TypeError("row must either be a dictionary or a list of tuples each with a size of 2")
-        row_dict = dict(row)
-    elif isinstance(row, Mapping):
-        row_dict = row
-    else:
-        raise TypeError('Row needs to be a list of tuples or a dictionary')
-
+    row_dict = _get_row_dict(row)
     default_dropped_row = drop_model_defaults(row_dict, model)
     normalized_row = normalize_decimal_columns(default_dropped_row)
     sorted_row = sort_row_values(normalized_row)
     row_bytes = get_byte_str_of_row(sorted_row, ignore_fields)
     if signature_size >= 64:
-        return get_hash_of_bytes(row_bytes, bits=signature_size, x64arch=x64arch)
-    return get_hash_of_bytes(row_bytes, bits=signature_size)
+        return get_hash_of_bytes(row_bytes, bits=signature_size, signature_format=signature_format, x64arch=x64arch)
+    return get_hash_of_bytes(row_bytes, bits=signature_size, signature_format=signature_format)
+
+
+def _get_row_dict(row):
+    if isinstance(row, list):
+        for each in row:
+            if not isinstance(each, tuple) or len(each) != 2:
+                raise TypeError("row must either be a dictionary or a list of tuples each with a size of 2")
+        return dict(row)
+    elif isinstance(row, Mapping):
+        return row
+    raise TypeError('Row needs to be a list of tuples or a dictionary')
 
 
 def normalize_decimal_columns(row):
@@ -81,12 +88,155 @@ def get_byte_str_of_row(row, ignore_fields=[]):
     return row_bytes
 
 
-def get_hash_of_bytes(item, bits=128, **kwargs):
+def get_hash_of_bytes(item, bits=128, signature_format='hex', **kwargs):
     """Run selected  Murmur Hash function on given byte string"""
     hash_type = BITS_MAP.get(int(bits))
     if hash_type is None:
         raise ValueError(f'get_hash_of_bytes only accepts: 32, 64, or 128 as bits values. Given: {bits}')
-    hash_value = getattr(mmh3, hash_type)(item, **kwargs)
+    return _get_hash_value_formatter(bits, signature_format)(getattr(mmh3, hash_type)(item, **kwargs))
+
+
+def _hash_value_to_str(hash_value):
     if isinstance(hash_value, tuple):
         return hex(hash_value[0])[2:]  # removing the 0x from the beginning of the hex
     return hex(hash_value)[2:]
+
+
+def _hash_value_to_int(hash_value):
+    """The 32 and 64 bit values are signed so they fit in Integer and BigInteger columns."""
+    if isinstance(hash_value, tuple):
+        return hash_value[0]
+    return hash_value
+
+
+def _get_hash_value_formatter(bits, signature_format):
+    if signature_format == 'hex':
+        return _hash_value_to_str
+    if signature_format == 'int':
+        return _hash_value_to_int
+    if signature_format == 'bytes':
+        mask = (1 << bits) - 1
+        size = bits // 8
+        return lambda hash_value: (_hash_value_to_int(hash_value) & mask).to_bytes(size, 'big')
+    raise ValueError(f"The signature_format of {signature_format} is invalid. "
+                     f"Options are: {', '.join(SIGNATURE_FORMATS)}")
+
+
+class BoundedSignatureSet:
+    """
+    A set of the signatures seen in a run that keeps about max_bytes of them in memory. Once it is full,
+    the least recently seen signatures are evicted. A duplicate of an evicted signature is then not caught
+    in memory and is left to the database. A max_bytes of 0 means it is not bounded.
+    """
+
+    # The memory that each signature takes in the OrderedDict on top of the signature itself.
+    ENTRY_OVERHEAD_BYTES = 100
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self._signatures = OrderedDict()
+
+    def __contains__(self, signature):
+        if signature in self._signatures:
+            self._signatures.move_to_end(signature)
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def add(self, signature):
+        if signature in self._signatures:
+            self._signatures.move_to_end(signature)
+            return
+        self._signatures[signature] = None
+        self.bytes += sys.getsizeof(signature) + self.ENTRY_OVERHEAD_BYTES
+        while self.max_bytes and self.bytes > self.max_bytes and len(self._signatures) > 1:
+            evicted, _ = self._signatures.popitem(last=False)
+            self.bytes -= sys.getsizeof(evicted) + self.ENTRY_OVERHEAD_BYTES
+            self.evictions += 1
+
+    def update(self, signatures):
+        for signature in signatures:
+            self.add(signature)
+
+
+class SignaturePlan:
+    """
+    Generates the same signatures as generate_row_signature but the work that only depends on the model
+    and the settings is done once: the columns are sorted and their defaults and the ignored fields are
+    looked up when the plan is made. Make one plan per model and reuse it for all the rows.
+
+    Without a model, the order of the keys is kept per set of keys the rows have.
+    """
+
+    MAX_KEY_ORDERS = 100
+
+    def __init__(self, model=None, ignore_fields=None, signature_size=128, x64arch=True, signature_format='hex'):
+        hash_type = BITS_MAP.get(int(signature_size))
+        if hash_type is None:
+            raise ValueError(f'SignaturePlan only accepts: 32, 64, or 128 as signature_size values. '
+                             f'Given: {signature_size}')
+        self._hash_func = getattr(mmh3, hash_type)
+        self._format_hash_value = _get_hash_value_formatter(int(signature_size), signature_format)
+        self._hash_kwargs = {'x64arch': x64arch} if signature_size >= 64 else {}
+        self.ignore_fields = frozenset(ignore_fields or ())
+        self._key_orders = {}
+        if model is None:
+            self.columns = None
+        else:
+            columns = sorted((column for column in model.__table__.columns
+                              if column.description not in self.ignore_fields),
+                             key=lambda column: str(column.description))
+            self.columns = [
+                (column.description, f'{column.description}:'.encode('utf-8'),
+                 column.default is not None, None if column.default is None else column.default.arg)
+                for column in columns
+            ]
+
+    def _get_key_order(self, row):
+        keys = tuple(row)
+        try:
+            return self._key_orders[keys]
+        except KeyError:
+            pass
+        if len(self._key_orders) >= self.MAX_KEY_ORDERS:
+            self._key_orders.clear()
+        order = self._key_orders[keys] = [
+            (key, f'{key}:'.encode('utf-8')) for key in sorted(keys, key=str) if key not in self.ignore_fields]
+        return order
+
+    def get_byte_str_of_row(self, row):
+        row = row if type(row) is dict else _get_row_dict(row)
+        items = []
+        if self.columns is None:
+            for key, prefix in self._get_key_order(row):
+                value = row[key]
+                if value is not None:
+                    if isinstance(value, Decimal):
+                        value = value.normalize()
+                    items.append(prefix + f'{value}'.encode('utf-8'))
+        else:
+            for key, prefix, has_default, default in self.columns:
+                try:
+                    value = row[key]
+                except KeyError:
+                    continue
+                if value is not None and (not has_default or value != default):
+                    if isinstance(value, Decimal):
+                        value = value.normalize()
+                    items.append(prefix + f'{value}'.encode('utf-8'))
+        return b','.join(items)
+
+    def generate_signature(self, row):
+        return self._format_hash_value(self._hash_func(self.get_byte_str_of_row(row), **self._hash_kwargs))
+
+    def generate_signatures(self, rows):
+        """
+        Returns the signatures of a chunk of rows in the same order as the rows.
+        """
+        hash_func, hash_kwargs, get_byte_str_of_row = self._hash_func, self._hash_kwargs, self.get_byte_str_of_row
+        format_hash_value = self._format_hash_value
+        return [format_hash_value(hash_func(get_byte_str_of_row(row), **hash_kwargs)) for row in rows]
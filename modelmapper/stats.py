@@ -1,8 +1,11 @@
+import re
 import decimal
 import datetime
 from collections import Counter
+from functools import lru_cache
 from typing import Any, NamedTuple
-from modelmapper.misc import MONTH_OR_DAY_REGEX, add_strings_and_integers_to_set, MAX_DATE_INTEGER, MIN_DATE_INTEGER
+from modelmapper.misc import (MONTH_OR_DAY_REGEX, add_strings_and_integers_to_set, MAX_DATE_INTEGER, MIN_DATE_INTEGER,
+                              cached_property)
 
 from modelmapper.normalization import normalize_numberic_values
 from modelmapper.types import (
@@ -44,6 +47,51 @@ class InconsistentData(ValueError):
     pass
 
 
+class InspectedItem:
+    """
+    A value of a field that is normalized and classified only once, no matter how many matchers look at it.
+
+    >>> InspectedItem('$1.50').has_dollar
+    True
+    """
+    def __init__(self, item):
+        self.item = item
+        self.normalized = item.lower().strip()
+        self.chars = frozenset(self.normalized)
+        self.length = len(self.normalized)
+        self.has_digit = any(i.isdigit() for i in self.chars)
+        self.has_alpha = any(i.isalpha() for i in self.chars)
+        self.has_dollar = '$' in self.chars
+        self.has_percent = '%' in self.chars
+        self.has_dot = '.' in self.chars
+        self.has_slash = '/' in self.chars
+        self.has_colon = ':' in self.chars
+
+    @cached_property
+    def numeric(self):
+        """
+        The item without the numeric formatting such as $, % and commas.
+        It is only computed once no matter how many numeric matchers look at it.
+        """
+        return normalize_numberic_values(self.normalized, absolute=True)
+
+    @cached_property
+    def positive_int(self):
+        try:
+            return int(self.numeric)
+        except ValueError:
+            return False
+
+    @cached_property
+    def positive_decimal(self):
+        if not self.has_dot:
+            return False
+        try:
+            return decimal.Decimal(self.numeric)
+        except decimal.InvalidOperation:
+            return False
+
+
 class TypeMatcher:
     """
     Matches a value to a type
@@ -51,6 +99,19 @@ class TypeMatcher:
     def match(self, item):
         return self._match(self.__normalize(item))
 
+    def match_inspected(self, inspected):
+        """
+        Matches an :class:`.InspectedItem` that is already normalized.
+        """
+        return self.could_match(inspected) and self._match(inspected.normalized)
+
+    def could_match(self, inspected):
+        """
+        Subclasses can override this to rule out the items that can never match
+        based on how the :class:`.InspectedItem` is classified.
+        """
+        return True
+
     def is_exclusive(self, item=None):
         """
         Return True if a match of this type should be the _only_ reported type for a field
@@ -63,6 +124,13 @@ class TypeMatcher:
         """
         return False
 
+    def end_sample(self):
+        """
+        Called once the training sample of the field is inspected. Subclasses can narrow
+        down what they check for the rest of the values.
+        """
+        pass
+
     def __normalize(self, item):
         """
         Default normalization, lowercases and strips the field.
@@ -86,6 +154,13 @@ class TypeAccumulator:
         """
         return False
 
+    def inspect_inspected(self, field_name, inspected):
+        """
+        Inspects an :class:`.InspectedItem`. Subclasses can override this to reuse
+        what was already computed for the item while matching it.
+        """
+        return self.inspect(field_name, inspected.item)
+
     def collect(self):
         """
         Sets the value of a field on the FieldStats object
@@ -129,6 +204,9 @@ class ContainsMatcher(TypeMatcher):
     def _match(self, item):
         return self.contains in item
 
+    def could_match(self, inspected):
+        return len(self.contains) != 1 or self.contains in inspected.chars
+
 
 class NullMatcher(InMatcher):
     """
@@ -231,9 +309,18 @@ class PositiveIntMatcher(TypeMatcher, TypeAccumulator):
     def _match(self, item):
         return self._get_positive_int(item) is not False
 
+    def match_inspected(self, inspected):
+        return inspected.has_digit and inspected.positive_int is not False
+
+    def could_match(self, inspected):
+        return inspected.has_digit
+
     def inspect(self, field_name, item):
         self.max_int = max(self._get_positive_int(item), self.max_int)
 
+    def inspect_inspected(self, field_name, inspected):
+        self.max_int = max(inspected.positive_int, self.max_int)
+
     def collect(self):
         return {'max_int': self.max_int }
 
@@ -279,8 +366,19 @@ class PositiveDecimalMatcher(TypeMatcher, TypeAccumulator):
     def _match(self, item):
         return self._get_positive_decimal(item) is not False
 
+    def match_inspected(self, inspected):
+        return inspected.has_digit and inspected.positive_decimal is not False
+
+    def could_match(self, inspected):
+        return inspected.has_dot and inspected.has_digit
+
     def inspect(self, field_name, item):
-        value = self._get_positive_decimal(item)
+        self._inspect_value(self._get_positive_decimal(item))
+
+    def inspect_inspected(self, field_name, inspected):
+        self._inspect_value(inspected.positive_decimal)
+
+    def _inspect_value(self, value):
         precision, scale = self._get_decimal_places(value)
         self.max_precision = max(precision, self.max_precision)
         self.max_scale = max(scale, self.max_scale)
@@ -311,12 +409,52 @@ class PositiveDecimalMatcher(TypeMatcher, TypeAccumulator):
             return False
 
 
+# Regex patterns that match at least everything strptime accepts for each directive.
+DATETIME_DIRECTIVE_PATTERNS = {
+    'd': r' ?\d{1,2}', 'm': r'\d{1,2}', 'H': r'\d{1,2}', 'I': r'\d{1,2}', 'M': r'\d{1,2}', 'S': r'\d{1,2}',
+    'U': r'\d{1,2}', 'W': r'\d{1,2}', 'V': r'\d{1,2}', 'y': r'\d\d', 'Y': r'\d{4}', 'G': r'\d{4}',
+    'f': r'\d{1,6}', 'j': r'\d{1,3}', 'w': r'\d', 'u': r'\d', 'z': r'(?:[+-][\d:.]+|z)', '%': '%',
+}
+
+
+@lru_cache(maxsize=None)
+def get_datetime_format_regex(_format):
+    """
+    Compiles a strptime format into a regex that matches at least every string that strptime
+    can parse with that format. The regex is only used to rule out the formats quickly and
+    strptime still validates the ones that match. Directives that parse names such as month names
+    depend on the locale so None is returned for those formats and they are always parsed.
+
+    >>> get_datetime_format_regex('%m/%d/%Y').fullmatch('10/15/1992') is not None
+    True
+    """
+    pattern = []
+    i = 0
+    while i < len(_format):
+        char = _format[i]
+        if char == '%' and i + 1 < len(_format):
+            try:
+                pattern.append(DATETIME_DIRECTIVE_PATTERNS[_format[i + 1]])
+            except KeyError:
+                return None
+            i += 2
+        else:
+            # strptime lets any run of whitespace match a whitespace in the format.
+            pattern.append(r'\s+' if char.isspace() else re.escape(char))
+            i += 1
+    return re.compile(''.join(pattern), re.IGNORECASE)
+
+
 class DateTimeMatcher(TypeMatcher, TypeAccumulator):
     """
     Matches values that could be represented as datetimes. This matcher
     also acts as an accumulator and records the possible datetime formats
     that are used to represent this field.
 
+    Each format is compiled into a regex that quickly rules out the formats that can not
+    parse the value. Only the formats left are validated with strptime. The formats that parsed
+    the last matched value are kept so inspecting it does not parse it again.
+
     >>> DateTimeMatcher(datetime_formats=['%m/%d/%Y']).match('test', settings)
     False
     >>> DateTimeMatcher(datetime_formats=['%m/%d/%Y']).match('10/15/1992', settings)
@@ -331,7 +469,16 @@ class DateTimeMatcher(TypeMatcher, TypeAccumulator):
 
     def reset(self):
         self.candidate_formats = self.datetime_formats.copy()
+        self.formats_to_try = self.datetime_formats
         self.has_matched_before = False
+        self._last_parsed = None
+
+    def end_sample(self):
+        """
+        The formats that survived the sample are tried first for the rest of the values.
+        """
+        self.formats_to_try = self.candidate_formats.copy()
+        self._last_parsed = None
 
     def _needs_new_datetime_format(self, item):
         item = item.lower()
@@ -347,14 +494,38 @@ class DateTimeMatcher(TypeMatcher, TypeAccumulator):
                 return True
         return False
 
-    def _match(self, item):
-        for _format in self.datetime_formats:
+    def _get_matching_formats(self, item):
+        """
+        Returns the formats that can parse the lowercased item. strptime does not care about the case.
+        """
+        if self._last_parsed is not None and self._last_parsed[0] == item:
+            return self._last_parsed[1]
+        matching_formats = self._get_parsing_formats(item, self.formats_to_try)
+        if not matching_formats and self.formats_to_try is not self.datetime_formats:
+            # A value that only parses with a format that was dropped after the sample is still a datetime
+            # so inspecting it reports the inconsistency instead of counting it as a string.
+            matching_formats = self._get_parsing_formats(
+                item, [i for i in self.datetime_formats if i not in self.formats_to_try])
+        self._last_parsed = (item, matching_formats)
+        return matching_formats
+
+    def _get_parsing_formats(self, item, formats):
+        matching_formats = set()
+        for _format in formats:
+            regex = get_datetime_format_regex(_format)
+            if regex is not None and regex.fullmatch(item) is None:
+                continue
             try:
                 datetime.datetime.strptime(item, _format)
-                self.has_matched_before = True
-                return True
             except ValueError:
                 continue
+            matching_formats.add(_format)
+        return matching_formats
+
+    def _match(self, item):
+        if self._get_matching_formats(item):
+            self.has_matched_before = True
+            return True
 
         if self.has_matched_before and self._needs_new_datetime_format(item):
             raise UserInferenceRequired(
@@ -386,14 +557,8 @@ class DateTimeMatcher(TypeMatcher, TypeAccumulator):
         return True
 
     def _get_format_data(self, item):
-        matching_formats = set()
-        failed_formats = set()
-        for _format in self.datetime_formats:
-            try:
-                datetime.datetime.strptime(item, _format)
-                matching_formats.add(_format)
-            except ValueError:
-                failed_formats.add(_format)
+        matching_formats = self._get_matching_formats(item.lower().strip())
+        failed_formats = set(self.formats_to_try) - matching_formats
         return matching_formats, failed_formats
 
 
@@ -424,6 +589,61 @@ class StringMatcher(TypeMatcher, TypeAccumulator):
         return True
 
 
+def merge_field_stats(all_stats, field_name=''):
+    """
+    Merges the stats of the same field that were collected from different shards of the data.
+    The merge is associative and commutative so the shards can be merged in any order:
+    the counters and lengths are added, the maxes are the max of the maxes and the
+    datetime formats are the formats that parsed the dates of every shard.
+
+    >>> merge_field_stats([FieldStats(counter=Counter(HasInt=2), max_int=10, len=2),
+    ...                    FieldStats(counter=Counter(HasInt=1), max_int=99, len=1)]).max_int
+    99
+    """
+    counter = Counter()
+    max_int = max_pre_decimal = max_decimal_scale = max_string_len = length = 0
+    datetime_formats = None
+    for stats in all_stats:
+        counter.update(stats.counter)
+        max_int = max(max_int, stats.max_int)
+        max_pre_decimal = max(max_pre_decimal, stats.max_pre_decimal)
+        max_decimal_scale = max(max_decimal_scale, stats.max_decimal_scale)
+        max_string_len = max(max_string_len, stats.max_string_len)
+        length += stats.len
+        if stats.datetime_formats is not None:
+            if datetime_formats is None:
+                datetime_formats = set(stats.datetime_formats)
+            else:
+                new_formats = datetime_formats & set(stats.datetime_formats)
+                if not new_formats:
+                    raise InconsistentData(f"field {field_name} has inconsistent datetime data: "
+                                           f"{', '.join(stats.datetime_formats)} in one shard but "
+                                           f"{', '.join(datetime_formats)} in the other shards")
+                datetime_formats = new_formats
+    return FieldStats(counter=counter, max_int=max_int, max_pre_decimal=max_pre_decimal,
+                      max_decimal_scale=max_decimal_scale, max_string_len=max_string_len,
+                      datetime_formats=datetime_formats, len=length)
+
+
+def field_stats_to_dict(stats):
+    """
+    Converts the FieldStats into a dictionary that can be dumped as json.
+    """
+    result = stats._asdict()
+    result['counter'] = dict(stats.counter)
+    if stats.datetime_formats is not None:
+        result['datetime_formats'] = sorted(stats.datetime_formats)
+    return result
+
+
+def field_stats_from_dict(item):
+    item = dict(item)
+    item['counter'] = Counter(item['counter'])
+    if item.get('datetime_formats') is not None:
+        item['datetime_formats'] = set(item['datetime_formats'])
+    return FieldStats(**item)
+
+
 def matchers_from_settings(settings=None, ignore_matchers=None):
     """
     Creates a default set of matchers from the settings object
@@ -456,24 +676,85 @@ class StatsCollector(object):
     Callers may cached this class, but :meth:`.StatsCollector.reset` should be called between
     field inspections.
 
+    The matchers run once per distinct value. The collector counts how many times each distinct
+    value is seen and weights the matched types by that count when collecting the stats.
+    Once more than MAX_CACHED_VALUES distinct values are cached, they are folded into the running
+    type counter, so the memory used does not grow with the number of inspected values.
+
+    If decided_string_length is passed, the field is considered decided as a string once a value longer
+    than it is matched as a string. From then on only the values that are longer than the longest string
+    so far go through the matchers. The rest are only checked for nulls and counted as strings.
+
+    If on_inference_required is passed, it is called with the field name, the item and the
+    :class:`.UserInferenceRequired` exception instead of raising it. The item is then treated as not
+    matching that matcher and the inspection goes on.
+
     Users may extend or override this by passing in their own matchers and stats class.
     """
-    def __init__(self, matchers=None, stats_class=None):
-        self.results = []
-        self.inspected = 0
+    MAX_CACHED_VALUES = 10000
+
+    def __init__(self, matchers=None, stats_class=None, decided_string_length=None, on_inference_required=None):
         self.stats_class = stats_class or FieldStats
-        self.matchers = matchers or matchers_from_settings()
+        self.on_inference_required = on_inference_required
+        self.all_matchers = list(matchers or matchers_from_settings())
+        self.decided_string_length = decided_string_length
+        self.string_matcher = self.null_matcher = None
+        for matcher in self.all_matchers:
+            if isinstance(matcher, StringMatcher):
+                self.string_matcher = matcher
+            elif isinstance(matcher, NullMatcher):
+                self.null_matcher = matcher
+        self.reset()
 
     def reset(self):
         """
         Resets the matchers and the collector to their default state.
         """
         self.inspected = 0
-        self.results = []
+        self.type_counter = Counter()
+        self.value_counts = Counter()
+        self.value_results = {}
+        self.seen_types = set()
+        self.is_decided_string = False
+        self.matchers = self.all_matchers
         for matcher in self.matchers:
             if isinstance(matcher, TypeAccumulator):
                 matcher.reset()
 
+    def _fold_value_counts(self):
+        """
+        Adds the weighted results of the distinct values to the type counter and forgets them.
+        """
+        for item, count in self.value_counts.items():
+            for value_type in self.value_results[item]:
+                self.type_counter[value_type] += count
+        self.value_counts.clear()
+        self.value_results.clear()
+
+    def end_sample(self, decided_string_length=None):
+        """
+        Marks the end of the training sample. The rest of the values are inspected based on what
+        the sample decided about the field:
+
+        - If the sample had a string longer than the decided_string_length, or the decided_string_length
+          of the constructor if not passed, the field is decided as a string. From then on only the values
+          that are longer than the longest string so far go through the matchers.
+        - If the sample did not have any datetime, the DateTimeMatcher is skipped for the rest of the values.
+        - Otherwise the datetime formats that survived the sample are tried first.
+
+        The null count, max string length, max int and decimal scale are still collected from all the values.
+        """
+        self._fold_value_counts()
+        if decided_string_length is None:
+            decided_string_length = self.decided_string_length
+        if (decided_string_length is not None and self.string_matcher is not None and
+                self.string_matcher.max_length > decided_string_length):
+            self.is_decided_string = True
+        if HasDateTime not in self.seen_types:
+            self.matchers = [matcher for matcher in self.matchers if not isinstance(matcher, DateTimeMatcher)]
+        for matcher in self.matchers:
+            matcher.end_sample()
+
     def collect(self):
         """
         Constructs an instance of the stats_class provided in the constructor. By default this is
@@ -482,42 +763,76 @@ class StatsCollector(object):
         :return:
             :class:`.FieldStats` object or user provided class instance.
         """
+        self._fold_value_counts()
         data = {}
-        for matcher in self.matchers:
+        for matcher in self.all_matchers:
             if isinstance(matcher, TypeAccumulator):
                 data.update(matcher.collect())
-        return self.stats_class(counter=Counter(self.results),
+        return self.stats_class(counter=self.type_counter.copy(),
                                 len=self.inspected, **data)
 
-    def inspect_item(self, field_name, item):
-        """
-        Inspects a given field value against all the matchers and accumulators. This will raise an
-        exception if no type was able to be determined.
-
-        :param item:
-            String value from the CSV
-        :param settings:
-            Settings object
-        """
-        item = item.strip()
+    def _match_item(self, field_name, item):
         results = []
         already_matched = False
+        inspected = InspectedItem(item)
         for matcher in self.matchers:
             if already_matched and isinstance(matcher, StringMatcher):
                 continue
-            if matcher.match(item):
+            try:
+                is_match = matcher.match_inspected(inspected)
+            except UserInferenceRequired as err:
+                if self.on_inference_required is None:
+                    raise
+                self.on_inference_required(field_name, item, err)
+                is_match = False
+            if is_match:
                 already_matched = True
             else:
                 continue
             if isinstance(matcher, TypeAccumulator):
-                matcher.inspect(field_name, item)
+                matcher.inspect_inspected(field_name, inspected)
             results.append(matcher.value_type)
             if matcher.is_exclusive(item):
                 break
 
         if not results:
             raise NoMatchFound(f"Failed to find a matching value type for {item}.")
+        return results
+
+    def _match_decided_item(self, item):
+        if self.null_matcher is not None and self.null_matcher.match(item):
+            return [HasNull]
+        return [HasString]
+
+    def inspect_item(self, field_name, item):
+        """
+        Inspects a given field value against all the matchers and accumulators. This will raise an
+        exception if no type was able to be determined.
 
-        self.results.extend(results)
+        :param item:
+            String value from the CSV
+        :param settings:
+            Settings object
+        """
+        item = item.strip()
+        results = self.value_results.get(item)
+        if results is None:
+            if self.is_decided_string and len(item) <= self.string_matcher.max_length:
+                results = self._match_decided_item(item)
+            else:
+                results = self._match_item(field_name, item)
+                if (self.decided_string_length is not None and self.string_matcher is not None and
+                        HasString in results and len(item) > self.decided_string_length):
+                    self.is_decided_string = True
+            if not self.seen_types.issuperset(results):
+                # A matcher may judge the values differently once its type is seen.
+                # For example the DateTimeMatcher asks for a new format only after it has matched a date.
+                # So the results of the previous values can not be reused anymore.
+                self._fold_value_counts()
+                self.seen_types.update(results)
+            elif len(self.value_results) >= self.MAX_CACHED_VALUES:
+                self._fold_value_counts()
+            self.value_results[item] = results
+        self.value_counts[item] += 1
         self.inspected += 1
         return results
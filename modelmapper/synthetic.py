@@ -0,0 +1,275 @@
+"""
+Generates synthetic data that looks like the data a model was trained with, based on the FIELDS
+of the model's combined module. The rows are streamed so the files can be as big as needed.
+"""
+import os
+import csv
+import random
+import datetime
+import zipfile
+from collections import deque
+from decimal import Decimal, InvalidOperation
+from string import ascii_letters, digits
+from xml.sax.saxutils import escape
+
+from modelmapper.mapper import SqlalchemyFieldType, INTEGER_SQLALCHEMY_TYPES
+
+# The same as the max_int in the setup template.
+MAX_INTS = {
+    SqlalchemyFieldType.SmallInteger: 32767,
+    SqlalchemyFieldType.Integer: 2147483647,
+    SqlalchemyFieldType.BigInteger: 9223372036854775807,
+}
+
+BOOLEAN_VALUES = ('true', 'false', 't', 'f', 'yes', 'no', 'y', 'n', '1', '0')
+
+STRING_CHARS = ascii_letters + digits + ' '
+
+DEFAULT_STRING_LENGTH = 255
+DEFAULT_DECIMAL_ARGS = (12, 2)
+DEFAULT_DATETIME_FORMAT = '%m/%d/%Y'
+BASE_DATETIME = datetime.datetime(2000, 1, 1)
+DATETIME_RANGE_SECONDS = 30 * 365 * 24 * 3600
+
+# Values that fail casting to each type when the data is cleaned.
+INVALID_VALUES = {
+    SqlalchemyFieldType.String: 'x' * 300,
+    SqlalchemyFieldType.Boolean: 'maybe',
+    SqlalchemyFieldType.DateTime: '99/99/9999',
+}
+INVALID_NUMBER = 'not a number'
+
+# Duplicate rows are copies of one of this many previous rows.
+DUPLICATE_WINDOW = 1000
+
+XLSX_MAX_ROWS = 1048576
+# Excel only keeps 15 significant digits of a number. Longer numbers stay text cells.
+XLSX_MAX_NUMBER_DIGITS = 15
+# Day zero of the Excel serial dates with the 1900 leap year bug.
+XLSX_EPOCH = datetime.datetime(1899, 12, 30)
+
+FILE_FORMATS = ('csv', 'tsv', 'xlsx')
+
+
+def _get_datetime_format(field_info):
+    # The cleaner expects all the values of a field to be in the same format.
+    return sorted(field_info.get('datetime_formats') or [DEFAULT_DATETIME_FORMAT])[0]
+
+
+def _get_value_func(field_info, rnd):
+    """
+    Returns a function that generates a valid raw value for the field.
+    """
+    _type = field_info['field_db_sqlalchemy_type']
+    args = field_info.get('args')
+    if _type == SqlalchemyFieldType.String:
+        max_length = args or DEFAULT_STRING_LENGTH
+
+        def string():
+            return rnd.choice(ascii_letters) + ''.join(rnd.choices(STRING_CHARS, k=rnd.randrange(max_length)))
+        return string
+    if _type == SqlalchemyFieldType.Boolean:
+        return lambda: rnd.choice(BOOLEAN_VALUES)
+    if _type in INTEGER_SQLALCHEMY_TYPES:
+        max_int = MAX_INTS[_type]
+        if field_info.get('is_dollar'):
+            # The dollars are stored as cents.
+            def dollar():
+                cents = rnd.randrange(max_int)
+                return f'${cents // 100:,}.{cents % 100:02d}'
+            return dollar
+        return lambda: str(rnd.randrange(max_int))
+    if _type == SqlalchemyFieldType.Decimal:
+        precision, scale = args or DEFAULT_DECIMAL_ARGS
+        max_pre_decimal = 10 ** (precision - scale)
+        if field_info.get('is_percent'):
+            # The percents are divided by 100 when stored.
+            scale = max(scale - 2, 0)
+        max_scale = 10 ** scale
+
+        def decimal():
+            value = str(rnd.randrange(max_pre_decimal))
+            if scale:
+                value = f'{value}.{rnd.randrange(max_scale):0{scale}d}'
+            return f'{value}%' if field_info.get('is_percent') else value
+        return decimal
+    if _type == SqlalchemyFieldType.DateTime:
+        _format = _get_datetime_format(field_info)
+
+        def date():
+            return (BASE_DATETIME + datetime.timedelta(seconds=rnd.randrange(DATETIME_RANGE_SECONDS))).strftime(_format)
+        return date
+    raise ValueError(f'{_type} is not supported for generating synthetic data.')
+
+
+def _get_field_generator(field_info, rnd, null_rate, error_rate, cardinality):
+    value_func = _get_value_func(field_info, rnd)
+    if cardinality:
+        pool = [value_func() for i in range(cardinality)]
+
+        def value_func():
+            return rnd.choice(pool)
+    _type = field_info['field_db_sqlalchemy_type']
+    invalid_value = INVALID_VALUES.get(_type, INVALID_NUMBER)
+    is_nullable = field_info.get('is_nullable', False)
+
+    def generate():
+        if is_nullable and null_rate and rnd.random() < null_rate:
+            return ''
+        if error_rate and rnd.random() < error_rate:
+            return invalid_value
+        return value_func()
+    return generate
+
+
+def generate_rows(fields, rows, null_rate=0.05, error_rate=0, duplicate_rate=0, cardinality=None, seed=0):
+    """
+    Generates the raw rows of a model based on the FIELDS of its combined module.
+    The first row is the header.
+
+    Args:
+        fields: The FIELDS dictionary of the combined module.
+        rows: Number of rows to generate after the header.
+        null_rate: Ratio of the values of the nullable fields that are empty.
+        error_rate: Ratio of the values that can not be cast to the type of the field.
+        duplicate_rate: Ratio of the rows that are copies of a previous row.
+        cardinality: If set, each field only has this many distinct values.
+        seed: Seed of the random generator so the data can be generated again.
+
+    Yields:
+        list: the values of each row as strings.
+    """
+    rnd = random.Random(seed)
+    field_names = list(fields.keys())
+    generators = [_get_field_generator(fields[i], rnd, null_rate=null_rate, error_rate=error_rate,
+                                       cardinality=cardinality) for i in field_names]
+    yield field_names
+    recent_rows = deque(maxlen=DUPLICATE_WINDOW)
+    for i in range(rows):
+        if recent_rows and duplicate_rate and rnd.random() < duplicate_rate:
+            row = rnd.choice(recent_rows)
+        else:
+            row = [generate() for generate in generators]
+            recent_rows.append(row)
+        yield row
+
+
+def _get_column_letter(index):
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+XLSX_STATIC_FILES = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'),
+}
+
+
+def _get_text_cell(ref, value):
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{escape(value)}</t></is></c>'
+
+
+def _get_number_cell(ref, number):
+    return f'<c r="{ref}"><v>{number}</v></c>'
+
+
+def _get_xlsx_number(field_info, value):
+    """
+    Returns the number that Excel stores for the raw value of a field or None if it is stored as text.
+    The percents are stored as fractions, the dollars without the symbol and the datetimes as serial dates,
+    the same as when the cells are formatted in Excel.
+    """
+    _type = field_info['field_db_sqlalchemy_type']
+    try:
+        if _type == SqlalchemyFieldType.DateTime:
+            delta = datetime.datetime.strptime(value, _get_datetime_format(field_info)) - XLSX_EPOCH
+            return repr(delta.days + delta.seconds / 86400)
+        if _type in INTEGER_SQLALCHEMY_TYPES or _type == SqlalchemyFieldType.Decimal:
+            if field_info.get('is_percent'):
+                number = Decimal(value.rstrip('%')) / 100
+            else:
+                number = Decimal(value.lstrip('$').replace(',', ''))
+            if len(number.as_tuple().digits) <= XLSX_MAX_NUMBER_DIGITS:
+                return str(number)
+    except (ValueError, InvalidOperation):
+        pass
+    return None
+
+
+def _write_xlsx(path, rows, fields):
+    """
+    Streams the rows into a single sheet xlsx file. The numbers, percents and datetimes are written as
+    numeric cells and the rest of the values as text cells, the same way as Excel stores them.
+    """
+    rows = iter(rows)
+    header = next(rows)
+    fields_info = [fields[i] for i in header]
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as the_zip:
+        for name, content in XLSX_STATIC_FILES.items():
+            the_zip.writestr(name, content)
+        with the_zip.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            cells = ''.join(_get_text_cell(f'{_get_column_letter(j)}1', value) for j, value in enumerate(header))
+            sheet.write(f'<row r="1">{cells}</row>'.encode('utf-8'))
+            for i, row in enumerate(rows, 2):
+                if i > XLSX_MAX_ROWS:
+                    raise ValueError(f'xlsx files can not have more than {XLSX_MAX_ROWS} rows.')
+                cells = []
+                for j, value in enumerate(row):
+                    if not value:
+                        continue
+                    ref = f'{_get_column_letter(j)}{i}'
+                    number = _get_xlsx_number(fields_info[j], value)
+                    cells.append(_get_text_cell(ref, value) if number is None else _get_number_cell(ref, number))
+                sheet.write(f'<row r="{i}">{"".join(cells)}</row>'.encode('utf-8'))
+            sheet.write(b'</sheetData></worksheet>')
+
+
+def write_synthetic_file(path, fields, rows, file_format=None, **kwargs):
+    """
+    Writes the rows generated by :func:`generate_rows` into a csv, tsv or xlsx file.
+    The format defaults to the extension of the path.
+    """
+    file_format = (file_format or os.path.splitext(path)[1].lstrip('.')).lower()
+    if file_format not in FILE_FORMATS:
+        raise ValueError(f"The file format of {file_format} is invalid. Options are: {', '.join(FILE_FORMATS)}")
+    all_rows = generate_rows(fields, rows, **kwargs)
+    if file_format == 'xlsx':
+        _write_xlsx(path, all_rows, fields)
+    else:
+        with open(path, 'w', newline='') as the_file:
+            writer = csv.writer(the_file, delimiter='\t' if file_format == 'tsv' else ',')
+            writer.writerows(all_rows)
@@ -0,0 +1,210 @@
+"""
+Lightweight tracing of the ETL runs. Each run is a trace of nested spans with attributes such as the key,
+bytes and rows, so a slow run can be broken down into for example a slow download or a slow insert chunk.
+
+Exporters receive the spans when they start and end. The JsonLinesExporter writes the finished spans into
+a local file. The OpenTelemetryExporter mirrors the spans into OpenTelemetry if it is installed.
+"""
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+
+class Span:
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self.end_time = None
+        self.status = 'ok'
+        self.error = None
+        self._start_counter = time.perf_counter()
+        self.duration_seconds = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def _end(self, error=None):
+        self.duration_seconds = time.perf_counter() - self._start_counter
+        self.end_time = self.start_time + self.duration_seconds
+        if error is not None:
+            self.status = 'error'
+            self.error = f'{error.__class__.__name__}: {error}'
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'duration_seconds': self.duration_seconds,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+    def __repr__(self):
+        return f'<Span {self.name} {self.span_id}>'
+
+
+class SpanExporter:
+    """
+    Subclass this to send the spans somewhere else.
+    """
+
+    def on_start(self, span):
+        pass
+
+    def on_end(self, span):
+        pass
+
+
+class JsonLinesExporter(SpanExporter):
+    """
+    Appends each finished span as a line of json to the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def on_end(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock, open(self.path, 'a') as the_file:
+            the_file.write(line + '\n')
+
+
+class OpenTelemetryExporter(SpanExporter):
+    """
+    Mirrors the spans into an OpenTelemetry tracer. Requires opentelemetry-api and a configured
+    tracer provider to send the spans anywhere.
+    """
+
+    def __init__(self, tracer=None):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise ImportError('Please install opentelemetry-api to use the OpenTelemetryExporter') from None
+        self._trace = trace
+        self.tracer = tracer or trace.get_tracer('modelmapper')
+        self._spans = {}
+
+    def on_start(self, span):
+        parent = self._spans.get(span.parent_id)
+        context = self._trace.set_span_in_context(parent) if parent is not None else None
+        self._spans[span.span_id] = self.tracer.start_span(
+            span.name, context=context, start_time=int(span.start_time * 1e9))
+
+    def on_end(self, span):
+        otel_span = self._spans.pop(span.span_id, None)
+        if otel_span is None:
+            return
+        otel_span.set_attributes({k: v if isinstance(v, (bool, int, float, str)) else str(v)
+                                  for k, v in span.attributes.items() if v is not None})
+        if span.error:
+            otel_span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int(span.end_time * 1e9))
+
+
+class Tracer:
+    """
+    Creates nested spans. The current span is kept per thread.
+    """
+
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+        self._local = threading.local()
+
+    def _get_stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            return stack
+
+    @property
+    def current_span(self):
+        stack = self._get_stack()
+        return stack[-1] if stack else None
+
+    def _start_span(self, name, attributes):
+        parent = self.current_span
+        if parent is None:
+            span = Span(name, trace_id=uuid.uuid4().hex, attributes=attributes)
+        else:
+            span = Span(name, trace_id=parent.trace_id, parent_id=parent.span_id, attributes=attributes)
+        for exporter in self.exporters:
+            exporter.on_start(span)
+        return span
+
+    def _end_span(self, span, error=None):
+        span._end(error)
+        for exporter in self.exporters:
+            exporter.on_end(span)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        stack = self._get_stack()
+        span = self._start_span(name, attributes)
+        stack.append(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            stack.pop()
+            self._end_span(span, error)
+
+    def iterate(self, name, iterable, **attributes):
+        """
+        Wraps the iterable in a span that starts when the first item is requested and ends when the iteration
+        ends. The span is not the current span since the consumer runs its own spans between the items.
+        The number of items is its rows attribute.
+        """
+        span = self._start_span(name, attributes)
+        rows = 0
+        error = None
+        try:
+            for item in iterable:
+                rows += 1
+                yield item
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            span.set_attribute('rows', rows)
+            self._end_span(span, error)
+
+
+@contextmanager
+def trace_span(tracer, name, **attributes):
+    """
+    Runs the block in a span if there is a tracer. Yields the span or None.
+    """
+    if tracer is None:
+        yield None
+    else:
+        with tracer.span(name, **attributes) as span:
+            yield span
+
+
+def trace_iterate(tracer, name, iterable, **attributes):
+    """
+    Wraps the iterable in a span if there is a tracer. See :meth:`Tracer.iterate`.
+    """
+    if tracer is None:
+        return iterable
+    return tracer.iterate(name, iterable, **attributes)
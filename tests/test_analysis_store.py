@@ -0,0 +1,67 @@
+import sqlite3
+import pytest
+from collections import namedtuple
+from contextlib import closing
+from deepdiff import DeepDiff
+
+from modelmapper.analysis_store import AnalysisStore, get_csv_fingerprint
+from modelmapper.misc import FileNotFound
+
+Settings = namedtuple('Settings', ['training_csvs', 'booleans'])
+
+
+@pytest.fixture(scope='function')
+def analysis_store(tmpdir):
+    return AnalysisStore(str(tmpdir.join('analysis.sqlite')))
+
+
+class TestAnalysisStore:
+
+    def test_write_and_read(self, analysis_store):
+        result_a = {'casualty': {'field_db_str': 'Boolean'},
+                    'last_payment_date': {'field_db_str': 'DateTime', 'datetime_formats': {'%m/%d/%y', '%Y%m%d'}}}
+        result_b = {'slope': {'field_db_str': 'Integer', 'is_nullable': True}}
+        analysis_store.write('a.csv', result_a)
+        analysis_store.write('b.csv', result_b)
+        results = analysis_store.read(['b.csv', 'a.csv'], keys_to_convert_to_set={'datetime_formats'})
+        assert not DeepDiff([result_b, result_a], results)
+        assert ['casualty', 'last_payment_date'] == list(results[1].keys())
+
+    def test_write_replaces_the_csv_results(self, analysis_store):
+        analysis_store.write('a.csv', {'slope': {'field_db_str': 'Integer'}})
+        analysis_store.write('a.csv', {'slope': {'field_db_str': 'BigInteger'}})
+        assert [{'slope': {'field_db_str': 'BigInteger'}}] == analysis_store.read(['a.csv'])
+
+    def test_read_csv_that_is_not_analyzed(self, analysis_store):
+        analysis_store.write('a.csv', {})
+        with pytest.raises(FileNotFound):
+            analysis_store.read(['a.csv', 'b.csv'])
+
+    def test_get_by_fingerprint(self, analysis_store):
+        analysis_store.write('a.csv', {'d': {'datetime_formats': {'%Y%m%d'}}}, fingerprint='abc', empty_fields={'e'})
+        expected = ({'d': {'datetime_formats': {'%Y%m%d'}}}, {'e'})
+        assert expected == analysis_store.get('a.csv', 'abc', keys_to_convert_to_set={'datetime_formats'})
+        assert analysis_store.get('a.csv', 'xyz') is None
+        assert analysis_store.get('b.csv', 'abc') is None
+
+    def test_store_without_fingerprints(self, analysis_store):
+        with closing(sqlite3.connect(analysis_store.path)) as conn, conn:
+            conn.execute('CREATE TABLE analysis (csv_name TEXT PRIMARY KEY, results TEXT NOT NULL)')
+            conn.execute('''INSERT INTO analysis VALUES ('a.csv', '{"slope": {}}')''')
+        assert [{'slope': {}}] == analysis_store.read(['a.csv'])
+        assert analysis_store.get('a.csv', None) is None
+        analysis_store.write('a.csv', {}, fingerprint='abc')
+        assert ({}, set()) == analysis_store.get('a.csv', 'abc')
+
+    def test_get_csv_fingerprint(self, tmpdir):
+        csv_path = str(tmpdir.join('a.csv'))
+        with open(csv_path, 'w') as the_file:
+            the_file.write('a,b\n1,2\n')
+        settings = Settings(training_csvs=['a.csv'], booleans={'y', 'n'})
+        fingerprint = get_csv_fingerprint(csv_path, settings)
+        assert fingerprint == get_csv_fingerprint(csv_path, settings._replace(training_csvs=['a.csv', 'b.csv']))
+        assert fingerprint != get_csv_fingerprint(csv_path, settings._replace(booleans={'y'}))
+        assert fingerprint != get_csv_fingerprint(csv_path, settings, fields_not_datetime={'a'})
+        with open(csv_path, 'a') as the_file:
+            the_file.write('3,4\n')
+        assert fingerprint != get_csv_fingerprint(csv_path, settings)
@@ -0,0 +1,70 @@
+import os
+import csv
+import pytest
+from unittest import mock
+
+from modelmapper import Cleaner
+from modelmapper.benchmark import (BenchmarkCase, NullSession, write_synthetic_csv, run_benchmarks,
+                                   compare_to_baseline, bench_model, get_bench_report_str)
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+example_setup_path = os.path.join(current_dir, '../modelmapper/example/some_model_setup.toml')
+example_csv_path = os.path.join(current_dir, 'fixtures/training_fixture1.csv')
+
+
+class TestBenchmark:
+
+    @pytest.mark.parametrize("type_mix", ['numeric', 'mixed'])
+    def test_write_synthetic_csv(self, type_mix, tmpdir):
+        path = str(tmpdir.join('synthetic.csv'))
+        write_synthetic_csv(path, BenchmarkCase(rows=20, columns=9, type_mix=type_mix))
+        with open(path, 'r') as the_file:
+            lines = list(csv.reader(the_file))
+        assert 21 == len(lines)
+        assert {9} == set(map(len, lines))
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(row_counts=[50], column_counts=[7], trace_memory=False)
+        stages = results['cases']['mixed_50x7']
+        assert ['analyze', 'clean', 'signature', 'load'] == list(stages.keys())
+        for metrics in stages.values():
+            assert metrics['rows_per_sec'] > 0
+            assert metrics['peak_memory_bytes'] is None
+
+    def test_compare_to_baseline(self):
+        baseline = {'cases': {'mixed_50x7': {
+            'clean': {'seconds': 1, 'rows_per_sec': 1000, 'peak_memory_bytes': 100},
+            'load': {'seconds': 1, 'rows_per_sec': 1000, 'peak_memory_bytes': 100},
+        }}}
+        results = {'cases': {'mixed_50x7': {
+            'clean': {'seconds': 1, 'rows_per_sec': 950, 'peak_memory_bytes': 105},
+            'load': {'seconds': 1, 'rows_per_sec': 800, 'peak_memory_bytes': 150},
+            'signature': {'seconds': 1, 'rows_per_sec': 10, 'peak_memory_bytes': 100},
+        }}}
+        regressions = compare_to_baseline(results, baseline, threshold=0.1)
+        assert 2 == len(regressions)
+        assert all(i.startswith('mixed_50x7 load') for i in regressions)
+
+    @pytest.mark.parametrize("data_path", [None, example_csv_path])
+    def test_bench_model(self, data_path):
+        results = bench_model(example_setup_path, data_path=data_path, rows=40, chunk_size=7)
+        assert ['clean', 'signature', 'load'] == list(results['stages'].keys())
+        assert results['content_type'] == 'csv'
+        for metrics in results['stages'].values():
+            assert metrics['rows_per_sec'] > 0
+        fields = Cleaner(example_setup_path)._get_combined_module().FIELDS
+        assert results['field_costs']
+        assert set(results['field_costs'].keys()) <= set(fields.keys())
+        report = get_bench_report_str(results)
+        assert 'rows/sec' in report
+
+    def test_bench_model_loads_with_the_bulk_loader(self):
+        with mock.patch.object(NullSession, 'execute', autospec=True, side_effect=NullSession.execute) as execute:
+            bench_model(example_setup_path, rows=40, chunk_size=7, duplicate_rate=0.5)
+        queries = [i[0][1] for i in execute.call_args_list]
+        assert 6 == len(queries)
+        assert all(query.table.name == 'records' for query in queries)
+        rows = [row for query in queries for row in query.parameters]
+        # The duplicate rows are not inserted again.
+        assert len(rows) < 40
+        assert len(rows) == len({row['signature'] for row in rows})
@@ -0,0 +1,57 @@
+import pytest
+
+from modelmapper.bloom import BloomFilter
+
+
+class TestBloomFilter:
+
+    @pytest.mark.parametrize('signatures', [
+        [format(i, '032x') for i in range(2000)],
+        list(range(-1000, 1000)),
+        [i.to_bytes(16, 'big') for i in range(2000)],
+    ])
+    def test_no_false_negatives(self, signatures):
+        bloom_filter = BloomFilter(2000, error_rate=0.01)
+        bloom_filter.update(signatures)
+        assert all(i in bloom_filter for i in signatures)
+        # A signature whose bits were all set already looks like a duplicate and is not counted.
+        assert 2000 * 0.98 < len(bloom_filter) <= 2000
+        assert not bloom_filter.is_full
+
+    def test_duplicates_are_counted_once(self):
+        bloom_filter = BloomFilter(3)
+        bloom_filter.update(['a', 'b', 'a', 'b', 'a'])
+        assert 2 == len(bloom_filter)
+        assert not bloom_filter.is_full
+
+    def test_false_positive_rate(self):
+        bloom_filter = BloomFilter(10000, error_rate=0.01)
+        bloom_filter.update(format(i, '032x') for i in range(10000))
+        false_positives = sum(format(i, '032x') in bloom_filter for i in range(10000, 30000))
+        assert false_positives < 20000 * 0.02
+
+    def test_save_and_load(self, tmpdir):
+        path = str(tmpdir.join('signatures.bloom'))
+        bloom_filter = BloomFilter(100)
+        bloom_filter.update(['a', 'b'])
+        bloom_filter.save(path)
+
+        loaded = BloomFilter.load(path)
+        assert 'a' in loaded and 'b' in loaded
+        assert 2 == len(loaded)
+        assert (100, 0.01) == (loaded.capacity, loaded.error_rate)
+
+    def test_load_invalid_file(self, tmpdir):
+        path = tmpdir.join('signatures.bloom')
+        path.write_binary(b'not a bloom filter')
+        with pytest.raises(ValueError):
+            BloomFilter.load(str(path))
+
+    @pytest.mark.parametrize('capacity, error_rate', [
+        (0, 0.01),
+        (100, 0),
+        (100, 1),
+    ])
+    def test_invalid_args(self, capacity, error_rate):
+        with pytest.raises(ValueError):
+            BloomFilter(capacity, error_rate=error_rate)
@@ -1,10 +1,11 @@
 import io
 import os
+import datetime
 import pytest
 
 from deepdiff import DeepDiff
 from modelmapper import Cleaner
-from modelmapper.cleaner import ErrorRegistry
+from modelmapper.cleaner import ErrorRegistry, FieldCostRegistry, CastingError
 from modelmapper.mapper import SqlalchemyFieldType
 from tests.fixtures.training_fixture1_cleaned_for_import import cleaned_csv_for_import_fixture  # NOQA
 from tests.fixtures.training_fixture1_with_2_sheets_cleaned_for_import import cleaned_csv_with_2_sheets_combined_for_import_fixture  # NOQA
@@ -60,6 +61,14 @@ class TestCleaner:
         result = list(cleaner.get_csv_data_cleaned(training_fixture1_path))
         assert result == cleaned_csv_for_import_fixture
 
+    def test_clean_with_line_filter(self, cleaner, cleaned_csv_for_import_fixture):  # NOQA
+        def line_filter(clean_names, lines):
+            assert 'casualty' in clean_names
+            return (line for i, line in enumerate(lines) if i % 2 == 0)
+
+        result = list(cleaner.clean('csv', content=training_fixture1_content_str, line_filter=line_filter))
+        assert result == cleaned_csv_for_import_fixture[::2]
+
     @pytest.mark.parametrize("line, is_parsable", [
         (["1", "2", ""], True),
         (["", "", "a"], True),
@@ -139,6 +148,72 @@ class TestCleaner:
         assert field_values == cleaner._get_field_values_cleaned_for_importing(
             'test_field', field_info, field_values, 'xlsx')
 
+    def test_datetime_field_costs(self, cleaner):
+        cleaner.settings = cleaner.settings._replace(track_cleaning_field_costs=True)
+        field_info = {
+            'is_nullable': True,
+            'field_db_sqlalchemy_type': SqlalchemyFieldType.DateTime,
+            'datetime_formats': ['%m/%d/%y']
+        }
+        field_values = ['5/5/18', '5/5/18 ', '5/7/18', '']
+        result = cleaner._get_field_values_cleaned_for_importing('test_field', field_info, field_values, 'csv')
+
+        expected = [datetime.datetime(2018, 5, 5), datetime.datetime(2018, 5, 5), datetime.datetime(2018, 5, 7), None]
+        assert expected == result
+        expected_costs = {'values': 4, 'paths': {'null': 1, 'datetime': 3}, 'defaults': 0, 'exceptions': 0}
+        costs = cleaner._field_cost_registry.to_dict()['test_field']
+        assert costs.pop('seconds') > 0
+        assert expected_costs == costs
+
+    def test_field_costs_with_casting_errors(self, cleaner):
+        cleaner.settings = cleaner.settings._replace(
+            track_cleaning_field_costs=True, default_value_for_field_when_casting_error={'with_default': None})
+        field_info = {'is_nullable': True, 'field_db_sqlalchemy_type': SqlalchemyFieldType.Boolean}
+        cleaner._get_field_values_cleaned_for_importing('with_default', field_info, ['y', 'maybe', 'n'], 'csv')
+        with pytest.raises(CastingError):
+            cleaner._get_field_values_cleaned_for_importing('no_default', field_info, ['y', 'maybe', 'n'], 'csv')
+
+        costs = cleaner._field_cost_registry.to_dict()
+        assert (1, 0) == (costs['with_default']['defaults'], costs['with_default']['exceptions'])
+        assert {'null': 1, 'boolean': 2} == costs['with_default']['paths']
+        assert (0, 1, 1) == (costs['no_default']['defaults'], costs['no_default']['exceptions'],
+                             costs['no_default']['values'])
+
+    def test_field_costs_are_not_tracked_by_default(self, cleaner):
+        list(cleaner.clean('csv', path=training_fixture1_path))
+        assert not cleaner._field_cost_registry
+
+    def test_clean_with_field_costs(self, cleaner, cleaned_csv_for_import_fixture):  # NOQA
+        cleaner.settings = cleaner.settings._replace(track_cleaning_field_costs=True)
+        result = list(cleaner.clean('csv', path=training_fixture1_path))
+        assert not DeepDiff(cleaned_csv_for_import_fixture, result)
+        costs = cleaner._field_cost_registry.to_dict()
+        assert set(result[0].keys()) == set(costs.keys())
+        assert {5} == {i['values'] for i in costs.values()}
+
+
+class TestFieldCostRegistry:
+
+    def test_field_cost_registry(self):
+        registry = FieldCostRegistry()
+        registry.add_field('cheap', 0.1, path='string', values=10)
+        registry.add_field('expensive', 0.5, path='datetime', values=10, nulls=2)
+        registry.add_field('expensive', 0.25, path='datetime', values=5, defaults=1)
+        registry.add_field('medium', 0.2, path='decimal', values=10)
+        registry.add_field('cheapest', 0.01, path='boolean', values=10)
+        expected = {
+            'field_name1': 'expensive', 'seconds1': 0.75, 'values1': 15, 'null1': 2, 'datetime1': 13,
+            'defaults1': 1, 'exceptions1': 0,
+            'field_name2': 'medium', 'seconds2': 0.2, 'values2': 10, 'decimal2': 10,
+            'defaults2': 0, 'exceptions2': 0,
+            'field_name3': 'cheap', 'seconds3': 0.1, 'values3': 10, 'string3': 10,
+            'defaults3': 0, 'exceptions3': 0,
+        }
+        assert expected == registry.get_report_dict()
+        report = registry.get_report_str().splitlines()
+        assert report[2].startswith('expensive')
+        assert report[-1].startswith('cheapest')
+
 
 class TestErrorRegistry:
 
@@ -4,9 +4,14 @@ from unittest.mock import Mock
 from uuid import uuid4
 
 import pytest
-from sqlalchemy import exc as core_exc
+from sqlalchemy import exc as core_exc, MetaData, Table, Column, Index, Integer, String
+from sqlalchemy.dialects import postgresql
 
-from modelmapper import ETL
+from modelmapper import ETL, SqlalchemyBulkLoaderMixin, SqlalchemySnapshotLoaderMixin, PostgresCopyLoaderMixin
+from modelmapper.bloom import BloomFilter
+from modelmapper.instrumentation import EtlInstrumentation
+from modelmapper.metrics import EtlMetrics
+from modelmapper.tracing import Tracer
 from tests.fixtures.etl import BasicETL
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -26,6 +31,18 @@ def basic():
     return BasicETL(setup_path=example_setup_path)
 
 
+class RawLineETL(SqlalchemyBulkLoaderMixin, ETL):
+    pass
+
+
+class SnapshotETL(SqlalchemySnapshotLoaderMixin, ETL):
+    SIGNATURE_BLOOM_FILTER = True
+
+
+class CopyETL(PostgresCopyLoaderMixin, ETL):
+    pass
+
+
 def content_generator():
     yield training_fixture1_content_str
 
@@ -110,3 +127,340 @@ class TestETL:
             # kinda hacky but it does the trick
             args = [None] * arg_count
             getattr(job, fn_name)(*args)
+
+    @mock.patch('modelmapper.ETL.insert_chunk_of_data_to_db')
+    def test_stage_metrics(self, mock_insert_chunk):
+        mock_insert_chunk.side_effect = lambda session, model, chunk: (len(chunk), 0)
+        sink = Mock()
+        test_etl = ETL(setup_path=example_setup_path, instrumentation=EtlInstrumentation(sinks=[sink]))
+        test_etl.RECORDS_MODEL = Mock(__table__='records')
+        data = {'content': training_fixture1_content_str, 'raw_key_id': 1, 'content_type': 'csv',
+                'path': None, 'sheet_names': None}
+        data_gen = test_etl._transform(Mock(), data)
+        test_etl._load(Mock(), data_gen)
+
+        metrics = test_etl.stage_metrics
+        assert {'transform', 'clean', 'insert', 'commit'} == set(metrics.keys())
+        assert 5 == metrics['clean']['rows'] == metrics['transform']['rows'] == metrics['insert']['rows']
+        assert len(training_fixture1_content_str) == metrics['clean']['bytes']
+        assert metrics['clean']['wall_seconds'] > 0
+        recorded_stages = [i[0][0] for i in sink.record.call_args_list]
+        # The stages that wrap the lazy rows are recorded once.
+        assert 1 == recorded_stages.count('transform') == recorded_stages.count('clean')
+        assert 1 == recorded_stages.count('commit')
+        assert {'transform', 'clean', 'insert', 'commit'} == set(recorded_stages)
+
+    @mock.patch('modelmapper.ETL.get_session')
+    @mock.patch('modelmapper.ETL._extract')
+    @mock.patch('modelmapper.ETL.insert_chunk_of_data_to_db')
+    def test_metrics(self, mock_insert_chunk, mock_extract, mock_get_session, tmpdir):
+        mock_insert_chunk.side_effect = lambda session, model, chunk: (len(chunk) - 1, 1)
+        mock_extract.return_value = {'content': training_fixture1_content_str, 'raw_key_id': 1,
+                                     'content_type': 'csv', 'path': None, 'sheet_names': None}
+        metrics = EtlMetrics()
+        test_etl = ETL(setup_path=example_setup_path, metrics=metrics)
+        test_etl.RECORDS_MODEL = Mock(__table__='records')
+        test_etl.METRICS_FILE_PATH = str(tmpdir.join('etl.prom'))
+        test_etl.run(use_client=False, backup_data=False)
+
+        with open(test_etl.METRICS_FILE_PATH, 'r') as the_file:
+            content = the_file.read()
+        assert 'modelmapper_etl_rows_inserted_total{job="ETL"} 4\n' in content
+        assert 'modelmapper_etl_rows_existing_total{job="ETL"} 1\n' in content
+        assert 'modelmapper_etl_runs_total{job="ETL",result="success"} 1\n' in content
+        assert 'modelmapper_etl_stage_seconds_count{job="ETL",stage="clean"} 1\n' in content
+
+    @mock.patch('modelmapper.ETL.get_session')
+    @mock.patch('modelmapper.ETL._create_raw_key')
+    @mock.patch('modelmapper.ETL.get_client_data')
+    @mock.patch('modelmapper.ETL.insert_chunk_of_data_to_db')
+    def test_tracing(self, mock_insert_chunk, mock_client_data, mock_create_raw_key, mock_get_session):
+        mock_insert_chunk.side_effect = lambda session, model, chunk: (len(chunk), 0)
+        mock_client_data.return_value = (training_fixture1_content_str, 'some_key.csv')
+        mock_create_raw_key.return_value = 1
+        exporter = Mock()
+        test_etl = ETL(setup_path=example_setup_path, tracer=Tracer(exporters=[exporter]))
+        test_etl.RECORDS_MODEL = Mock(__table__='records')
+        test_etl.SQL_CHUNK_ROWS = 3
+        test_etl._dump_state_after_client_response = Mock()
+        test_etl.run(content_type='csv', backup_data=False)
+
+        spans = {}
+        for call in exporter.on_end.call_args_list:
+            spans.setdefault(call[0][0].name, []).append(call[0][0])
+        assert {'run', 'get_client_data', 'clean', 'insert_chunk_of_data_to_db', 'commit'} == set(spans.keys())
+        run_span = spans['run'][0]
+        assert all(i[0].parent_id == run_span.span_id for i in spans.values() if i[0] is not run_span)
+        assert {'key': 'some_key.csv', 'bytes': len(training_fixture1_content_str)} == \
+            spans['get_client_data'][0].attributes
+        assert [{'rows': 3, 'inserted': 3, 'existing': 0}, {'rows': 2, 'inserted': 2, 'existing': 0}] == \
+            [i.attributes for i in spans['insert_chunk_of_data_to_db']]
+        assert 5 == spans['commit'][0].attributes['inserted']
+        # The clean span covers the lazy cleaning of the rows while they are inserted.
+        assert 5 == spans['clean'][0].attributes['rows']
+        assert spans['clean'][0].end_time >= spans['insert_chunk_of_data_to_db'][0].end_time
+
+    @pytest.mark.parametrize('insert_side_effect, expected_commits', [
+        (None, 2),
+        (core_exc.OperationalError('insert', {}, 'failed'), 1),
+    ])
+    @mock.patch('modelmapper.ETL.report_exception')
+    @mock.patch('modelmapper.ETL.insert_chunk_of_data_to_db')
+    def test_run_stats(self, mock_insert_chunk, mock_report_exception, insert_side_effect, expected_commits):
+        mock_insert_chunk.side_effect = lambda session, model, chunk: (len(chunk) - 1, 1)
+        test_etl = ETL(setup_path=example_setup_path)
+        test_etl.RECORDS_MODEL = Mock(__table__='records')
+        columns = []
+        for name in ('id', 'raw_key_id', 'rows_read', 'rows_inserted', 'rows_existing', 'stage_seconds'):
+            column = Mock()
+            column.name = name
+            columns.append(column)
+        table = Mock(columns=columns)
+        test_etl.RUN_STATS_MODEL = Mock(__table__=table)
+        data = {'content': training_fixture1_content_str, 'raw_key_id': 7, 'content_type': 'csv',
+                'path': None, 'sheet_names': None}
+        session = Mock()
+        session.execute.side_effect = insert_side_effect
+        test_etl._load(session, test_etl._transform(session, data))
+
+        values = table.insert.return_value.values.call_args[1]
+        stage_seconds = values.pop('stage_seconds')
+        assert {'raw_key_id': 7, 'rows_read': 5, 'rows_inserted': 4, 'rows_existing': 1} == values
+        assert {'transform', 'clean', 'insert', 'commit'} == set(stage_seconds.keys())
+        assert expected_commits == session.commit.call_count
+        assert bool(insert_side_effect) == mock_report_exception.called
+
+    @mock.patch('modelmapper.loader.insert')
+    def test_raw_line_signatures(self, mock_insert):
+        data = {'content': training_fixture1_content_str, 'raw_key_id': 7, 'content_type': 'csv',
+                'path': None, 'sheet_names': None}
+
+        def run(known_signatures):
+            test_etl = RawLineETL(setup_path=example_setup_path)
+            test_etl.settings = test_etl.settings._replace(signature_strategy='raw_line')
+            test_etl.RECORDS_MODEL = Mock(__table__='records')
+            test_etl.get_ids_by_signatures = Mock(
+                side_effect=lambda session, model, signatures: {i: 1 for i in signatures if i in known_signatures})
+            session = Mock()
+            session.execute.return_value.rowcount = 5 - len(known_signatures)
+            test_etl._load(session, test_etl._transform(session, data))
+            return test_etl, mock_insert.return_value.values.call_args[0][0]
+
+        test_etl, rows = run(known_signatures=set())
+        signatures = [row['signature'] for row in rows]
+        assert 5 == len(set(signatures))
+        assert 0 == test_etl.line_filter.rows_skipped
+
+        test_etl, rows = run(known_signatures=set(signatures[:3]))
+        assert signatures[3:] == [row['signature'] for row in rows]
+        assert 3 == test_etl.line_filter.rows_skipped
+        assert 2 == test_etl.stage_metrics['clean']['rows']
+        assert 5 == test_etl._get_run_stats(2, 3)['rows_read']
+
+    def test_raw_line_signatures_of_the_loaded_fields(self):
+        test_etl = RawLineETL(setup_path=example_setup_path)
+        test_etl.settings = test_etl.settings._replace(signature_strategy='raw_line', fields_to_be_scrubbed=['make'])
+        test_etl.get_ids_by_signatures = Mock(return_value={})
+        line_filter = test_etl.get_line_filter(Mock())
+        # The scrubbed field and the field that is not in the model are not a part of the signature.
+        clean_names = ['casualty', 'make', 'not_in_model']
+        lines = [['N', 'Kia', 'a'], ['N', 'BMW', 'b'], ['Y', 'Kia', 'a']]
+        assert [lines[0], lines[2]] == list(line_filter(clean_names, lines))
+        assert 1 == line_filter.rows_skipped
+
+    @mock.patch('modelmapper.loader.RawLineSignatureMixin.get_ids_by_signatures')
+    def test_snapshot_raw_line_duplicate_lines(self, mock_get_ids_by_signatures):
+        lines = training_fixture1_content_str.strip().split('\n')
+        # The 2nd line is repeated at the end of the file.
+        content = '\n'.join(lines + [lines[2]]) + '\n'
+        data = {'content': content, 'raw_key_id': 7, 'content_type': 'csv', 'path': None, 'sheet_names': None}
+
+        def run(existing_ids):
+            mock_get_ids_by_signatures.side_effect = lambda session, model, signatures: {
+                i: existing_ids[i] for i in signatures if i in existing_ids}
+            test_etl = self.get_snapshot_etl(existing_ids)
+            test_etl.SIGNATURE_BLOOM_FILTER = False
+            test_etl.settings = test_etl.settings._replace(signature_strategy='raw_line')
+            session = Mock()
+            test_etl._load(session, test_etl._transform(session, data))
+            snapshot_ids = [i['record_id'] for call in test_etl.insert_snapshot_rows.call_args_list
+                            for i in call[0][1]]
+            return test_etl, snapshot_ids
+
+        # The duplicate line is loaded and gets a snapshot row of the record of the first one.
+        test_etl, snapshot_ids = run(existing_ids={})
+        inserted_rows = test_etl.insert_records.call_args[0][2]
+        assert 5 == len(inserted_rows)
+        assert [1, 2, 3, 4, 5, 2] == snapshot_ids
+
+        # Each line of an existing record is skipped and still gets its snapshot row.
+        test_etl, snapshot_ids = run(existing_ids={inserted_rows[1]['signature']: 100})
+        assert 2 == test_etl.line_filter.rows_skipped
+        assert 4 == len(test_etl.insert_records.call_args[0][2])
+        assert [100, 100] == snapshot_ids[:2]
+        assert 6 == len(snapshot_ids)
+
+    def get_snapshot_etl(self, existing_ids):
+        test_etl = SnapshotETL(setup_path=example_setup_path)
+        columns = [Mock(description=name, default=None) for name in (
+            'casualty', 'value_current', 'last_payment_date', 'year', 'score', 'slope', 'available', 'make')]
+        test_etl.RECORDS_MODEL = Mock(__table__=Mock(columns=columns))
+        test_etl.SNAPSHOT_MODEL = Mock(__table__=Mock())
+        test_etl.insert_records = Mock(side_effect=lambda session, model, rows: {
+            row['signature']: i for i, row in enumerate(rows, len(existing_ids) + 1)})
+        test_etl.insert_snapshot_rows = Mock()
+        test_etl.post_row_insert = Mock()
+        return test_etl
+
+    @mock.patch('modelmapper.loader.RawLineSignatureMixin.get_ids_by_signatures')
+    def test_snapshot_bloom_filter(self, mock_get_ids_by_signatures, tmpdir):
+        mock_get_ids_by_signatures.return_value = {}
+        data = {'content': training_fixture1_content_str, 'raw_key_id': 7, 'content_type': 'csv',
+                'path': None, 'sheet_names': None}
+        bloom_filter_path = str(tmpdir.join('signatures.bloom'))
+
+        def run(existing_signatures):
+            mock_get_ids_by_signatures.reset_mock()
+            test_etl = self.get_snapshot_etl({})
+            test_etl.SIGNATURE_BLOOM_FILTER_PATH = bloom_filter_path
+            test_etl.get_signature_count = Mock(return_value=len(existing_signatures))
+            test_etl.get_all_signatures = Mock(return_value=iter(existing_signatures))
+            session = Mock()
+            test_etl._load(session, test_etl._transform(session, data))
+            return test_etl, mock_get_ids_by_signatures.call_args[0][2]
+
+        test_etl, looked_up_signatures = run(existing_signatures=['not in the file'])
+        # All the rows are definitely new so none of them are looked up.
+        assert [] == looked_up_signatures
+        assert 1 == test_etl.get_all_signatures.call_count
+
+        # The next run loads the saved filter that has the inserted rows.
+        test_etl, looked_up_signatures = run(existing_signatures=[])
+        assert not test_etl.get_all_signatures.called
+        assert 5 == len(looked_up_signatures)
+        # The signatures that were already in the filter are not counted again.
+        assert 1 + 5 == len(BloomFilter.load(bloom_filter_path))
+
+    @mock.patch('modelmapper.loader.RawLineSignatureMixin.get_ids_by_signatures')
+    def test_snapshot_batches(self, mock_get_ids_by_signatures):
+        data = {'content': training_fixture1_content_str, 'raw_key_id': 7, 'content_type': 'csv',
+                'path': None, 'sheet_names': None}
+        test_etl = self.get_snapshot_etl({})
+        test_etl.SIGNATURE_BLOOM_FILTER = False
+        signatures = test_etl.signature_plan.generate_signatures(
+            list(test_etl.cleaner.clean('csv', content=training_fixture1_content_str)))
+        existing_ids = {signatures[0]: 100, signatures[1]: 101}
+        # The 3rd row is inserted by someone else after it is looked up.
+        mock_get_ids_by_signatures.side_effect = [existing_ids, {signatures[2]: 102}]
+        test_etl.insert_records.side_effect = lambda session, model, rows: {
+            row['signature']: i for i, row in enumerate(rows[1:], 1)}
+        session = Mock()
+        result = test_etl.insert_chunk_of_data_to_db(
+            session, test_etl.RECORDS_MODEL, test_etl._transform(session, data))
+
+        assert (5, 3) == result
+        assert 1 == test_etl.insert_records.call_count
+        assert signatures[2:] == [row['signature'] for row in test_etl.insert_records.call_args[0][2]]
+        assert {signatures[2]} == mock_get_ids_by_signatures.call_args[0][2]
+        assert [100, 101, 102, 1, 2] == [i['record_id'] for i in test_etl.insert_snapshot_rows.call_args[0][1]]
+        assert [1, 2] == [i[0][0]['id'] for i in test_etl.post_row_insert.call_args_list]
+        assert not session.execute.called
+
+    @mock.patch('modelmapper.loader.RawLineSignatureMixin.get_ids_by_signatures')
+    def test_snapshot_conflicted_row_not_found(self, mock_get_ids_by_signatures):
+        data = {'content': training_fixture1_content_str, 'raw_key_id': 7, 'content_type': 'csv',
+                'path': None, 'sheet_names': None}
+        test_etl = self.get_snapshot_etl({})
+        test_etl.SIGNATURE_BLOOM_FILTER = False
+        signatures = test_etl.signature_plan.generate_signatures(
+            list(test_etl.cleaner.clean('csv', content=training_fixture1_content_str)))
+        # The 1st row conflicted but it is not found when it is looked up again.
+        mock_get_ids_by_signatures.side_effect = [{}, {}]
+        test_etl.insert_records.side_effect = lambda session, model, rows: {
+            row['signature']: i for i, row in enumerate(rows[1:], 1)}
+        session = Mock()
+        result = test_etl.insert_chunk_of_data_to_db(
+            session, test_etl.RECORDS_MODEL, test_etl._transform(session, data))
+
+        assert (4, 0) == result
+        assert {signatures[0]} == mock_get_ids_by_signatures.call_args[0][2]
+        assert [1, 2, 3, 4] == [i['record_id'] for i in test_etl.insert_snapshot_rows.call_args[0][1]]
+
+    def test_snapshot_insert_records_statement(self):
+        metadata = MetaData()
+        table = Table('records', metadata, Column('id', Integer, primary_key=True),
+                      Column('signature', String, unique=True))
+        session = Mock()
+        session.get_bind.return_value.dialect.name = 'postgresql'
+        test_etl = SnapshotETL(setup_path=example_setup_path)
+        session.execute.return_value.fetchall.return_value = [(1, 'a')]
+        assert {'a': 1} == test_etl.insert_records(session, Mock(__table__=table), [{'signature': 'a'}])
+        query = str(session.execute.call_args[0][0].compile(dialect=postgresql.dialect()))
+        assert query.endswith('ON CONFLICT (signature) DO NOTHING RETURNING records.id, records.signature')
+
+    @pytest.mark.parametrize("dialect_name, unique_index", [
+        ('postgresql', False),
+        ('sqlite', True),
+    ])
+    def test_snapshot_insert_records_one_by_one(self, dialect_name, unique_index):
+        metadata = MetaData()
+        table = Table('records', metadata, Column('id', Integer, primary_key=True), Column('signature', String))
+        if unique_index:
+            Index('records_signature_idx', table.c.signature, unique=True)
+        session = Mock()
+        session.get_bind.return_value.dialect.name = dialect_name
+        session.execute.return_value.inserted_primary_key = [3]
+        test_etl = SnapshotETL(setup_path=example_setup_path)
+        model = Mock(__table__=table)
+        postgresql_session = Mock()
+        postgresql_session.get_bind.return_value.dialect.name = 'postgresql'
+        assert unique_index == test_etl.has_unique_signature(postgresql_session, model)
+        assert {'a': 3, 'b': 3} == test_etl.insert_records(session, model, [{'signature': 'a'}, {'signature': 'b'}])
+        assert 2 == session.execute.call_count
+        query = str(session.execute.call_args[0][0].compile(dialect=postgresql.dialect()))
+        assert 'ON CONFLICT' not in query
+
+    def test_postgres_copy_loader(self):
+        data = {'content': training_fixture1_content_str, 'raw_key_id': 7, 'content_type': 'csv',
+                'path': None, 'sheet_names': None}
+        metadata = MetaData()
+        table = Table('records', metadata, Column('id', Integer, primary_key=True), Column('raw_key_id', Integer),
+                      Column('signature', String), Column('make', String), Column('year', Integer))
+        test_etl = CopyETL(setup_path=example_setup_path)
+        test_etl.RECORDS_MODEL = Mock(__table__=table)
+        copied = []
+        cursor = Mock(spec=['copy_expert', 'close'])
+        cursor.copy_expert.side_effect = lambda query, copy_buffer, size: copied.append((query, copy_buffer.read()))
+        connection = Mock(dialect=postgresql.dialect())
+        connection.connection.cursor.return_value = cursor
+        connection.execute.return_value.rowcount = 4
+        session = Mock()
+        session.connection.return_value = connection
+        test_etl.all_recent_rows_signatures = set()
+
+        with mock.patch.object(Table, 'create', autospec=True) as mock_create:
+            result = test_etl.insert_chunk_of_data_to_db(
+                session, test_etl.RECORDS_MODEL, test_etl._transform(session, data))
+            # Forgetting the signatures of the rows so the next chunks load them again.
+            test_etl.all_recent_rows_signatures = set()
+            test_etl.insert_chunk_of_data_to_db(session, test_etl.RECORDS_MODEL, test_etl._transform(session, data))
+            assert 1 == mock_create.call_count
+            session.transaction = Mock()
+            test_etl.all_recent_rows_signatures = set()
+            test_etl.insert_chunk_of_data_to_db(session, test_etl.RECORDS_MODEL, test_etl._transform(session, data))
+            # The temporary table is dropped on commit.
+            assert 2 == mock_create.call_count
+        assert 'records_copy' == mock_create.call_args[0][0].name
+
+        assert (4, None) == result
+        query, content = copied[0]
+        assert 'COPY records_copy (raw_key_id, signature, make, year) FROM STDIN' == query
+        lines = content.splitlines()
+        assert 5 == len(lines)
+        assert lines[0].startswith('7\t')
+        assert lines[0].endswith('\tCadillac\t2015')
+        insert_query = str(connection.execute.call_args_list[0][0][0].compile(dialect=postgresql.dialect()))
+        assert insert_query.startswith('INSERT INTO records (raw_key_id, signature, make, year) SELECT')
+        assert insert_query.endswith('ON CONFLICT DO NOTHING')
+        assert 'TRUNCATE records_copy' == str(connection.execute.call_args_list[1][0][0])
+        assert cursor.close.called
@@ -0,0 +1,67 @@
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from modelmapper.instrumentation import EtlInstrumentation, StageMetrics
+
+
+def slow_rows(count, seconds):
+    for i in range(count):
+        time.sleep(seconds)
+        yield {'id': i}
+
+
+class TestEtlInstrumentation:
+
+    def test_stage(self):
+        instrumentation = EtlInstrumentation()
+        with instrumentation.stage('hash', bytes=10) as metrics:
+            metrics.rows = 2
+        with instrumentation.stage('hash', bytes=5):
+            pass
+        result = instrumentation.to_dict()['hash']
+        assert 15 == result['bytes']
+        assert 2 == result['rows']
+        assert result['wall_seconds'] > 0
+
+    def test_stage_is_recorded_when_it_raises(self):
+        instrumentation = EtlInstrumentation()
+        with pytest.raises(ValueError):
+            with instrumentation.stage('download'):
+                raise ValueError()
+        assert ['download'] == list(instrumentation.metrics.keys())
+        assert not instrumentation._stack
+
+    def test_lazy_rows_are_attributed_to_their_stage(self):
+        sink = Mock()
+        instrumentation = EtlInstrumentation(sinks=[sink])
+        rows = instrumentation.iterate('clean', slow_rows(5, 0.02))
+        with instrumentation.stage('insert'):
+            assert 5 == len(list(rows))
+        metrics = instrumentation.to_dict()
+        assert 5 == metrics['clean']['rows']
+        assert metrics['clean']['wall_seconds'] >= 0.1
+        assert metrics['insert']['wall_seconds'] < 0.05
+        assert ['clean', 'insert'] == [i[0][0] for i in sink.record.call_args_list]
+
+    def test_partially_consumed_rows_are_recorded_when_closed(self):
+        instrumentation = EtlInstrumentation()
+        rows = instrumentation.iterate('clean', slow_rows(5, 0))
+        next(rows)
+        rows.close()
+        assert 1 == instrumentation.to_dict()['clean']['rows']
+        assert 'rows/sec' in instrumentation.get_report_str()
+
+    def test_measured_work_is_recorded_once_with_the_rows(self):
+        sink = Mock()
+        instrumentation = EtlInstrumentation(sinks=[sink])
+        metrics = StageMetrics(bytes=10)
+        with instrumentation.measure(metrics):
+            time.sleep(0.05)
+        assert not sink.record.called
+        assert 3 == len(list(instrumentation.iterate('clean', slow_rows(3, 0), metrics=metrics)))
+        assert ['clean'] == [i[0][0] for i in sink.record.call_args_list]
+        result = instrumentation.to_dict()['clean']
+        assert (10, 3) == (result['bytes'], result['rows'])
+        assert result['wall_seconds'] >= 0.05
@@ -1,4 +1,5 @@
 import os
+import shutil
 import pytest
 from unittest import mock
 from collections import Counter
@@ -6,7 +7,9 @@ from deepdiff import DeepDiff
 
 from modelmapper import Mapper
 from modelmapper.mapper import FieldResult, SqlalchemyFieldType, get_field_result_from_dict
-from modelmapper.stats import FieldStats
+from modelmapper.misc import load_toml, write_toml
+from modelmapper.stats import FieldStats, UserInferenceRequired
+from modelmapper.types import HasString
 from tests.fixtures.training_fixture1_mapping import all_fixture1_values, all_field_results_fixture1, all_field_sqlalchemy_str_fixture1  # NOQA
 from tests.fixtures.analysis_fixtures import (analysis_fixture_a, analysis_fixture_b, override_fixture1,
                                               analysis_fixture_a_only_combined, analysis_fixture_a_and_b_combined,
@@ -154,6 +157,84 @@ class TestMapper:
             diff = DeepDiff(all_field_results_fixture1[field_name], field_result)
             assert not diff
 
+    def test_get_field_results_from_csv_with_sample(self, all_field_results_fixture1, mapper):
+        mapper.settings = mapper.settings._replace(training_sample_size=2)
+        for field_name, field_result in mapper._get_field_results_from_csv(training_fixture1_path):
+            diff = DeepDiff(all_field_results_fixture1[field_name], field_result)
+            assert not diff
+
+    @pytest.mark.parametrize("sample_size", [0, 2])
+    def test_get_field_results_from_csv_streaming(self, sample_size, all_field_results_fixture1, mapper):
+        mapper.settings = mapper.settings._replace(training_streaming=True, training_sample_size=sample_size)
+        field_names = []
+        for field_name, field_result in mapper._get_field_results_from_csv(training_fixture1_path):
+            field_names.append(field_name)
+            diff = DeepDiff(all_field_results_fixture1[field_name], field_result)
+            assert not diff
+        assert list(mapper._get_all_values_per_clean_name(training_fixture1_path).keys()) == field_names
+
+    @mock.patch('modelmapper.base.read_csv_gen', side_effect=AssertionError('Should read the file line by line'))
+    def test_get_field_results_from_csv_streaming_line_by_line(self, mock_read_csv_gen, all_field_results_fixture1,
+                                                               mapper):
+        mapper.settings = mapper.settings._replace(training_streaming=True)
+        results = dict(mapper._get_field_results_from_csv(training_fixture1_path))
+        assert not DeepDiff(all_field_results_fixture1, results)
+
+    def test_get_streamed_stats_per_field_failed_to_infer(self, mapper):
+        mapper.failed_to_infer_fields = set()
+        inspect_streamed_item = mapper._inspect_streamed_item
+
+        def _inspect_streamed_item(collector, field_name, item):
+            if field_name == 'make':
+                raise UserInferenceRequired(HasString, 'Some other question.')
+            inspect_streamed_item(collector, field_name, item)
+
+        with mock.patch.object(mapper, '_inspect_streamed_item', side_effect=_inspect_streamed_item):
+            field_names = [i for i, _ in mapper._get_streamed_stats_per_field(training_fixture1_path)]
+        assert 'make' not in field_names
+        assert {'make'} == mapper.failed_to_infer_fields
+
+    @pytest.mark.parametrize("streaming", [False, True])
+    def test_get_field_results_from_csv_short_circuit_strings(self, streaming, all_field_results_fixture1, mapper):
+        mapper.settings = mapper.settings._replace(training_short_circuit_string_fields=True,
+                                                   training_streaming=streaming)
+        for field_name, field_result in mapper._get_field_results_from_csv(training_fixture1_path):
+            diff = DeepDiff(all_field_results_fixture1[field_name], field_result)
+            assert not diff
+
+    @pytest.mark.parametrize("shard_count", [1, 3])
+    def test_merge_partial_stats(self, shard_count, all_field_results_fixture1, mapper, tmpdir):
+        paths = []
+        for shard_index in range(shard_count):
+            all_stats = mapper.get_partial_stats(csv_paths=[training_fixture1_path],
+                                                 shard_index=shard_index, shard_count=shard_count)
+            path = str(tmpdir.join(f'partial_{shard_index}.json'))
+            mapper.write_partial_stats(path, all_stats)
+            paths.append(path)
+        merged = mapper.merge_partial_stats(mapper.load_partial_stats(path) for path in paths)
+        assert set(all_field_results_fixture1.keys()) <= set(merged.keys())
+        for field_name, stats in merged.items():
+            field_result = mapper._get_field_result_from_stats(field_name=field_name, stats=stats)
+            if field_result:
+                diff = DeepDiff(all_field_results_fixture1[field_name], field_result)
+                assert not diff
+
+    def test_get_values_of_field_gen(self, all_fixture1_values, mapper):
+        for field_name, values in all_fixture1_values.items():
+            assert values == list(mapper._get_values_of_field_gen(training_fixture1_path, field_name))
+
+    @pytest.mark.parametrize("sample_size, items, expected_sample_len", [
+        (0, ['a', 'b', 'c'], 3),
+        (5, ['a', 'b', 'c'], 3),
+        (2, ['a', 'b', 'c'], 2),
+    ])
+    def test_split_training_sample(self, sample_size, items, expected_sample_len, mapper):
+        mapper.settings = mapper.settings._replace(training_sample_size=sample_size)
+        sample, rest = mapper._split_training_sample('blah', items)
+        assert expected_sample_len == len(sample)
+        assert sorted(items) == sorted(sample + rest)
+        assert (sample, rest) == mapper._split_training_sample('blah', items)
+
     def test_get_field_orm_string(self, all_field_results_fixture1, all_field_sqlalchemy_str_fixture1, mapper):
         for field_name, field_result in all_field_results_fixture1.items():
             assert all_field_sqlalchemy_str_fixture1[field_name] == mapper._get_field_orm_string(
@@ -168,6 +249,111 @@ class TestMapper:
         diff = DeepDiff(expected_results, results)
         assert not diff
 
+    @mock.patch('modelmapper.mapper.get_user_choice', side_effect=AssertionError('Should not prompt'))
+    def test_get_stats_non_interactive(self, mock_get_user_choice, tmpdir):
+        mapper = Mapper(example_setup_path, non_interactive=True)
+        items = ['1/2/2018', '1/3/2018', '10:11 1/4/2018', '1/5/2018', '10:12 1/6/2018', 'Jan 7 2018 10:13']
+        stats = mapper._get_stats('date_of_sale', items)
+        assert Counter(HasDateTime=3, HasString=3) == stats.counter
+        assert {'date_of_sale'} == set(mapper.questions.keys())
+        # One question per shape of the items.
+        assert ['10:11 1/4/2018', 'Jan 7 2018 10:13'] == [i['item'] for i in mapper.questions['date_of_sale']]
+
+        mapper.settings = mapper.settings._replace(questions_path=str(tmpdir.join('questions.toml')))
+        mapper._write_questions()
+        assert 2 == len(load_toml(mapper.settings.questions_path)['date_of_sale'])
+        mapper._apply_answered_questions()
+        assert {} == mapper.questions
+
+    @mock.patch('modelmapper.Mapper.write_orm_model')
+    @mock.patch('modelmapper.Mapper.combine_results')
+    @mock.patch('modelmapper.Mapper.analyze')
+    def test_run_non_interactive_with_pending_questions(self, mock_analyze, mock_combine_results,
+                                                        mock_write_orm_model, tmpdir):
+        mapper = Mapper(example_setup_path, non_interactive=True)
+        mapper.settings = mapper.settings._replace(questions_path=str(tmpdir.join('questions.toml')))
+        items = ['1/2/2018', '1/3/2018', '10:11 1/4/2018', '1/5/2018', '10:12 1/6/2018']
+        mock_analyze.side_effect = lambda: mapper._get_stats('date_of_sale', items)
+        mapper.run()
+        assert ['date_of_sale'] == mapper.get_pending_questions()
+        assert not mock_combine_results.called
+        assert not mock_write_orm_model.called
+
+    @mock.patch('modelmapper.mapper.write_settings')
+    def test_apply_answered_questions(self, mock_write_settings, tmpdir):
+        mapper = Mapper(example_setup_path, non_interactive=True)
+        mapper.settings = mapper.settings._replace(questions_path=str(tmpdir.join('questions.toml')))
+        items = ['1/2/2018', '1/3/2018', '10:11 1/4/2018', '1/5/2018', '10:12 1/6/2018']
+        mapper._get_stats('date_of_sale', items)
+        mapper._get_stats('last_sold', items + ['Jan 7 2018 10:13'])
+        mapper.questions['date_of_sale'][0]['not_datetime'] = True
+        mapper.questions['last_sold'][0]['datetime_format'] = '%H:%M %m/%d/%Y'
+        mapper._write_questions()
+        assert ['last_sold'] == mapper.get_pending_questions()
+        mapper.questions['last_sold'][1]['datetime_format'] = '%b %d %Y %H:%M'
+        mapper._write_questions()
+        assert [] == mapper.get_pending_questions()
+
+        mapper._apply_answered_questions()
+        assert {'%H:%M %m/%d/%Y', '%b %d %Y %H:%M'} <= mapper.settings.datetime_formats
+        assert mock_write_settings.called
+        stats = mapper._get_stats('date_of_sale', items,
+                                  ignore_matchers=mapper._get_ignore_matchers_of_field('date_of_sale'))
+        assert Counter(HasString=5) == stats.counter
+        assert {'date_of_sale', 'last_sold'} == set(mapper.questions.keys())
+        stats = mapper._get_stats('last_sold', ['Jan 7 2018 10:13', 'Feb 8 2018 11:00'])
+        assert Counter(HasDateTime=2) == stats.counter
+        assert [] == mapper.get_pending_questions()
+
+    @mock.patch('modelmapper.mapper.write_settings')
+    def test_apply_answered_questions_of_one_question_per_field(self, mock_write_settings, tmpdir):
+        mapper = Mapper(example_setup_path, non_interactive=True)
+        mapper.settings = mapper.settings._replace(questions_path=str(tmpdir.join('questions.toml')))
+        write_toml(mapper.settings.questions_path, {'last_sold': {
+            'item': '10:11 1/4/2018', 'datetime_format': '%H:%M %m/%d/%Y', 'not_datetime': False}})
+        mapper._apply_answered_questions()
+        assert '%H:%M %m/%d/%Y' in mapper.settings.datetime_formats
+        assert ['10:11 1/4/2018'] == [i['item'] for i in mapper.questions['last_sold']]
+
+    def test_analyze_with_analysis_store(self, mapper, tmpdir):
+        expected_results = mapper._read_analyzed_csv_results()
+        mapper.settings = mapper.settings._replace(analysis_store_path=str(tmpdir.join('analysis.sqlite')))
+        with mock.patch('modelmapper.mapper.write_toml') as mock_write_toml:
+            mapper.analyze()
+        assert not mock_write_toml.called
+        diff = DeepDiff(expected_results, mapper._read_analyzed_csv_results())
+        assert not diff
+
+    def test_analyze_with_analysis_store_reuses_unchanged_csvs(self, mapper, tmpdir):
+        csv_paths = []
+        for csv_path in mapper.settings.training_csvs:
+            new_path = str(tmpdir.join(os.path.basename(csv_path)))
+            shutil.copy(mapper._get_csv_full_path(csv_path), new_path)
+            csv_paths.append(new_path)
+        mapper.settings = mapper.settings._replace(
+            analysis_store_path=str(tmpdir.join('analysis.sqlite')), training_csvs=csv_paths)
+        expected_results = mapper.analyze()
+        expected_empty_fields = mapper.empty_fields
+        mapper.empty_fields = set()
+        with mock.patch.object(mapper, '_get_clean_names_and_csv_data_gen') as mock_read_csv:
+            assert not DeepDiff(expected_results, mapper.analyze())
+        assert not mock_read_csv.called
+        assert expected_empty_fields == mapper.empty_fields
+
+        stat = os.stat(csv_paths[1])
+        os.utime(csv_paths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        with mock.patch.object(mapper, '_get_clean_names_and_csv_data_gen',
+                               wraps=mapper._get_clean_names_and_csv_data_gen) as mock_read_csv:
+            assert not DeepDiff(expected_results, mapper.analyze())
+        assert [mock.call(csv_paths[1])] == mock_read_csv.call_args_list
+
+        # Changing the settings analyzes all the csvs again.
+        mapper.settings = mapper.settings._replace(add_to_string_length=mapper.settings.add_to_string_length + 1)
+        with mock.patch.object(mapper, '_get_clean_names_and_csv_data_gen',
+                               wraps=mapper._get_clean_names_and_csv_data_gen) as mock_read_csv:
+            mapper.analyze()
+        assert 2 == mock_read_csv.call_count
+
     @pytest.mark.parametrize("item, expected", [
         ({'field_db_str': "Boolean", 'is_nullable': True},
          FieldResult(field_db_sqlalchemy_type=SqlalchemyFieldType.Boolean, is_nullable=True)),
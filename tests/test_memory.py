@@ -0,0 +1,89 @@
+import os
+import tracemalloc
+from unittest import mock
+
+import pytest
+
+from modelmapper import Cleaner
+from modelmapper.memory import MemoryProfiler, get_rss_bytes
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+example_setup_path = os.path.join(current_dir, '../modelmapper/example/some_model_setup.toml')
+training_fixture1_path = os.path.join(current_dir, 'fixtures/training_fixture1.csv')
+
+MB = 2 ** 20
+
+
+def allocate(size):
+    return bytearray(size)
+
+
+class TestMemoryProfiler:
+
+    def test_tracemalloc_stages(self):
+        profiler = MemoryProfiler(warning_bytes=8 * MB)
+        profiler.start()
+        try:
+            with profiler.stage('fetch'):
+                kept = allocate(2 * MB)
+            with mock.patch('modelmapper.memory.logger') as mock_logger:
+                for i in range(2):
+                    with profiler.stage('insert'):
+                        allocate(10 * MB)
+        finally:
+            profiler.stop()
+        assert not tracemalloc.is_tracing()
+
+        stats = profiler.to_dict()
+        assert 2 * MB <= stats['fetch']['peak_bytes']
+        assert 2 * MB <= stats['fetch']['retained_bytes'] < 3 * MB
+        assert any('test_memory.py' in site for site, size in stats['fetch']['top_sites'])
+        assert 2 == stats['insert']['calls']
+        assert 10 * MB <= stats['insert']['peak_bytes']
+        assert stats['insert']['retained_bytes'] < MB
+        assert ['insert'] == [i[0] for i in profiler.warnings]
+        assert 1 == mock_logger.warning.call_count
+        assert 'retained bytes' in profiler.get_report_str()
+        del kept
+
+    def test_nested_stages_keep_the_peak_of_the_outer_stage(self):
+        profiler = MemoryProfiler(top_sites=0)
+        profiler.start()
+        try:
+            with profiler.stage('outer'):
+                allocate(10 * MB)
+                with profiler.stage('inner'):
+                    allocate(MB)
+        finally:
+            profiler.stop()
+        stats = profiler.to_dict()
+        assert 10 * MB <= stats['outer']['peak_bytes']
+        assert MB <= stats['inner']['peak_bytes'] < 10 * MB
+
+    def test_stage_is_not_profiled_when_not_started(self):
+        profiler = MemoryProfiler()
+        with profiler.stage('fetch'):
+            pass
+        assert {} == profiler.to_dict()
+
+    def test_rss(self):
+        profiler = MemoryProfiler(mode='rss')
+        with profiler.stage('fetch'):
+            pass
+        assert get_rss_bytes() > 0
+        assert 1 == profiler.to_dict()['fetch']['calls']
+        assert profiler.to_dict()['fetch']['peak_bytes'] > 0
+
+    def test_invalid_mode(self):
+        with pytest.raises(ValueError):
+            MemoryProfiler(mode='psutil')
+
+    def test_cleaner_stages(self):
+        cleaner = Cleaner(example_setup_path)
+        assert cleaner.memory_profiler is None
+        cleaner.memory_profiler = MemoryProfiler()
+        with open(training_fixture1_path, 'rb') as the_file:
+            result = list(cleaner.clean('csv', content=the_file.read()))
+        assert 5 == len(result)
+        assert ['decode', 'transpose', 'clean'] == list(cleaner.memory_profiler.to_dict().keys())
+        assert not tracemalloc.is_tracing()
@@ -0,0 +1,77 @@
+import urllib.request
+
+import pytest
+
+from modelmapper.instrumentation import EtlInstrumentation
+from modelmapper.metrics import MetricsRegistry, EtlMetrics
+
+
+class TestMetrics:
+
+    def test_get_text(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('rows_total', 'Rows.', ['job'])
+        counter.inc(3, job='a')
+        counter.inc(job='a')
+        counter.inc(2, job='b"c')
+        histogram = registry.histogram('latency_seconds', 'Latency.', buckets=[0.1, 1])
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        expected = '\n'.join([
+            '# HELP rows_total Rows.',
+            '# TYPE rows_total counter',
+            'rows_total{job="a"} 4',
+            'rows_total{job="b\\"c"} 2',
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3',
+        ]) + '\n'
+        assert expected == registry.get_text()
+
+    def test_invalid_metrics(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('rows_total', 'Rows.', ['job'])
+        assert counter is registry.counter('rows_total', 'Rows.', ['job'])
+        with pytest.raises(ValueError):
+            registry.histogram('rows_total', 'Rows.')
+        with pytest.raises(ValueError):
+            registry.counter('rows-total', 'Rows.')
+        with pytest.raises(ValueError):
+            counter.inc(job='a', stage='b')
+        with pytest.raises(ValueError):
+            counter.inc(-1, job='a')
+
+    def test_write_text_file_and_serve(self, tmpdir):
+        metrics = EtlMetrics()
+        metrics.record_load('SomeJob', rows_inserted=10, rows_existing=2)
+        path = str(tmpdir.join('etl.prom'))
+        metrics.write_text_file(path)
+        with open(path, 'r') as the_file:
+            content = the_file.read()
+        assert 'modelmapper_etl_rows_inserted_total{job="SomeJob"} 10\n' in content
+        assert ['etl.prom'] == [i.basename for i in tmpdir.listdir()]
+
+        server = metrics.serve(port=0)
+        try:
+            url = 'http://{}:{}/metrics'.format(*server.server_address)
+            with urllib.request.urlopen(url) as response:
+                assert content == response.read().decode('utf-8')
+                assert response.headers['Content-Type'].startswith('text/plain')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_stage_sink(self):
+        metrics = EtlMetrics()
+        instrumentation = EtlInstrumentation(sinks=[metrics.get_stage_sink('SomeJob')])
+        with instrumentation.stage('download', bytes=100):
+            pass
+        list(instrumentation.iterate('clean', range(7)))
+        assert 100 == metrics.bytes_downloaded.get_value(job='SomeJob')
+        assert 7 == metrics.stage_rows.get_value(job='SomeJob', stage='clean')
+        assert 1 == metrics.stage_seconds.get_count(job='SomeJob', stage='download')
@@ -6,9 +6,9 @@ import pytest
 from unittest import mock
 from deepdiff import DeepDiff
 from modelmapper.misc import (escape_word, get_combined_dict, load_toml, convert_dict_key,
-                              convert_dict_item_type, write_toml, write_settings, read_csv_gen,
+                              convert_dict_item_type, write_toml, write_settings, read_csv_gen, read_csv_lines_gen,
                               DefaultList, generator_chunker, generator_updater, decode_bytes,
-                              camel_to_snake)
+                              camel_to_snake, get_encoding_of_bytes, ENCODING_SAMPLE_SIZE, FALLBACK_ENCODING)
 from modelmapper.mapper import SqlalchemyFieldType
 from tests.fixtures.analysis_fixtures import analysis_fixture_c_in_dict  # NOQA
 from tests.fixtures.excel_fixtures import xls_xml_contents_in_json2, csv_contents2, offset_header, corrected_header
@@ -167,6 +167,41 @@ class TestMisc:
         with pytest.raises(csv.Error):
             list(read_csv_gen(offset_io))
 
+    @pytest.mark.parametrize('encoding, bom', [
+        ('utf-8', b''),
+        ('utf-8', b'\xef\xbb\xbf'),
+        ('utf-16-le', b'\xff\xfe'),
+        ('utf-16-be', b'\xfe\xff'),
+    ])
+    @pytest.mark.parametrize('newline', ['\n', '\r\n', '\r'])
+    def test_read_csv_lines_gen(self, encoding, bom, newline, tmpdir):
+        contents = csv_contents2().replace('\n', newline)
+        path = tmpdir.join('contents.csv')
+        path.write_binary(bom + contents.encode(encoding))
+        expected = list(read_csv_gen(str(path)))
+        assert xls_xml_contents_in_json2()['Sheet1'] == expected
+        assert expected == list(read_csv_lines_gen(str(path)))
+
+    def test_read_csv_lines_gen_with_bytes_not_in_the_encoding(self, tmpdir):
+        path = tmpdir.join('contents.csv')
+        lines = ['name,city'] + [f'name{i},city{i}' for i in range(ENCODING_SAMPLE_SIZE // 10)]
+        # The encoding is detected to be utf-8 from the start of the file.
+        path.write_binary('\n'.join(lines).encode('utf-8') + b'\nTOM O\x92DEA,S\x81O PAULO\n')
+        rows = list(read_csv_lines_gen(str(path), identify_header_by_column_names={'name', 'city'}))
+        assert len(lines) + 1 == len(rows)
+        assert ['TOM O\u2019DEA', 'S\x81O PAULO'] == rows[-1]
+
+    def test_read_csv_lines_gen_with_encoding_that_is_not_detected(self, tmpdir):
+        path = tmpdir.join('contents.csv')
+        path.write_binary(b'name,city\nTOM O\x92DEA,S\x81O PAULO\n')
+        with mock.patch('modelmapper.misc.cchardet.detect', return_value={'encoding': None, 'confidence': None}):
+            rows = list(read_csv_lines_gen(str(path), identify_header_by_column_names={'name', 'city'}))
+        assert [['name', 'city'], ['TOM O\u2019DEA', 'S\x81O PAULO']] == rows
+
+    def test_get_encoding_of_bytes_that_is_not_detected(self):
+        with mock.patch('modelmapper.misc.cchardet.detect', return_value={'encoding': None, 'confidence': None}):
+            assert FALLBACK_ENCODING == get_encoding_of_bytes(b'O\x92DEA')
+
     _content = 'blah'
     _content_bytes = _content.encode('utf-8')
     _content_bytes_utf8 = _content.encode('utf-8-sig')
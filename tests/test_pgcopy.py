@@ -0,0 +1,52 @@
+import datetime
+from decimal import Decimal
+from uuid import UUID
+
+import pytest
+
+from modelmapper.pgcopy import get_copy_text_value, get_copy_text_line, CopyTextBuffer
+
+
+class TestPgCopy:
+
+    @pytest.mark.parametrize('value, expected', [
+        (None, '\\N'),
+        (True, 't'),
+        (False, 'f'),
+        (0, '0'),
+        (-12, '-12'),
+        (1.5, '1.5'),
+        (Decimal('1.50'), '1.50'),
+        (datetime.datetime(2018, 5, 5, 13, 1, 2), '2018-05-05T13:01:02'),
+        (datetime.datetime(2018, 5, 5, tzinfo=datetime.timezone.utc), '2018-05-05T00:00:00+00:00'),
+        (datetime.date(2018, 5, 5), '2018-05-05'),
+        (b'\x00\xff', '\\\\x00ff'),
+        ({'a': 1}, '{"a": 1}'),
+        (UUID('12345678123456781234567812345678'), '12345678-1234-5678-1234-567812345678'),
+        ('Cadillac', 'Cadillac'),
+        ('a\tb\nc\rd\\e', 'a\\tb\\nc\\rd\\\\e'),
+        ('\\N', '\\\\N'),
+    ])
+    def test_get_copy_text_value(self, value, expected):
+        assert expected == get_copy_text_value(value)
+
+    def test_get_copy_text_line(self):
+        row = {'make': 'BMW', 'year': 2015, 'available': None}
+        assert 'BMW\t\\N\t2015\t\\N\n' == get_copy_text_line(row, ['make', 'available', 'year', 'missing'])
+
+    @pytest.mark.parametrize('size', [1, 5, 7, 100, -1])
+    def test_copy_text_buffer_read(self, size):
+        rows = [{'a': i, 'b': f'value {i}'} for i in range(20)]
+        expected = ''.join(get_copy_text_line(row, ['a', 'b']) for row in rows)
+        copy_buffer = CopyTextBuffer(rows, ['a', 'b'])
+        pieces = list(iter(lambda: copy_buffer.read(size), ''))
+        assert expected == ''.join(pieces)
+        if size > 0:
+            assert all(len(i) == size for i in pieces[:-1])
+
+    def test_copy_text_buffer_readline(self):
+        copy_buffer = CopyTextBuffer([{'a': 1}, {'a': 2}], ['a'])
+        assert '1' == copy_buffer.read(1)
+        assert '\n' == copy_buffer.readline()
+        assert '2\n' == copy_buffer.readline()
+        assert '' == copy_buffer.readline()
@@ -1,3 +1,4 @@
+import sys
 import datetime
 from decimal import Decimal
 import pytest
@@ -10,7 +11,9 @@ from modelmapper.signature import (
     drop_model_defaults,
     sort_row_values,
     get_byte_str_of_row,
-    get_hash_of_bytes
+    get_hash_of_bytes,
+    SignaturePlan,
+    BoundedSignatureSet,
 )
 
 Base = declarative_base()
@@ -72,3 +75,68 @@ class TestSignatures:
     ])
     def test_generate_row_signature(self, row, ignore_fields, expected):
         assert generate_row_signature(row, Model, ignore_fields) == expected
+
+    @pytest.mark.parametrize("model, ignore_fields, signature_size, x64arch", [
+        (Model, ['id'], 128, True),
+        (Model, ['id', 'field_decimal'], 64, False),
+        (Model, [], 32, True),
+        (None, ['id'], 128, True),
+        (None, [], 64, True),
+    ])
+    def test_signature_plan_matches_generate_row_signature(self, model, ignore_fields, signature_size, x64arch):
+        rows = [
+            {'field_id': 'test', 'field_decimal': Decimal('1.5000'), 'id': 1},
+            {'field_id': '', 'field_decimal': Decimal('0.000'), 'id': 2, 'created_at': datetime.datetime(2020, 1, 1)},
+            {'field_decimal': None, 'field_id': 'b', 'not_a_column': 'x'},
+            [('field_id', 'c'), ('id', 3)],
+            {'id': 4, 'field_id': 'test', 'field_decimal': Decimal('1.5000')},
+        ]
+        plan = SignaturePlan(model, ignore_fields, signature_size=signature_size, x64arch=x64arch)
+        expected = [generate_row_signature(row, model, ignore_fields, signature_size=signature_size, x64arch=x64arch)
+                    for row in rows]
+        assert expected == plan.generate_signatures(rows)
+        assert expected[0] == plan.generate_signature(rows[0])
+
+    def test_signature_plan_invalid_size(self):
+        with pytest.raises(ValueError):
+            SignaturePlan(Model, signature_size=16)
+
+    @pytest.mark.parametrize("signature_size", [32, 64, 128])
+    def test_signature_formats(self, signature_size):
+        row = {'field_id': 'test', 'field_decimal': Decimal('1.5000'), 'id': 1}
+        hex_signature = generate_row_signature(row, Model, ['id'], signature_size=signature_size)
+        int_signature = generate_row_signature(row, Model, ['id'], signature_size=signature_size,
+                                               signature_format='int')
+        bytes_signature = generate_row_signature(row, Model, ['id'], signature_size=signature_size,
+                                                 signature_format='bytes')
+        assert hex(int_signature)[2:] == hex_signature
+        assert signature_size // 8 == len(bytes_signature)
+        assert int_signature % (1 << signature_size) == int.from_bytes(bytes_signature, 'big')
+        for signature_format, expected in (('int', int_signature), ('bytes', bytes_signature)):
+            plan = SignaturePlan(Model, ['id'], signature_size=signature_size, signature_format=signature_format)
+            assert [expected] == plan.generate_signatures([row])
+
+    def test_signature_plan_invalid_format(self):
+        with pytest.raises(ValueError):
+            SignaturePlan(Model, signature_format='base64')
+
+
+class TestBoundedSignatureSet:
+
+    def test_evicts_the_least_recently_seen(self):
+        signatures = [format(i, '032x') for i in range(5)]
+        entry_bytes = sys.getsizeof(signatures[0]) + BoundedSignatureSet.ENTRY_OVERHEAD_BYTES
+        signature_set = BoundedSignatureSet(max_bytes=3 * entry_bytes)
+        signature_set.update(signatures[:3])
+        assert signatures[0] in signature_set
+        signature_set.add(signatures[3])
+        assert 3 == len(signature_set)
+        assert 1 == signature_set.evictions
+        assert signatures[1] not in signature_set
+        assert {signatures[0], signatures[2], signatures[3]} == {i for i in signatures if i in signature_set}
+
+    def test_not_bounded(self):
+        signature_set = BoundedSignatureSet()
+        signature_set.update(range(1000))
+        assert 1000 == len(signature_set)
+        assert 0 == signature_set.evictions
@@ -1,8 +1,13 @@
+import datetime
 import pytest
+from unittest import mock
 from collections import Counter
 from deepdiff import DeepDiff
 
-from modelmapper.stats import StatsCollector, FieldStats, InconsistentData
+from modelmapper.normalization import normalize_numberic_values
+from modelmapper.stats import (StatsCollector, FieldStats, InconsistentData, UserInferenceRequired,
+                               DateTimeMatcher, get_datetime_format_regex, merge_field_stats,
+                               field_stats_to_dict, field_stats_from_dict)
 
 
 @pytest.fixture(scope='function')
@@ -142,3 +147,176 @@ def test_inconsistent_datetime(default_collector, values, expected_error):
             default_collector.inspect_item('blah', item)
         default_collector.collect()
     assert str(excinfo.value) == expected_error
+
+
+@pytest.mark.parametrize("sample, rest, expected_stats", [
+    # The datetime matcher did not match any value in the sample so it is skipped for the rest.
+    (['apple', 'orange'], ['8/8/18', '12/8/18', ''],
+     FieldStats(counter=Counter(HasString=4, HasNull=1), max_string_len=7, len=5),
+     ),
+    # The datetime formats that survived the sample are tried first for the rest.
+    (['8/8/18', '12/22/18'], ['12/8/18', '5/5/18'],
+     FieldStats(counter=Counter(HasDateTime=4), datetime_formats={'%m/%d/%y'}, len=4),
+     ),
+    # The cheap accumulators keep inspecting every value.
+    (['1.1', '2'], ['$13000.22', '30000', 'null'],
+     FieldStats(counter=Counter(HasDecimal=2, HasInt=2, HasDollar=1, HasNull=1),
+                max_int=30000, max_pre_decimal=5, max_decimal_scale=2, len=5),
+     ),
+])
+def test_expected_stats_with_sample(default_collector, sample, rest, expected_stats):
+    for item in sample:
+        default_collector.inspect_item('test-field', item)
+    default_collector.end_sample()
+    for item in rest:
+        default_collector.inspect_item('test-field', item)
+    stats = default_collector.collect()
+    assert DeepDiff(expected_stats, stats) == {}
+
+
+def test_decided_string_after_sample(default_collector):
+    for item in ['apple', 'orange']:
+        default_collector.inspect_item('test-field', item)
+    default_collector.end_sample(decided_string_length=5)
+    with mock.patch.object(default_collector, '_match_item', wraps=default_collector._match_item) as match_item:
+        for item in ['8/8/18', '12', 'null', 'watermelon']:
+            default_collector.inspect_item('test-field', item)
+    # Only the value longer than the longest string so far goes through the matchers.
+    assert [mock.call('test-field', 'watermelon')] == match_item.call_args_list
+    stats = default_collector.collect()
+    assert Counter(HasString=5, HasNull=1) == stats.counter
+    assert 10 == stats.max_string_len
+
+
+def test_inconsistent_datetime_after_sample(default_collector):
+    for item in ['8/8/18', '12/22/18']:
+        default_collector.inspect_item('test-field', item)
+    default_collector.end_sample()
+    with pytest.raises(InconsistentData) as excinfo:
+        for item in ['12/11/2018', '5/5/18']:
+            default_collector.inspect_item('test-field', item)
+    assert str(excinfo.value) == ('field test-field has inconsistent datetime data: 12/11/2018 '
+                                  'had %m/%d/%Y but previous dates in this field had %m/%d/%y')
+
+
+@pytest.mark.parametrize("values", [
+    ['1', '3', '4', '', '4', '1', '3'],
+    ['random string', '8/8/18', '12/8/18', 'NONE', '12/22/18', '', '8/8/18', 'random string'],
+    ['$1.92', '$33.6', '$0', 'null', '$13000.22', '$0', '$1.92'],
+])
+def test_distinct_values_are_matched_once(default_collector, values):
+    stats_per_value = StatsCollector()
+    for item in values:
+        stats_per_value.inspect_item('test-field', item)
+        stats_per_value._fold_value_counts()
+    for item in values:
+        default_collector.inspect_item('test-field', item)
+    assert DeepDiff(stats_per_value.collect(), default_collector.collect()) == {}
+
+
+def test_repeated_values_are_not_matched_again(default_collector):
+    with mock.patch.object(default_collector, '_match_item', wraps=default_collector._match_item) as match_item:
+        for item in ['apple', 'apple ', 'orange', 'apple']:
+            default_collector.inspect_item('test-field', item)
+    assert 2 == match_item.call_count
+    assert Counter(HasString=4) == default_collector.collect().counter
+
+
+def test_decided_string_field_skips_matchers():
+    collector = StatsCollector(decided_string_length=5)
+    with mock.patch.object(collector, '_match_item', wraps=collector._match_item) as match_item:
+        for item in ['12', 'John Smith', '10/15/1992', 'null', 'Jane', 'John Smithson']:
+            collector.inspect_item('test-field', item)
+    assert 3 == match_item.call_count
+    stats = collector.collect()
+    assert Counter(HasInt=1, HasString=4, HasNull=1) == stats.counter
+    assert 13 == stats.max_string_len
+
+
+@pytest.mark.parametrize("item, expected_calls", [
+    ('1,234', 1),
+    ('$12.50', 1),
+    ('12.50', 1),
+    ('John Smith', 0),
+])
+def test_numeric_value_is_parsed_once(item, expected_calls, default_collector):
+    with mock.patch('modelmapper.stats.normalize_numberic_values',
+                    wraps=normalize_numberic_values) as normalize:
+        default_collector.inspect_item('test-field', item)
+    assert expected_calls == normalize.call_count
+
+
+@pytest.mark.parametrize("values", [
+    ['1', '3', '4', '', '99', 'n'],
+    ['$1.50', '10.123', '', '2', 'null'],
+    ['01/02/18', '10/12/18', '', '12/30/18'],
+    ['apple', 'orange', 'Jane', '', 'John Smith'],
+])
+def test_merge_field_stats(values):
+    collector = StatsCollector()
+    for item in values:
+        collector.inspect_item('test-field', item)
+    expected = collector.collect()
+    all_stats = []
+    for i in range(3):
+        collector.reset()
+        for item in values[i::3]:
+            collector.inspect_item('test-field', item)
+        all_stats.append(field_stats_from_dict(field_stats_to_dict(collector.collect())))
+    assert not DeepDiff(expected, merge_field_stats(all_stats))
+    assert not DeepDiff(expected, merge_field_stats([merge_field_stats(all_stats[:2]), all_stats[2]]))
+
+
+def test_merge_field_stats_inconsistent_datetime():
+    with pytest.raises(InconsistentData):
+        merge_field_stats([FieldStats(counter=Counter(HasDateTime=1), datetime_formats={'%m/%d/%y'}, len=1),
+                           FieldStats(counter=Counter(HasNull=1), len=1),
+                           FieldStats(counter=Counter(HasDateTime=1), datetime_formats={'%Y%m%d'}, len=1)])
+
+
+def test_datetime_prompt_is_not_cached(default_collector):
+    """
+    A value that looks like a date but matches no format only needs the user's input
+    once a date was matched before. It should not be cached from before that.
+    """
+    default_collector.inspect_item('test-field', '12:00')
+    default_collector.inspect_item('test-field', '8/8/18')
+    with pytest.raises(UserInferenceRequired):
+        default_collector.inspect_item('test-field', '12:00')
+
+
+def test_cached_values_are_bounded(default_collector):
+    default_collector.MAX_CACHED_VALUES = 3
+    for item in ['a', 'b', 'c', 'd', 'e', 'a']:
+        default_collector.inspect_item('test-field', item)
+        assert len(default_collector.value_results) <= 3
+    assert Counter(HasString=6) == default_collector.collect().counter
+
+
+@pytest.mark.parametrize("_format, item, expected", [
+    ('%m/%d/%y', '12/22/18', True),
+    ('%m/%d/%y', 'John Smith', False),
+    ('%m/%d/%y', '$12.50', False),
+    ('%m/%d/%y', '1234567890', False),
+    ('%m/%d/%y', '13/45/18', True),  # strptime rejects it later
+    ('%Y-%m-%d', '2018-05-05', True),
+    ('%Y-%m-%d', '2018/05/05', False),
+    ('%Y-%m-%dT%H:%M:%S', '2018-05-05T10:10:10', True),
+    ('%Y-%m-%d %H:%M', '2018-05-05   10:10', True),
+    ('%d %b %Y', '5 may 2018', True),
+])
+def test_datetime_format_regex(_format, item, expected):
+    regex = get_datetime_format_regex(_format)
+    assert expected is (regex is None or regex.fullmatch(item) is not None)
+
+
+def test_datetime_matcher_parses_matched_item_once():
+    matcher = DateTimeMatcher(datetime_formats={'%m/%d/%y', '%m/%d/%Y', '%Y%m%d', '%Y-%m-%d'},
+                              datetime_allowed_characters=set('0123456789/:-'))
+    with mock.patch('modelmapper.stats.datetime') as mock_datetime:
+        mock_datetime.datetime.strptime.side_effect = datetime.datetime.strptime
+        assert matcher.match('12/22/18')
+        matcher.inspect('test-field', '12/22/18')
+        assert not matcher.match('John Smith')
+    assert 1 == mock_datetime.datetime.strptime.call_count
+    assert {'%m/%d/%y'} == matcher.candidate_formats
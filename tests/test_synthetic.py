@@ -0,0 +1,78 @@
+import io
+import os
+import csv
+import pytest
+from collections import Counter
+from decimal import Decimal
+
+from modelmapper import Cleaner
+from modelmapper.cleaner import CastingError
+from modelmapper.synthetic import generate_rows, write_synthetic_file
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+example_setup_path = os.path.join(current_dir, '../modelmapper/example/some_model_setup.toml')
+
+
+@pytest.fixture(scope='function')
+def fields():
+    return Cleaner(example_setup_path)._get_combined_module().FIELDS
+
+
+@pytest.fixture(scope='function')
+def cleaner(fields):
+    cleaner = Cleaner(example_setup_path)
+    # The csv sniffer can not always tell that random data has a header.
+    cleaner.settings = cleaner.settings._replace(identify_header_by_column_names=set(fields.keys()))
+    return cleaner
+
+
+class TestSynthetic:
+
+    def test_generate_rows_can_be_cleaned(self, cleaner, fields):
+        rows = list(generate_rows(fields, 200, null_rate=0.1))
+        assert list(fields.keys()) == rows[0]
+        assert 201 == len(rows)
+        content = io.StringIO()
+        csv.writer(content).writerows(rows)
+        cleaned = list(cleaner.clean('csv', content=content.getvalue()))
+        assert 200 == len(cleaned)
+
+    def test_generate_rows_is_deterministic(self, fields):
+        assert list(generate_rows(fields, 20, seed=3)) == list(generate_rows(fields, 20, seed=3))
+        assert list(generate_rows(fields, 20, seed=3)) != list(generate_rows(fields, 20, seed=4))
+
+    def test_generate_rows_with_errors(self, cleaner, fields):
+        rows = list(generate_rows(fields, 200, error_rate=0.2))
+        content = io.StringIO()
+        csv.writer(content).writerows(rows)
+        with pytest.raises(CastingError):
+            list(cleaner.clean('csv', content=content.getvalue()))
+
+    def test_generate_rows_with_duplicates_and_cardinality(self, fields):
+        rows = list(generate_rows(fields, 500, duplicate_rate=0.5))[1:]
+        assert 200 < 500 - len(set(map(tuple, rows))) < 300
+        rows = list(generate_rows(fields, 500, null_rate=0, cardinality=3))[1:]
+        for values in zip(*rows):
+            assert len(Counter(values)) <= 3
+
+    @pytest.mark.parametrize("file_format", ['csv', 'tsv', 'xlsx'])
+    def test_write_synthetic_file(self, file_format, cleaner, fields, tmpdir):
+        path = str(tmpdir.join(f'synthetic.{file_format}'))
+        write_synthetic_file(path, fields, 50)
+        cleaned = list(cleaner.clean(file_format, path=path))
+        assert 50 == len(cleaned)
+        assert set(fields.keys()) == set(cleaned[0].keys())
+
+    def test_xlsx_round_trip_has_the_same_values_as_csv(self, cleaner, fields, tmpdir):
+        csv_path = str(tmpdir.join('synthetic.csv'))
+        xlsx_path = str(tmpdir.join('synthetic.xlsx'))
+        write_synthetic_file(csv_path, fields, 100, seed=5)
+        write_synthetic_file(xlsx_path, fields, 100, seed=5)
+        from_csv = list(cleaner.clean('csv', path=csv_path))
+        cleaner.reset()
+        from_xlsx = list(cleaner.clean('xlsx', path=xlsx_path))
+        assert from_csv == from_xlsx
+        # The percents are stored as fractions and the dollars as cents.
+        slopes = [i['slope'] for i in from_xlsx if i['slope'] is not None]
+        assert slopes and all(0 <= i < Decimal('0.1') for i in slopes)
+        assert any(i['value_current'] for i in from_xlsx)
@@ -0,0 +1,87 @@
+import json
+from unittest.mock import Mock
+
+import pytest
+
+from modelmapper.tracing import Tracer, JsonLinesExporter, OpenTelemetryExporter, trace_span, trace_iterate
+
+
+class TestTracing:
+
+    def test_nested_spans(self):
+        exporter = Mock()
+        tracer = Tracer(exporters=[exporter])
+        with tracer.span('run', job='SomeJob') as run_span:
+            with tracer.span('insert', rows=3) as insert_span:
+                insert_span.set_attribute('inserted', 2)
+                assert insert_span is tracer.current_span
+            with pytest.raises(ValueError):
+                with tracer.span('commit') as commit_span:
+                    raise ValueError('failed')
+        assert tracer.current_span is None
+
+        assert [run_span, insert_span, commit_span] == [i[0][0] for i in exporter.on_start.call_args_list]
+        assert [insert_span, commit_span, run_span] == [i[0][0] for i in exporter.on_end.call_args_list]
+        assert run_span.parent_id is None
+        assert {run_span.trace_id} == {insert_span.trace_id, commit_span.trace_id}
+        assert run_span.span_id == insert_span.parent_id == commit_span.parent_id
+        assert {'rows': 3, 'inserted': 2} == insert_span.attributes
+        assert ('ok', None) == (insert_span.status, insert_span.error)
+        assert ('error', 'ValueError: failed') == (commit_span.status, commit_span.error)
+        assert run_span.start_time <= insert_span.start_time <= insert_span.end_time <= run_span.end_time
+
+    def test_json_lines_exporter(self, tmpdir):
+        path = str(tmpdir.join('spans.jsonl'))
+        tracer = Tracer(exporters=[JsonLinesExporter(path)])
+        with tracer.span('run'):
+            with tracer.span('clean', bytes=10):
+                pass
+        with open(path, 'r') as the_file:
+            spans = [json.loads(line) for line in the_file]
+        assert ['clean', 'run'] == [i['name'] for i in spans]
+        assert {'bytes': 10} == spans[0]['attributes']
+        assert spans[1]['span_id'] == spans[0]['parent_id']
+        assert spans[0]['duration_seconds'] >= 0
+
+    def test_iterate(self):
+        exporter = Mock()
+        tracer = Tracer(exporters=[exporter])
+
+        def rows():
+            yield 1
+            yield 2
+            raise ValueError('failed')
+
+        with tracer.span('run') as run_span:
+            items = tracer.iterate('clean', rows(), bytes=10)
+            # The span only starts when the first item is requested.
+            assert 1 == exporter.on_start.call_count
+            assert 1 == next(items)
+            with tracer.span('insert') as insert_span:
+                assert 2 == next(items)
+            with pytest.raises(ValueError):
+                next(items)
+
+        clean_span = exporter.on_end.call_args_list[1][0][0]
+        assert 'clean' == clean_span.name
+        assert run_span.span_id == clean_span.parent_id == insert_span.parent_id
+        assert {'bytes': 10, 'rows': 2} == clean_span.attributes
+        assert ('error', 'ValueError: failed') == (clean_span.status, clean_span.error)
+
+    def test_trace_iterate_without_tracer(self):
+        items = [1, 2]
+        assert items is trace_iterate(None, 'clean', items)
+
+    def test_trace_span_without_tracer(self):
+        with trace_span(None, 'run') as span:
+            assert span is None
+
+    def test_open_telemetry_exporter(self):
+        trace = pytest.importorskip('opentelemetry.trace')
+        tracer = Mock()
+        exporter = OpenTelemetryExporter(tracer=tracer)
+        with Tracer(exporters=[exporter]).span('run', job='SomeJob'):
+            pass
+        assert 'run' == tracer.start_span.call_args[0][0]
+        tracer.start_span.return_value.set_attributes.assert_called_once_with({'job': 'SomeJob'})
+        assert trace